@@ -0,0 +1,278 @@
+"""Runs the same workload against every storage engine and compares their results.
+
+The workload is a seeded sequence of data.Storage calls: servers, roles, channels, joins and departures,
+buffer flushes with voice sessions and snapshot tokens, role syncs, server removals, and reads in between. Every engine
+must return the same results as the first one. The engines are then closed and opened again, to check
+that the data they persist reads back the same. The time each engine spends on the workload is reported
+to compare them.
+
+    python -m benchmarks.conformance --servers 20 --users 500 --flushes 200
+    python -m benchmarks.conformance --engines memory --json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+import cache
+import storage
+
+FIRST_DAY = 740000
+
+
+def normalize(value):
+    # Rows of equal XP come in any order from get_users, configs are compared field by field
+    if isinstance(value, Exception):
+        return 'error'
+    if isinstance(value, cache.ServerConfig):
+        return normalize({name: getattr(value, name) for name in value.__slots__})
+    if isinstance(value, dict):
+        return {repr(key): normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    return value
+
+def normalize_users(rows: list[tuple]) -> list:
+    return [list(row) for row in sorted(rows, key=lambda row: (-row[2], row[1]))]
+
+
+class Workload():
+    """Seeded list of (name, args, kwargs) calls, the same for every engine."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.rng = random.Random(args.seed)
+        self.args = args
+        self.calls: list[tuple[str, tuple, dict]] = [('init', (), {})]
+        self.servers: dict[int:set[int]] = {}
+        self.next_id = 1000
+        self.day = FIRST_DAY
+
+    def new_id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def call(self, name: str, *args, **kwargs):
+        self.calls.append((name, args, kwargs))
+
+    def reads(self, server_id: int):
+        members = self.servers.get(server_id) or {0}
+        user_id = self.rng.choice(sorted(members))
+        self.call('get_server_config', server_id)
+        self.call('get_users', server_id)
+        self.call('get_users', server_id, 10)
+        self.call('get_user', server_id, user_id)
+        self.call('get_user_history', server_id, user_id, self.day - 7)
+        self.call('get_period_leaderboard', server_id, self.day - 7, 10)
+        self.call('get_period_leaderboard', server_id, self.day - 30, 5, 5)
+        self.call('get_global_leaderboard', 10)
+        self.call('get_global_leaderboard', 10, 20)
+
+    def add_server(self):
+        server_id = self.new_id()
+        self.servers[server_id] = set()
+        self.call('add_server', server_id, f'server-{server_id}')
+        self.call('set_xp_rate_text', server_id, self.rng.randint(1, 20), self.rng.randint(0, 60), self.rng.randint(-1, 500), self.rng.choice([0.5, 0.9, 1.0]), 1)
+        self.call('set_xp_rate_voice', server_id, self.rng.randint(1, 5))
+        self.call('set_mod_role', server_id, self.new_id())
+        # Servers join the global leaderboard before or after their users are added, or not at all
+        joins_global = self.rng.random()
+        if joins_global < 0.3:
+            self.call('set_global_leaderboard', server_id, True)
+        for _ in range(self.rng.randint(0, 5)):
+            self.call('set_role', server_id, self.new_id(), self.rng.choice([0, 100, 500, 1000]))
+        for channel_type in (0, 2, 4):
+            self.call('add_channel', server_id, self.new_id(), channel_type)
+        users = [(f'user-{user_id}', user_id) for user_id in (self.new_id() for _ in range(self.args.users))]
+        self.servers[server_id].update(user_id for _, user_id in users)
+        self.call('init_users', server_id, users)
+        # Duplicates are ignored, both within a call and with the stored users
+        self.call('add_users', [(username, user_id, server_id) for username, user_id in users[:10]] * 2)
+        if joins_global > 0.6:
+            self.call('set_global_leaderboard', server_id, True)
+        self.call('add_server', server_id, 'duplicate')
+
+    def flush(self):
+        rng = self.rng
+        rows, new_users, departed = [], [], []
+        for server_id in rng.sample(sorted(self.servers), min(3, len(self.servers))):
+            members = sorted(self.servers[server_id])
+            for user_id in rng.sample(members, min(20, len(members))):
+                last_message = rng.random() < 0.7
+                # Some activity is flushed the day after it happened
+                rows.append((rng.randint(0, 30), rng.randint(0, 3), rng.randint(0, 10),
+                             time.time() + rng.random() if last_message else None, rng.randint(1, 20) if last_message else None,
+                             server_id, user_id, self.day - (rng.random() < 0.1)))
+            if rng.random() < 0.3:
+                user_id = self.new_id()
+                new_users.append((f'user-{user_id}', user_id, server_id))
+                self.servers[server_id].add(user_id)
+                rows.append((5, 1, 0, 1.5, 5, server_id, user_id, self.day))
+            if rng.random() < 0.2 and members:
+                user_id = rng.choice(members)
+                departed.append((server_id, user_id))
+                self.servers[server_id].discard(user_id)
+        # XP of a user who is not stored only goes to the activity of the day
+        rows.append((7, 1, 0, None, None, rng.choice(sorted(self.servers)), self.new_id(), self.day))
+        sessions = [(server_id, rng.choice(sorted(members)), 1000 + rng.random())
+                    for server_id, members in self.servers.items() if members and rng.random() < 0.5]
+        voice_servers = rng.sample(sorted(self.servers), min(2, len(self.servers))) if rng.random() < 0.5 else None
+        if voice_servers is not None:
+            sessions = [session for session in sessions if session[0] in voice_servers]
+        snapshot = rng.choice([None, ('process-0', None), ('process-0', rng.getrandbits(63)), ('process-1', rng.getrandbits(63))])
+        self.call('update_users', rows, sessions if rng.random() < 0.8 else None,
+                  new_users=new_users, departed_users=departed, voice_servers=voice_servers, snapshot=snapshot)
+        self.call('get_snapshot_token', 'process-0')
+        self.call('get_snapshot_token', 'process-1')
+
+    def other_write(self):
+        rng = self.rng
+        server_id = rng.choice(sorted(self.servers))
+        members = sorted(self.servers[server_id])
+        action = rng.randrange(8)
+        if action == 0 and members:
+            self.call('set_user_xp', server_id, rng.choice(members), rng.randint(0, 10000))
+        elif action == 1 and members:
+            self.call('set_users_xp', [(rng.randint(0, 10000), 2000.5, 3, server_id, user_id) for user_id in rng.sample(members, min(5, len(members)))])
+        elif action == 2 and members:
+            user_id = rng.choice(members)
+            self.servers[server_id].discard(user_id)
+            self.call('rm_user', server_id, user_id)
+        elif action == 3:
+            self.call('set_role_sync', server_id, self.new_id(), rng.randint(0, 10 ** 6))
+        elif action == 4:
+            self.call('rm_role_sync', server_id)
+            self.call('get_role_syncs')
+        elif action == 6:
+            self.call('set_global_leaderboard', server_id, rng.random() < 0.6)
+            self.call('get_global_leaderboard', 20)
+        elif action == 5:
+            self.call('set_role', server_id, self.new_id(), rng.randint(0, 2000))
+            self.call('rm_role', self.next_id)
+            self.call('rm_channel', rng.randint(1000, self.next_id))
+        else:
+            self.call('set_xp_rate_voice', server_id, rng.randint(1, 5))
+
+    def build(self) -> list[tuple[str, tuple, dict]]:
+        for _ in range(self.args.servers):
+            self.add_server()
+        self.call('get_servers')
+        self.call('get_server_configs')
+        for n in range(self.args.flushes):
+            self.flush()
+            self.other_write()
+            if n % 10 == 0:
+                self.day += 1
+                self.reads(self.rng.choice(sorted(self.servers)))
+                self.call('get_voice_sessions')
+            if n % 50 == 49 and len(self.servers) > 1:
+                server_id = self.rng.choice(sorted(self.servers))
+                del self.servers[server_id]
+                self.call('rm_server', server_id)
+                self.call('get_servers')
+        return self.calls
+
+    def final_reads(self) -> list[tuple[str, tuple, dict]]:
+        calls = [('get_servers', (), {}), ('get_server_configs', (), {}), ('get_role_syncs', (), {}), ('get_voice_sessions', (), {}),
+                 ('get_global_leaderboard', (10 ** 6,), {}), ('get_snapshot_token', ('process-0',), {}), ('get_snapshot_token', ('process-1',), {})]
+        for server_id in sorted(self.servers):
+            calls += [('get_users', (server_id,), {}), ('get_period_leaderboard', (server_id, FIRST_DAY, 10 ** 6), {})]
+            calls += [('get_user_history', (server_id, user_id, FIRST_DAY), {}) for user_id in sorted(self.servers[server_id])[:20]]
+        return calls
+
+
+def execute(db, calls: list[tuple[str, tuple, dict]]) -> tuple[list, dict[str:float]]:
+    results, seconds = [], {}
+    for name, args, kwargs in calls:
+        start = time.perf_counter()
+        try:
+            result = getattr(db, name)(*args, **kwargs)
+        except Exception as e:
+            result = e
+        seconds[name] = seconds.get(name, 0) + time.perf_counter() - start
+        results.append(normalize_users(result) if name == 'get_users' and not isinstance(result, Exception) else normalize(result))
+    return results, seconds
+
+def compare(calls: list[tuple[str, tuple, dict]], expected: list, results: list, limit: int = 5) -> list[str]:
+    errors = []
+    for (name, args, _), expected_result, result in zip(calls, expected, results):
+        if result != expected_result:
+            errors.append(f'{name}{args[:3]}: {str(result)[:200]} instead of {str(expected_result)[:200]}')
+            if len(errors) == limit:
+                break
+    return errors
+
+
+def run_engine(name: str, path: str, calls: list, final_calls: list) -> dict:
+    engine = storage.ENGINES[name]
+    db = engine(path)
+    results, seconds = execute(db, calls)
+    final_results, _ = execute(db, final_calls)
+    db.close()
+    # A new instance on the same path reads back what the first one persisted
+    db = engine(path)
+    db.init()
+    reopened_results, _ = execute(db, final_calls)
+    db.close()
+    return {
+        'results': results + final_results,
+        'reopened': reopened_results,
+        'seconds': seconds,
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    workload = Workload(args)
+    calls = workload.build()
+    final_calls = workload.final_reads()
+    engines = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in args.engines:
+            engines[name] = run_engine(name, os.path.join(tmpdir, name), calls, final_calls)
+
+    reference = engines[args.engines[0]]['results']
+    report = {'calls': len(calls), 'engines': {}}
+    for name, result in engines.items():
+        duration = sum(result['seconds'].values())
+        report['engines'][name] = {
+            'duration_s': duration,
+            'calls_per_s': len(calls) / duration if duration else 0,
+            'errors': compare(calls + final_calls, reference, result['results']),
+            'reopen_errors': compare(final_calls, result['results'][len(calls):], result['reopened']),
+            'method_ms': {method: seconds * 1000 for method, seconds in sorted(result['seconds'].items())},
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the storage engines give the same results on the same workload, and time them")
+    parser.add_argument('--engines', nargs='+', choices=storage.ENGINES, default=list(storage.ENGINES), help="the first one is the reference")
+    parser.add_argument('--servers', type=int, default=20)
+    parser.add_argument('--users', type=int, default=500, help="users per server")
+    parser.add_argument('--flushes', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    report = run(args)
+    failed = any(result['errors'] or result['reopen_errors'] for result in report['engines'].values())
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"{report['calls']} calls")
+        for name, result in report['engines'].items():
+            status = 'ok' if not (result['errors'] or result['reopen_errors']) else 'FAILED'
+            print(f"  {name:<8} {result['duration_s'] * 1000:8.1f} ms   {result['calls_per_s']:8.0f} calls/s   {status}")
+            for error in result['errors']:
+                print(f'    {error}')
+            for error in result['reopen_errors']:
+                print(f'    after reopening: {error}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
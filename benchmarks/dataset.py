@@ -0,0 +1,98 @@
+"""Generates a synthetic SQLite database with the bot's schema, for the storage benchmarks.
+
+Guild sizes follow a Zipf-like distribution and some members are shared between guilds.
+Each member also gets daily activity rows over the last --history-days days.
+
+    python -m benchmarks.dataset bench.db --guilds 2000 --users 1000000 --history-days 90
+"""
+import os
+import time
+import datetime
+import random
+import argparse
+
+import data
+
+CHUNK_SIZE = 50000
+ROLE_THRESHOLDS = (0, 50, 200, 1000, 5000)
+
+
+def guild_sizes(n_guilds: int, n_users: int, rng: random.Random) -> list[int]:
+    weights = [1 / (rank ** 1.1) for rank in range(1, n_guilds + 1)]
+    total = sum(weights)
+    sizes = [max(1, int(n_users * weight / total)) for weight in weights]
+    rng.shuffle(sizes)
+    return sizes
+
+
+def user_rows(server_id: int, size: int, user_pool: range, rng: random.Random, now: float):
+    for discord_id in rng.sample(user_pool, min(size, len(user_pool))):
+        xp = int(rng.paretovariate(1.5) * 10) - 10
+        lastmsg_time = now - rng.random() * 30 * 86400
+        yield (f'user-{discord_id}', discord_id, server_id, xp, xp // 5, rng.randrange(0, 600), lastmsg_time, rng.randrange(1, 10))
+
+
+def daily_rows(server_id: int, discord_id: int, history_days: int, rng: random.Random, today: int):
+    for day in rng.sample(range(today - history_days + 1, today + 1), rng.randrange(0, history_days // 3 + 1)):
+        msg_count = rng.randrange(1, 50)
+        voice_uptime = rng.randrange(0, 120)
+        yield (server_id, discord_id, day, msg_count * 5 + voice_uptime, msg_count, voice_uptime)
+
+def generate(path: str, n_guilds: int, n_users: int, seed: int = 0, history_days: int = 30) -> dict:
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    rng = random.Random(seed)
+    db = data.Database(path)
+    db.init()
+    db.cur.execute('PRAGMA synchronous = OFF')
+
+    start = time.perf_counter()
+    now = time.time()
+    today = datetime.date.today().toordinal()
+    # Members are drawn from a pool smaller than the number of rows, so that some are in several guilds
+    first_id = 100_000_000_000_000_000
+    user_pool = range(first_id, first_id + max(1, int(n_users * 0.6)))
+    with db.con:
+        rows = []
+        days = []
+        for n, size in enumerate(guild_sizes(n_guilds, n_users, rng)):
+            server_id = 1_000_000_000_000_000 + n
+            # Every guild is in the global leaderboard, the worst case for the triggers maintaining it
+            db.cur.execute('INSERT INTO servers (id, name, global_leaderboard) VALUES (?, ?, 1)', (server_id, f'guild-{n}'))
+            db.cur.executemany('INSERT INTO roles (id, xp_threshold, server_id) VALUES (?, ?, ?)',
+                               [(server_id * 10 + i, xp_threshold, server_id) for i, xp_threshold in enumerate(ROLE_THRESHOLDS)])
+            db.cur.executemany('INSERT INTO channels (id, type, server_id) VALUES (?, ?, ?)',
+                               [(server_id * 10 + i, 0 if i < 3 else 2, server_id) for i in range(5)])
+            for row in user_rows(server_id, size, user_pool, rng, now):
+                rows.append(row)
+                if history_days:
+                    days.extend(daily_rows(server_id, row[1], history_days, rng, today))
+                if len(rows) >= CHUNK_SIZE:
+                    db.cur.executemany('INSERT INTO users (username, discord_id, server_id, xp, msg_count, voice_uptime, lastmsg_time, lastmsg_xp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                    db.cur.executemany('INSERT INTO user_daily (server_id, discord_id, day, xp, msg_count, voice_uptime) VALUES (?, ?, ?, ?, ?, ?)', days)
+                    rows = []
+                    days = []
+        db.cur.executemany('INSERT INTO users (username, discord_id, server_id, xp, msg_count, voice_uptime, lastmsg_time, lastmsg_xp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        db.cur.executemany('INSERT INTO user_daily (server_id, discord_id, day, xp, msg_count, voice_uptime) VALUES (?, ?, ?, ?, ?, ?)', days)
+    db.cur.execute('ANALYZE')
+
+    db.cur.execute('SELECT COUNT(*) FROM users')
+    n_rows = db.cur.fetchone()[0]
+    return {'path': path, 'guilds': n_guilds, 'users': n_rows, 'seed': seed, 'duration_s': time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic database for the storage benchmarks")
+    parser.add_argument('path')
+    parser.add_argument('--guilds', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100000, help="total number of user rows")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--history-days', type=int, default=30, help="days of daily activity rows per member, 0 for none")
+    args = parser.parse_args()
+
+    result = generate(args.path, args.guilds, args.users, args.seed, args.history_days)
+    print(f"Generated {result['users']} users in {result['guilds']} guilds in {result['duration_s']:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
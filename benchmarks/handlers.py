@@ -0,0 +1,277 @@
+"""Replays synthetic gateway traffic through the event handlers of main.py, without connecting to Discord.
+
+Discord objects are replaced by minimal stand-ins, role edits go to a stubbed REST call
+and the database is a temporary SQLite file. The replay ends once the role outbox is drained.
+
+    python -m benchmarks.handlers --guilds 10 --members 5000 --events 100000
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import importlib
+import tempfile
+import statistics
+
+
+# ================================
+# Stand-ins
+# ================================
+
+class FakeRest():
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeRole():
+    __slots__ = ('id', 'default')
+
+    def __init__(self, role_id: int, default: bool = False):
+        self.id = role_id
+        self.default = default
+
+    def is_default(self) -> bool:
+        return self.default
+
+
+class FakeChannel():
+    __slots__ = ('id',)
+
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+
+
+class FakeGuild():
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f'guild-{guild_id}'
+        self.members: list[FakeMember] = []
+        self.text_channels: list[FakeChannel] = []
+        self.voice_channels: list[FakeChannel] = []
+        self.in_voice: dict[int:FakeChannel] = {}
+
+    def add_member(self, member: 'FakeMember'):
+        self.members.append(member)
+
+    def get_member(self, member_id: int) -> 'FakeMember | None':
+        # Members ids are consecutive from the first one
+        index = member_id - self.members[0].id if self.members else -1
+        return self.members[index] if 0 <= index < len(self.members) else None
+
+
+class FakeMember():
+    def __init__(self, member_id: int, guild: FakeGuild, rest: FakeRest):
+        self.id = member_id
+        self.name = f'member-{member_id}'
+        self.bot = False
+        self.guild = guild
+        # Like a Discord member, with the @everyone role of the guild first
+        self.roles: list[FakeRole] = [FakeRole(guild.id, default=True)]
+        self.rest = rest
+
+    async def add_roles(self, *roles):
+        for role in roles:
+            await self.rest.call()
+            self.roles.append(FakeRole(role.id))
+
+    async def remove_roles(self, *roles):
+        for role in roles:
+            await self.rest.call()
+        role_ids = {role.id for role in roles}
+        self.roles = [role for role in self.roles if role.id not in role_ids]
+
+
+class FakeVoiceState():
+    __slots__ = ('channel',)
+
+    def __init__(self, channel: FakeChannel | None):
+        self.channel = channel
+
+
+class FakeMessage():
+    __slots__ = ('author', 'guild', 'channel')
+
+    def __init__(self, author: FakeMember, channel: FakeChannel):
+        self.author = author
+        self.guild = author.guild
+        self.channel = channel
+
+
+# ================================
+# Traffic
+# ================================
+
+async def setup_guilds(bot, args: argparse.Namespace, rest: FakeRest, first_guild: int = 0) -> list[FakeGuild]:
+    await bot.db.init()
+    guilds = []
+    for n in range(first_guild, first_guild + args.guilds):
+        guild = FakeGuild(10**6 * (n + 1))
+        await bot.db.add_server(guild.id, guild.name)
+        await bot.db.set_xp_rate_text(guild.id, 10, args.cooldown, 100, 0.9, 1)
+        await bot.db.set_xp_rate_voice(guild.id, 2)
+        for i, xp_threshold in enumerate((0, 50, 500, 5000)):
+            await bot.db.set_role(guild.id, guild.id + 100 + i, xp_threshold)
+        # The last text channel is not tracked
+        guild.text_channels = [FakeChannel(guild.id + 200 + i) for i in range(4)]
+        guild.voice_channels = [FakeChannel(guild.id + 300 + i) for i in range(3)]
+        for channel in guild.text_channels[:-1]:
+            await bot.db.add_channel(guild.id, channel.id, 0)
+        for channel in guild.voice_channels[:-1]:
+            await bot.db.add_channel(guild.id, channel.id, 2)
+
+        guild.members = [FakeMember(guild.id + 1000 + i, guild, rest) for i in range(args.members)]
+        await bot.db.add_users([(member.name, member.id, guild.id) for member in guild.members])
+        guilds.append(guild)
+
+    for guild in guilds:
+        await bot.load_server(await bot.db.get_server_config(guild.id))
+    return guilds
+
+
+def generate_events(bot, guilds: list[FakeGuild], args: argparse.Namespace, rest: FakeRest, rng: random.Random) -> list[tuple]:
+    kinds = ['message', 'voice', 'join']
+    weights = [args.message_rate, args.voice_churn, args.join_rate]
+    events = []
+    for _ in range(args.events):
+        kind = rng.choices(kinds, weights)[0]
+        guild = rng.choice(guilds)
+        if kind == 'message':
+            # A few members write most of the messages
+            author = guild.members[int(rng.random() ** 3 * len(guild.members))]
+            events.append((kind, bot.on_message, (FakeMessage(author, rng.choice(guild.text_channels)),)))
+        elif kind == 'voice':
+            member = rng.choice(guild.members)
+            before = guild.in_voice.get(member.id)
+            after = None if before is not None and rng.random() < 0.7 else rng.choice(guild.voice_channels)
+            if after is None:
+                del guild.in_voice[member.id]
+            else:
+                guild.in_voice[member.id] = after
+            events.append((kind, bot.on_voice_state_update, (member, FakeVoiceState(before), FakeVoiceState(after))))
+        else:
+            member = FakeMember(guild.members[-1].id + 1, guild, rest)
+            guild.add_member(member)
+            events.append((kind, bot.on_member_join, (member,)))
+    return events
+
+
+# ================================
+# Measures
+# ================================
+
+class DatabaseTimer():
+    # Wraps every call going through storage.AsyncDatabase
+    def __init__(self, db):
+        self.calls = 0
+        self.total = 0.0
+        submit = db._submit
+
+        async def timed_submit(*args):
+            start = time.perf_counter()
+            try:
+                return await submit(*args)
+            finally:
+                self.calls += 1
+                self.total += time.perf_counter() - start
+        db._submit = timed_submit
+
+
+def percentiles(latencies: list[float]) -> dict:
+    if len(latencies) < 2:
+        value = latencies[0] * 1000 if latencies else 0
+        return {'p50_ms': value, 'p99_ms': value}
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {'p50_ms': quantiles[49] * 1000, 'p99_ms': quantiles[98] * 1000}
+
+
+async def replay(bot, events: list[tuple], args: argparse.Namespace, rest: FakeRest) -> dict:
+    timer = DatabaseTimer(bot.db)
+    latencies = {kind: [] for kind, _, _ in events}
+    bot.role_outbox.start()
+    start = time.perf_counter()
+    for n, (kind, handler, handler_args) in enumerate(events, start=1):
+        event_start = time.perf_counter()
+        await handler(*handler_args)
+        latencies[kind].append(time.perf_counter() - event_start)
+        if n % args.flush_every == 0:
+            await bot.flush_xp_buffer()
+    await bot.flush_xp_buffer()
+    await bot.role_outbox.join()
+    duration = time.perf_counter() - start
+
+    return {
+        'profile': vars(args),
+        'events': len(events),
+        'duration_s': duration,
+        'events_per_s': len(events) / duration if duration else 0,
+        'db_calls': timer.calls,
+        'db_ms_per_event': timer.total * 1000 / len(events) if events else 0,
+        'rest_calls': rest.calls,
+        'flushes': bot.xp_buffer.flush_count,
+        'handlers': {kind: {'events': len(values), **percentiles(values)} for kind, values in latencies.items()},
+    }
+
+
+def print_report(result: dict):
+    print(f"{result['events']} events in {result['duration_s']:.2f} s: {result['events_per_s']:.0f} events/s")
+    print(f"DB: {result['db_calls']} calls, {result['db_ms_per_event']:.3f} ms/event, {result['flushes']} flushes")
+    print(f"REST: {result['rest_calls']} calls")
+    for kind, stats in result['handlers'].items():
+        print(f"  {kind:<8} {stats['events']:>8} events   p50 {stats['p50_ms']:.3f} ms   p99 {stats['p99_ms']:.3f} ms")
+
+
+async def run(args: argparse.Namespace) -> dict:
+    # main reads its storage settings, JOURNAL_DIR and ROLE_UPDATE_RATE when it is imported
+    os.environ['DB_PATH'] = os.path.join(args.tmpdir, 'bench.db')
+    os.environ['STORAGE_ENGINE'] = args.engine
+    os.environ['MEMORY_SNAPSHOT'] = ''
+    os.environ['JOURNAL_DIR'] = os.path.join(args.tmpdir, 'journal')
+    os.environ['ROLE_UPDATE_RATE'] = '0'
+    bot = importlib.import_module('main')
+    rest = FakeRest(args.rest_latency / 1000)
+    rng = random.Random(args.seed)
+    guilds = await setup_guilds(bot, args, rest)
+    events = generate_events(bot, guilds, args, rest, rng)
+    result = await replay(bot, events, args, rest)
+    bot.db.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's event handlers on synthetic traffic")
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--members', type=int, default=1000, help="members per guild")
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--message-rate', type=float, default=0.9, help="share of message events")
+    parser.add_argument('--voice-churn', type=float, default=0.08, help="share of voice state events")
+    parser.add_argument('--join-rate', type=float, default=0.02, help="share of member joins")
+    parser.add_argument('--cooldown', type=int, default=0, help="text XP cooldown in seconds")
+    parser.add_argument('--rest-latency', type=float, default=0, help="latency of a stubbed REST call in ms")
+    parser.add_argument('--flush-every', type=int, default=1000, help="events between two buffer flushes")
+    parser.add_argument('--engine', choices=['sqlite', 'memory'], default='sqlite', help="storage engine, see storage.ENGINES")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.tmpdir = tmpdir
+        result = asyncio.run(run(args))
+    del result['profile']['tmpdir']
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
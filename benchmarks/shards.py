@@ -0,0 +1,126 @@
+"""Runs stand-in shards against one writer process, as cluster.py deploys the bot, without connecting to Discord.
+
+Each shard is a process importing main.py with STORAGE_ADDRESS set, replaying the synthetic traffic of
+benchmarks.handlers on its own guilds. Once every shard is done, the XP stored by the writer is compared
+with the XP cached by each shard.
+
+    python -m benchmarks.shards --shards 4 --guilds 5 --events 50000
+"""
+import os
+import sys
+import json
+import time
+import random
+import secrets
+import asyncio
+import argparse
+import importlib
+import tempfile
+import multiprocessing
+
+import data
+import writer
+from benchmarks import handlers
+
+
+def run_shard(n: int, args: argparse.Namespace, results: multiprocessing.Queue):
+    # main reads its settings when it is imported, the process is spawned so that it is imported here
+    os.environ['STORAGE_ADDRESS'] = args.address
+    os.environ['STORAGE_AUTHKEY'] = args.authkey
+    os.environ['JOURNAL_DIR'] = os.path.join(args.tmpdir, f'journal-{n}')
+    os.environ['ROLE_UPDATE_RATE'] = '0'
+    bot = importlib.import_module('main')
+
+    async def replay():
+        rest = handlers.FakeRest(args.rest_latency / 1000)
+        guilds = await handlers.setup_guilds(bot, args, rest, first_guild=n * args.guilds)
+        events = handlers.generate_events(bot, guilds, args, rest, random.Random(args.seed + n))
+        result = await handlers.replay(bot, events, args, rest)
+        xp = {guild.id: sum(user.xp for user in bot.cached.get_server(guild.id).users.values()) for guild in guilds}
+        bot.db.close()
+        return result, xp
+
+    result, xp = asyncio.run(replay())
+    results.put((n, result, xp))
+
+
+def check_totals(path: str, cached_xp: dict[int:int]) -> list[str]:
+    db = data.Database(path)
+    errors = []
+    for server_id, xp in cached_xp.items():
+        db.cur.execute('SELECT COALESCE(SUM(xp), 0) FROM users WHERE server_id = ?', (server_id,))
+        stored_xp = db.cur.fetchone()[0]
+        if stored_xp != xp:
+            errors.append(f'{server_id}: {stored_xp} XP stored, {xp} XP cached')
+    db.con.close()
+    return errors
+
+
+def run(args: argparse.Namespace) -> dict:
+    path = os.path.join(args.tmpdir, 'bench.db')
+    args.address = os.path.join(args.tmpdir, 'writer.sock')
+    # As cluster.py does, the writer only serves the processes holding the key
+    args.authkey = secrets.token_bytes(32).hex()
+    context = multiprocessing.get_context('spawn')
+    storage_process = context.Process(target=writer.serve, args=(args.address, path), kwargs={'authkey': args.authkey.encode()})
+    storage_process.start()
+    while not os.path.exists(args.address):
+        time.sleep(0.05)
+
+    results = context.Queue()
+    start = time.perf_counter()
+    shards = [context.Process(target=run_shard, args=(n, args, results)) for n in range(args.shards)]
+    for shard in shards:
+        shard.start()
+    shard_results = [results.get() for _ in shards]
+    duration = time.perf_counter() - start
+    for shard in shards:
+        shard.join()
+    storage_process.terminate()
+    storage_process.join()
+
+    cached_xp = {server_id: xp for _, _, xp in shard_results for server_id, xp in xp.items()}
+    n_events = sum(result['events'] for _, result, _ in shard_results)
+    return {
+        'shards': args.shards,
+        'events': n_events,
+        'duration_s': duration,
+        'events_per_s': n_events / duration if duration else 0,
+        'shard_events_per_s': {n: result['events_per_s'] for n, result, _ in sorted(shard_results, key=lambda result: result[0])},
+        'errors': check_totals(path, cached_xp),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic traffic through stand-in shards sharing one writer process")
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--guilds', type=int, default=5, help="guilds per shard")
+    parser.add_argument('--members', type=int, default=1000, help="members per guild")
+    parser.add_argument('--events', type=int, default=20000, help="events per shard")
+    parser.add_argument('--message-rate', type=float, default=0.9)
+    parser.add_argument('--voice-churn', type=float, default=0.08)
+    parser.add_argument('--join-rate', type=float, default=0.02)
+    parser.add_argument('--cooldown', type=int, default=0)
+    parser.add_argument('--rest-latency', type=float, default=0)
+    parser.add_argument('--flush-every', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.tmpdir = tmpdir
+        result = run(args)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"{result['shards']} shards, {result['events']} events in {result['duration_s']:.2f} s: {result['events_per_s']:.0f} events/s")
+        for n, events_per_s in result['shard_events_per_s'].items():
+            print(f"  shard {n}: {events_per_s:.0f} events/s")
+        print('Stored XP matches the shards' if not result['errors'] else '\n'.join(['XP mismatch:', *result['errors']]))
+    if result['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
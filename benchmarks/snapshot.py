@@ -0,0 +1,110 @@
+"""Compares a cold start, which reads the users of every server from a database generated by benchmarks.dataset,
+with a warm start from a cache snapshot of the same servers.
+
+The snapshot is written from the cold cache, read back and checked against it before being timed.
+
+    python -m benchmarks.snapshot bench.db --repeat 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+import cache
+import data
+import snapshot
+
+
+def cold_load(db: data.Database) -> cache.CachedData:
+    # What on_ready does without a snapshot, minus the member reconciliation
+    cached = cache.CachedData()
+    for config in db.get_server_configs().values():
+        cached.add_server(config).load_users(db.get_users(config.id))
+    return cached
+
+def warm_load(db: data.Database, path: str) -> cache.CachedData:
+    # The configs are still read from the database
+    saved = snapshot.load(path)
+    cached = cache.CachedData()
+    for config in db.get_server_configs().values():
+        server = cached.add_server(config)
+        if config.id in saved.servers:
+            server.set_users(saved.servers[config.id].users, saved.servers[config.id].ranking)
+    return cached
+
+def check(expected: cache.CachedData, restored: cache.CachedData) -> list[str]:
+    errors = []
+    for server_id, server in expected.data.items():
+        users = {user_id: (user.xp, user.lastmsg_time, user.lastmsg_xp) for user_id, user in server.users.items()}
+        restored_users = {user_id: (user.xp, user.lastmsg_time, user.lastmsg_xp) for user_id, user in restored.data[server_id].users.items()}
+        if users != restored_users or server.ranking.top(10) != restored.data[server_id].ranking.top(10):
+            errors.append(f'{server_id}: the restored users differ')
+    return errors
+
+
+def timed(function, repeat: int) -> tuple[float, object]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, result
+
+
+def run(path: str, repeat: int) -> dict:
+    db = data.Database(path)
+    db.init()
+    cold_ms, cached = timed(lambda: cold_load(db), repeat)
+    # Voice sessions are part of the snapshot, a few are started so that they are written too
+    for server in list(cached.data.values())[:100]:
+        for user_id in list(server.users)[:5]:
+            server.start_voice_session(user_id)
+    dump_ms, payload = timed(lambda: snapshot.dump(cached, 1, time.time()), repeat)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        snapshot_path = os.path.join(tmpdir, 'cache.snap')
+        write_ms, _ = timed(lambda: snapshot.write(snapshot_path, payload), repeat)
+        read_ms, saved = timed(lambda: snapshot.load(snapshot_path), repeat)
+        warm_ms, restored = timed(lambda: warm_load(db, snapshot_path), repeat)
+    errors = check(cached, restored)
+    sessions = {(server.id, user_id): session.update_time for server in cached.data.values() for user_id, session in server.voice_sessions.items()}
+    if sessions != {(server_id, user_id): update_time for server_id, server in saved.servers.items() for user_id, update_time in server.voice_sessions.items()}:
+        errors.append('the restored voice sessions differ')
+    db.con.close()
+    return {
+        'servers': len(cached.data),
+        'users': sum(len(server.users) for server in cached.data.values()),
+        'snapshot_bytes': len(payload),
+        'cold_load_ms': cold_ms,
+        'dump_ms': dump_ms,
+        'write_ms': write_ms,
+        'read_ms': read_ms,
+        'warm_load_ms': warm_ms,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a cold start from the database against a warm start from a cache snapshot")
+    parser.add_argument('path', help="database generated by benchmarks.dataset")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    result = run(args.path, args.repeat)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"{result['servers']} servers, {result['users']} users, snapshot of {result['snapshot_bytes'] / 2**20:.1f} MiB")
+        print(f"cold load {result['cold_load_ms']:.0f} ms, warm load {result['warm_load_ms']:.0f} ms (snapshot read {result['read_ms']:.0f} ms)")
+        print(f"snapshot dump {result['dump_ms']:.0f} ms, write {result['write_ms']:.0f} ms")
+        print('Restored cache matches' if not result['errors'] else '\n'.join(result['errors']))
+    if result['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
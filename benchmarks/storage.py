@@ -0,0 +1,204 @@
+"""Times every public data.Database method against a database from benchmarks.dataset.
+
+The dataset is copied before the run so that writes do not alter it. Results are printed as JSON,
+methods without a benchmark case are listed under "missing".
+
+    python -m benchmarks.storage bench.db --repeat 50 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+
+import data
+
+SAMPLE_SIZE = 10000
+
+
+class SamplesExhausted(Exception):
+    pass
+
+
+class Samples():
+    # Random existing rows, picked before the timed calls
+    def __init__(self, db: data.Database, rng: random.Random):
+        self.rng = rng
+        db.cur.execute('SELECT id FROM servers')
+        self.servers = [server_id for (server_id,) in db.cur.fetchall()]
+        db.cur.execute('SELECT MAX(rowid) FROM users')
+        max_rowid = db.cur.fetchone()[0] or 0
+        rowids = [rng.randint(1, max_rowid) for _ in range(SAMPLE_SIZE)] if max_rowid else []
+        db.cur.execute(f"SELECT server_id, discord_id FROM users WHERE rowid IN ({','.join('?' * len(rowids))})", rowids)
+        self.users = db.cur.fetchall()
+        db.cur.execute('SELECT id, server_id FROM roles')
+        self.roles = db.cur.fetchall()
+        db.cur.execute('SELECT id, server_id FROM channels')
+        self.channels = db.cur.fetchall()
+        self.next_id = 1
+        self.today = datetime.date.today().toordinal()
+
+    def new_id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def pick(self, rows: list):
+        if not rows:
+            raise SamplesExhausted
+        return self.rng.choice(rows)
+
+    def server(self) -> int:
+        return self.pick(self.servers)
+
+    def user(self) -> tuple[int, int]:
+        return self.pick(self.users)
+
+    def take(self, rows: list) -> tuple:
+        # For the methods removing the row they are given
+        if not rows:
+            raise SamplesExhausted
+        return rows.pop(self.rng.randrange(len(rows)))
+
+    def take_server(self) -> int:
+        server_id = self.take(self.servers)
+        self.users = [user for user in self.users if user[0] != server_id]
+        return server_id
+
+
+def _user_update(s: Samples) -> tuple:
+    return (1, 1, 0, time.time(), 1, *s.user(), s.today)
+
+# Arguments of one call of each method
+CASES = {
+    'init': lambda s: (),
+    'get_servers': lambda s: (),
+    'add_server': lambda s: (s.new_id(), 'new'),
+    'rm_server': lambda s: (s.take_server(),),
+    'get_server_config': lambda s: (s.server(),),
+    'get_server_configs': lambda s: (),
+    'set_xp_rate_text': lambda s: (s.server(), 10, 30, 100, 0.9, 1),
+    'set_xp_rate_voice': lambda s: (s.server(), 2),
+    'set_mod_role': lambda s: (s.server(), s.new_id()),
+    'set_role': lambda s: (s.server(), s.new_id(), 100),
+    'rm_role': lambda s: (s.take(s.roles)[0],),
+    'add_channel': lambda s: (s.server(), s.new_id(), 0),
+    'rm_channel': lambda s: (s.take(s.channels)[0],),
+    'init_users': lambda s: (s.new_id(), [(f'new-{i}', i) for i in range(1000)]),
+    'add_users': lambda s: ([(f'new-{i}', i, s.server()) for i in range(1000)],),
+    'add_user': lambda s: (s.server(), s.new_id(), 'new'),
+    'rm_user': lambda s: s.take(s.users),
+    'get_user': lambda s: s.user(),
+    'get_users': lambda s: (s.server(),),
+    'get_user_xp': lambda s: s.user(),
+    'set_user_xp': lambda s: (*s.user(), 100),
+    'add_user_xp': lambda s: (*s.user(), 10),
+    'get_user_msg_count': lambda s: s.user(),
+    'set_user_msg_count': lambda s: (*s.user(), 100),
+    'add_user_msg_count': lambda s: (*s.user(), 1),
+    'get_user_voice_uptime': lambda s: s.user(),
+    'set_user_voice_uptime': lambda s: (*s.user(), 100),
+    'add_user_voice_uptime': lambda s: (*s.user(), 1),
+    'update_user': lambda s: (*s.user(), 100, 10, 10, time.time(), 1),
+    'update_users': lambda s: ([_user_update(s) for _ in range(1000)],),
+    'get_role_syncs': lambda s: (),
+    'set_role_sync': lambda s: (s.server(), s.new_id(), 0),
+    'rm_role_sync': lambda s: (s.server(),),
+    'get_voice_sessions': lambda s: (),
+    'get_period_leaderboard': lambda s: (s.server(), s.today - 7, 10),
+    'get_user_history': lambda s: (*s.user(), s.today - 30),
+    'get_global_leaderboard': lambda s: (10, s.rng.randrange(100)),
+    'set_global_leaderboard': lambda s: (s.server(), s.rng.random() < 0.5),
+    'get_snapshot_token': lambda s: ('data/cache.snap',),
+    'set_users_xp': lambda s: ([(100, time.time(), 10, *s.user()) for _ in range(1000)],),
+}
+
+
+def public_methods() -> list[str]:
+    # close would end the run, it is not timed
+    return [name for name, value in vars(data.Database).items() if callable(value) and not name.startswith('_') and name != 'close']
+
+
+def describe(db: data.Database, path: str) -> dict:
+    db.cur.execute('PRAGMA user_version')
+    user_version = db.cur.fetchone()[0]
+    db.cur.execute('SELECT COUNT(*) FROM users')
+    n_users = db.cur.fetchone()[0]
+    db.cur.execute('SELECT COUNT(*) FROM servers')
+    n_servers = db.cur.fetchone()[0]
+    db.cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL ORDER BY name")
+    indexes = [name for (name,) in db.cur.fetchall()]
+    return {'path': path, 'size_bytes': os.path.getsize(path), 'servers': n_servers, 'users': n_users,
+            'user_version': user_version, 'indexes': indexes}
+
+
+def measure(db: data.Database, name: str, samples: Samples, repeat: int) -> dict:
+    method = getattr(db, name)
+    timings = []
+    for _ in range(repeat):
+        try:
+            args = CASES[name](samples)
+        except SamplesExhausted:
+            # A method removing rows can run out of them before the end of the run
+            print(f"{name}: no rows left after {len(timings)} calls", file=sys.stderr)
+            break
+        start = time.perf_counter()
+        method(*args)
+        timings.append(time.perf_counter() - start)
+    if not timings:
+        return {'calls': 0}
+    quantiles = statistics.quantiles(timings, n=100) if len(timings) > 1 else timings * 99
+    return {
+        'calls': len(timings),
+        'mean_ms': statistics.fmean(timings) * 1000,
+        'p50_ms': quantiles[49] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'min_ms': min(timings) * 1000,
+        'max_ms': max(timings) * 1000,
+    }
+
+
+def run(path: str, repeat: int, methods: list[str] | None = None, seed: int = 0) -> dict:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        copy = os.path.join(tmpdir, 'bench.db')
+        shutil.copyfile(path, copy)
+        db = data.Database(copy)
+        db.init()
+        result = {'dataset': describe(db, path), 'repeat': repeat, 'methods': {}}
+        samples = Samples(db, random.Random(seed))
+
+        available = public_methods()
+        result['missing'] = [name for name in available if name not in CASES]
+        for name in methods or available:
+            if name in CASES:
+                result['methods'][name] = measure(db, name, samples, repeat)
+                if result['methods'][name]['calls']:
+                    print(f"{name}: {result['methods'][name]['mean_ms']:.3f} ms", file=sys.stderr)
+        db.con.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every public data.Database method")
+    parser.add_argument('path', help="database generated by benchmarks.dataset")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--method', action='append', dest='methods', help="only run this method, can be repeated")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    result = run(args.path, args.repeat, args.methods, args.seed)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
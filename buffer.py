@@ -0,0 +1,168 @@
+import asyncio
+import time
+import datetime
+
+import storage
+
+
+class UserDelta():
+    __slots__ = ('xp', 'msg_count', 'voice_uptime', 'lastmsg_time', 'lastmsg_xp')
+
+    def __init__(self):
+        self.xp: int = 0
+        self.msg_count: int = 0
+        self.voice_uptime: int = 0
+        self.lastmsg_time: float | None = None
+        self.lastmsg_xp: int | None = None
+
+    def merge(self, other: 'UserDelta') -> 'UserDelta':
+        self.xp += other.xp
+        self.msg_count += other.msg_count
+        self.voice_uptime += other.voice_uptime
+        if other.lastmsg_time is not None:
+            self.lastmsg_time = other.lastmsg_time
+            self.lastmsg_xp = other.lastmsg_xp
+        return self
+
+
+class XpBuffer():
+    """Gathers per-user deltas, joins and departures in memory and writes them to the database in one transaction."""
+
+    def __init__(self, db: storage.AsyncDatabase, max_rows: int = 1000, snapshot_name: str | None = None):
+        self.db = db
+        self.max_rows = max_rows
+        # Name of the cache snapshot of this process, each flush sets its token (see snapshot.py)
+        self.snapshot_name = snapshot_name
+        self.flushing: int = 0
+        # Set while no flush is in flight
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # Deltas are kept by day, so that activity flushed after midnight still goes to the user_daily row of its day
+        self.pending: dict[tuple[int, int, int], UserDelta] = {}
+        # A member joining then leaving before a flush only leaves a departure, and the other way around
+        self.joined: dict[tuple[int, int], str] = {}
+        self.departed: set[tuple[int, int]] = set()
+
+        self.flush_count: int = 0
+        self.flushed_rows: int = 0
+        self.last_flush_time: float = 0
+        self.total_flush_time: float = 0
+
+    @property
+    def pending_rows(self) -> int:
+        return len(self.pending) + len(self.joined) + len(self.departed)
+
+    def _get_delta(self, server_id: int, user_id: int) -> UserDelta:
+        key = (server_id, user_id, datetime.date.today().toordinal())
+        delta = self.pending.get(key)
+        if delta is None:
+            delta = self.pending[key] = UserDelta()
+        return delta
+
+    async def _check_size(self):
+        if self.pending_rows >= self.max_rows:
+            await self.flush()
+
+    async def add_message(self, server_id: int, user_id: int, xp: int = 0, lastmsg_time: float | None = None, lastmsg_xp: int | None = None):
+        delta = self._get_delta(server_id, user_id)
+        delta.msg_count += 1
+        delta.xp += xp
+        if lastmsg_time is not None:
+            delta.lastmsg_time = lastmsg_time
+            delta.lastmsg_xp = lastmsg_xp
+        await self._check_size()
+
+    async def add_voice(self, server_id: int, user_id: int, xp: int, n_min: int):
+        delta = self._get_delta(server_id, user_id)
+        delta.xp += xp
+        delta.voice_uptime += n_min
+        await self._check_size()
+
+    async def add_member(self, server_id: int, user_id: int, username: str):
+        key = (server_id, user_id)
+        self.departed.discard(key)
+        self.joined[key] = username
+        await self._check_size()
+
+    async def remove_member(self, server_id: int, user_id: int):
+        # The deltas of the member are dropped at the flush, in case they join again before it
+        key = (server_id, user_id)
+        self.joined.pop(key, None)
+        self.departed.add(key)
+        await self._check_size()
+
+    def is_departed(self, server_id: int, user_id: int) -> bool:
+        return (server_id, user_id) in self.departed
+
+    async def get_user(self, server_id: int, user_id: int) -> tuple | None:
+        # Same row as Database.get_user, with the pending deltas applied on top.
+        # The read is queued behind the flushes already submitted to the writer thread,
+        # so the deltas copied here are exactly the ones it cannot see yet.
+        delta = None
+        # The deltas of earlier days come first, the last message of the latest day wins
+        for key, pending_delta in self.pending.items():
+            if key[0] == server_id and key[1] == user_id:
+                delta = (delta or UserDelta()).merge(pending_delta)
+        username = self.joined.get((server_id, user_id))
+        user = await self.db.run_ordered('get_user', server_id, user_id)
+        if user is None and username is not None:
+            user = (username, 0, 0, 0, 0, 0)
+        if user is None or delta is None:
+            return user
+        username, xp, msg_count, voice_uptime, lastmsg_time, lastmsg_xp = user
+        if delta.lastmsg_time is not None:
+            lastmsg_time, lastmsg_xp = delta.lastmsg_time, delta.lastmsg_xp
+        return username, xp + delta.xp, msg_count + delta.msg_count, voice_uptime + delta.voice_uptime, lastmsg_time, lastmsg_xp
+
+    def discard(self, server_id: int, user_id: int | None = None):
+        if user_id is not None:
+            self.pending = {key: delta for key, delta in self.pending.items() if key[0] != server_id or key[1] != user_id}
+            self.joined.pop((server_id, user_id), None)
+            self.departed.discard((server_id, user_id))
+        else:
+            self.pending = {key: delta for key, delta in self.pending.items() if key[0] != server_id}
+            self.joined = {key: username for key, username in self.joined.items() if key[0] != server_id}
+            self.departed = {key for key in self.departed if key[0] != server_id}
+
+    async def flush(self, voice_sessions: list[tuple[int, int, float]] | None = None, voice_servers: list[int] | None = None,
+                    snapshot_token: int | None = None) -> int:
+        # voice_sessions are saved along with the deltas, see Database.update_users.
+        # Any flush without the token of a new snapshot invalidates the last one
+        if not self.pending_rows and voice_sessions is None:
+            return 0
+        pending, self.pending = self.pending, {}
+        joined, self.joined = self.joined, {}
+        departed, self.departed = self.departed, set()
+        rows = [(delta.xp, delta.msg_count, delta.voice_uptime, delta.lastmsg_time, delta.lastmsg_xp, server_id, user_id, day)
+                for (server_id, user_id, day), delta in pending.items() if (server_id, user_id) not in departed]
+        new_users = [(username, user_id, server_id) for (server_id, user_id), username in joined.items()]
+
+        start = time.perf_counter()
+        self.flushing += 1
+        self.idle.clear()
+        try:
+            await self.db.update_users(rows, voice_sessions, new_users=new_users, departed_users=list(departed), voice_servers=voice_servers,
+                                       snapshot=(self.snapshot_name, snapshot_token) if self.snapshot_name else None)
+        except Exception:
+            # Put the deltas back so that they are retried on the next flush,
+            # deltas, joins and departures added while the write was in flight are more recent
+            for key, delta in self.pending.items():
+                if key in pending:
+                    pending[key].merge(delta)
+                else:
+                    pending[key] = delta
+            self.pending = pending
+            for key, username in joined.items():
+                if key not in self.departed:
+                    self.joined.setdefault(key, username)
+            self.departed |= {key for key in departed if key not in self.joined}
+            raise
+        finally:
+            self.flushing -= 1
+            if not self.flushing:
+                self.idle.set()
+        self.last_flush_time = time.perf_counter() - start
+        self.total_flush_time += self.last_flush_time
+        self.flush_count += 1
+        self.flushed_rows += len(rows)
+        return len(rows)
@@ -1,19 +1,66 @@
 import time
-import discord
-from typing import Self
+import bisect
+from collections import OrderedDict
+from discord.enums import ChannelType
+from sortedcontainers import SortedList
 
+import metrics
 
-class VoiceUpdate():
-    def __init__(self, member: discord.Member, voice_state: discord.VoiceState):
-        self.update_time = time.time()
-        self.is_connected = voice_state.channel is not None
-        self.user_id = member.id
-    
-    def uptime(self, new_update: Self) -> int:
-        return new_update.update_time // 60 - self.update_time // 60
+
+class VoiceSession():
+    # Only members connected to a tracked voice channel have a session
+    __slots__ = ('user_id', 'update_time')
+
+    def __init__(self, user_id: int, update_time: float | None = None):
+        self.user_id: int = user_id
+        # Time up to which the session has been credited
+        self.update_time: float = update_time or time.time()
+
+
+# Keys of ServerConfig.channels for each tracked channel type
+CHANNEL_KINDS = {ChannelType.text.value: 'text', ChannelType.voice.value: 'voice'}
+
+
+class UserActivity():
+    __slots__ = ('xp', 'lastmsg_time', 'lastmsg_xp')
+
+    def __init__(self, xp: int = 0, lastmsg_time: float = 0, lastmsg_xp: int = 0):
+        self.xp: int = xp
+        self.lastmsg_time: float = lastmsg_time
+        self.lastmsg_xp: int = lastmsg_xp
+
+
+class Ranking():
+    # Members ordered by decreasing XP, ties are broken by member id
+    def __init__(self, users: dict[int:UserActivity], entries: list[tuple[int, int]] | None = None):
+        # entries (-xp, user_id) may be given instead when they are already known, as in a cache snapshot
+        self.entries = SortedList(entries if entries is not None else ((-user.xp, user_id) for user_id, user in users.items()))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, user_id: int, xp: int):
+        self.entries.add((-xp, user_id))
+
+    def remove(self, user_id: int, xp: int):
+        self.entries.discard((-xp, user_id))
+
+    def update(self, user_id: int, old_xp: int, new_xp: int):
+        if old_xp != new_xp:
+            self.entries.remove((-old_xp, user_id))
+            self.entries.add((-new_xp, user_id))
+
+    def rank(self, user_id: int, xp: int) -> int:
+        return self.entries.index((-xp, user_id)) + 1
+
+    def top(self, n_users: int, offset: int = 0) -> list[tuple[int, int]]:
+        return [(user_id, -xp) for xp, user_id in self.entries.islice(offset, offset + n_users)]
 
 
 class ServerConfig():
+    __slots__ = ('id', 'name', 'rate_txt', 'rate_voice', 'mod_role', 'msg_cooldown', 'msg_rankthr', 'msg_xpfactor', 'msg_xpmin',
+                 'global_leaderboard', 'roles', 'channels', 'role_thresholds', 'role_ids', 'text_channels', 'voice_channels')
+
     def __init__(self,
                  server_id: int,
                  name: str,
@@ -24,7 +71,8 @@ class ServerConfig():
                  msg_rankthr: int,
                  msg_xpfactor: float,
                  msg_xpmin: int,
-                 roles: dict[int:int],
+                 global_leaderboard: bool,
+                 roles: list[tuple[int, int]],
                  channels: dict):
         self.id: int = server_id
         self.name: str = name
@@ -35,42 +83,156 @@ class ServerConfig():
         self.msg_rankthr: int = msg_rankthr
         self.msg_xpfactor: float = msg_xpfactor
         self.msg_xpmin: int = msg_xpmin
+        self.global_leaderboard: bool = bool(global_leaderboard)
         self.roles: list[tuple[int, int]] = roles
         self.channels: dict = channels
-    
+        self._update_roles()
+        self._update_channels()
+
+    def _update_roles(self):
+        self.roles.sort(key=lambda role: role[1])
+        self.role_thresholds: list[int] = [xp_threshold for _, xp_threshold in self.roles]
+        self.role_ids: frozenset[int] = frozenset(role_id for role_id, _ in self.roles)
+
+    def _update_channels(self):
+        self.text_channels: frozenset[int] = frozenset(self.channels['text'])
+        self.voice_channels: frozenset[int] = frozenset(self.channels['voice'])
+
+    def get_role(self, xp: int) -> int | None:
+        n_role = bisect.bisect_right(self.role_thresholds, xp)
+        return self.roles[n_role-1][0] if n_role > 0 else None
+
+    # The setters below mirror the Database methods of the same name
+
+    def set_role(self, role_id: int, xp_threshold: int):
+        self.roles = [role for role in self.roles if role[0] != role_id] + [(role_id, xp_threshold)]
+        self._update_roles()
+
+    def rm_role(self, role_id: int):
+        self.roles = [role for role in self.roles if role[0] != role_id]
+        self._update_roles()
+
+    def add_channel(self, channel_id: int, channel_type: int):
+        kind = CHANNEL_KINDS.get(channel_type)
+        if kind is not None and channel_id not in self.channels[kind]:
+            self.channels[kind].append(channel_id)
+            self._update_channels()
+
+    def rm_channel(self, channel_id: int):
+        for channels in self.channels.values():
+            if channel_id in channels:
+                channels.remove(channel_id)
+        self._update_channels()
+
+    def set_xp_rate_text(self, xp_rate: int, msg_cooldown: int, msg_rankthr: int, msg_xpfactor: float, msg_xpmin: int):
+        self.rate_txt = xp_rate
+        self.msg_cooldown = msg_cooldown
+        self.msg_rankthr = msg_rankthr
+        self.msg_xpfactor = msg_xpfactor
+        self.msg_xpmin = msg_xpmin
+
+    def set_xp_rate_voice(self, xp_rate: int):
+        self.rate_voice = xp_rate
+
+    def set_mod_role(self, role_id: int):
+        self.mod_role = role_id
+
+    def set_global_leaderboard(self, enabled: bool):
+        self.global_leaderboard = enabled
+
     def __str__(self):
         nl = '\n'
-        return f"ServerConfig(\n   {f',{nl}   '.join([f'{k}: {v}' for k, v in self.__dict__.items()])}\n)"
+        return f"ServerConfig(\n   {f',{nl}   '.join([f'{k}: {getattr(self, k)}' for k in self.__slots__])}\n)"
 
 class CachedServer():
     def __init__(self, config: ServerConfig):
         self.id: int = config.id
         self.config: ServerConfig = config
-        self.voice_updates: dict[int:VoiceUpdate] = {}
+        self.voice_sessions: dict[int:VoiceSession] = {}
+        self.users: dict[int:UserActivity] = {}
+        self.ranking: Ranking = Ranking(self.users)
 
-    def update_config(self, config: ServerConfig):
-        self.config = config
+    def load_users(self, users: list[tuple]):
+        # users are rows from Database.get_users
+        self.set_users({discord_id: UserActivity(xp, lastmsg_time, lastmsg_xp)
+                        for _, discord_id, xp, _, _, lastmsg_time, lastmsg_xp in users})
 
-    def get_voice_update(self, user_id: int) -> VoiceUpdate:
-        return self.voice_updates.get(user_id, None)
-    
-    def add_voice_update(self, member: discord.Member, voice_state: discord.VoiceState):
-        update = VoiceUpdate(member, voice_state)
-        self.voice_updates[member.id] = update
+    def set_users(self, users: dict[int:UserActivity], ranking: Ranking | None = None):
+        self.users = users
+        self.ranking = ranking if ranking is not None else Ranking(self.users)
+
+    def get_user(self, user_id: int) -> UserActivity:
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = UserActivity()
+            self.ranking.add(user_id, user.xp)
+        return user
+
+    def rm_user(self, user_id: int) -> UserActivity | None:
+        user = self.users.pop(user_id, None)
+        if user is not None:
+            self.ranking.remove(user_id, user.xp)
+        self.voice_sessions.pop(user_id, None)
+        return user
+
+    def set_user_xp(self, user_id: int, xp: int) -> int:
+        # XP must only be changed through here so that the ranking stays in sync
+        user = self.get_user(user_id)
+        self.ranking.update(user_id, user.xp, xp)
+        user.xp = xp
+        return xp
+
+    def add_user_xp(self, user_id: int, xp: int) -> int:
+        return self.set_user_xp(user_id, self.get_user(user_id).xp + xp)
+
+    def get_rank(self, user_id: int) -> int | None:
+        # Unlike get_user, an unknown user is not added
+        user = self.users.get(user_id)
+        return self.ranking.rank(user_id, user.xp) if user is not None else None
+
+    def get_voice_session(self, user_id: int) -> VoiceSession | None:
+        return self.voice_sessions.get(user_id, None)
+
+    def start_voice_session(self, user_id: int, update_time: float | None = None) -> VoiceSession:
+        session = self.voice_sessions[user_id] = VoiceSession(user_id, update_time)
+        return session
+
+    def end_voice_session(self, user_id: int) -> VoiceSession | None:
+        return self.voice_sessions.pop(user_id, None)
+
+    def is_idle(self) -> bool:
+        # Ongoing voice sessions would be lost if the server was unloaded
+        return not self.voice_sessions
 
 
 class CachedData():
-    def __init__(self):
-        self.data: dict[int:CachedServer] = {}
+    def __init__(self, max_size: int | None = None):
+        # Servers by least recent use, only idle servers are evicted past max_size
+        self.data: OrderedDict[int:CachedServer] = OrderedDict()
+        self.max_size = max_size
     
     def get_server(self, server_id: int) -> CachedServer:
-        return self.data.get(server_id, None)
+        server = self.data.get(server_id, None)
+        metrics.CACHE_LOOKUPS.inc(result='hit' if server else 'miss')
+        if server is not None and self.max_size is not None:
+            self.data.move_to_end(server_id)
+        return server
     
-    def add_server(self, config: ServerConfig):
-        self.data[config.id] = CachedServer(config)
+    def add_server(self, config: ServerConfig) -> CachedServer:
+        server = self.data[config.id] = CachedServer(config)
+        return server
 
     def rm_server(self, server_id: int):
-        del self.data[server_id]
-    
-    def update_server_config(self, config: ServerConfig):
-        self.data[config.id].update_config(config)
+        self.data.pop(server_id, None)
+
+    def evict(self, keep: int | None = None) -> list[CachedServer]:
+        # keep is a server just loaded, it would be the first idle one when the older servers are busy
+        evicted = []
+        if self.max_size is None:
+            return evicted
+        for server_id in list(self.data):
+            if len(self.data) <= self.max_size:
+                break
+            if server_id != keep and self.data[server_id].is_idle():
+                evicted.append(self.data.pop(server_id))
+        return evicted
@@ -0,0 +1,84 @@
+"""Runs the bot as several processes sharing the gateway shards, with writer.py as the only database user.
+
+Each process runs main.py with its own SHARD_IDS, journal folder, cache snapshot and metrics port (METRICS_PORT + n).
+The writer unpickles what it receives, so its socket always requires a key: STORAGE_AUTHKEY, or a random one
+generated for the run and given to the writer and to every bot process.
+Stopping the cluster stops the bot processes first, then the writer once their last flush is written.
+
+    python cluster.py --processes 4 --shards 8
+"""
+import os
+import sys
+import time
+import signal
+import secrets
+import argparse
+import subprocess
+
+import writer
+import snapshot
+
+STARTUP_TIMEOUT = 30
+
+
+def shard_env(n: int, n_processes: int, n_shards: int, address: str, authkey: str) -> dict[str:str]:
+    env = dict(os.environ)
+    env['SHARD_COUNT'] = str(n_shards)
+    env['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in range(n, n_shards, n_processes))
+    env['STORAGE_ADDRESS'] = address
+    env['STORAGE_AUTHKEY'] = authkey
+    # Journal segments are numbered per process
+    env['JOURNAL_DIR'] = os.path.join(os.environ.get('JOURNAL_DIR', 'data/journal'), f'process-{n}')
+    # Each process snapshots the servers of its own shards
+    cache_snapshot = os.environ.get('CACHE_SNAPSHOT', snapshot.SNAPSHOT_PATH)
+    if cache_snapshot:
+        root, ext = os.path.splitext(cache_snapshot)
+        env['CACHE_SNAPSHOT'] = f'{root}-{n}{ext}'
+    if int(os.environ.get('METRICS_PORT', 0)):
+        env['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + n)
+    return env
+
+def wait_for_socket(address: str, process: subprocess.Popen):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not os.path.exists(address):
+        if process.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError('The writer process did not start')
+        time.sleep(0.1)
+
+def stop(processes: list[subprocess.Popen]):
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+    for process in processes:
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as several sharded processes and one storage writer")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--shards', type=int, help="total number of shards, one per process by default")
+    parser.add_argument('--address', default=os.environ.get('STORAGE_ADDRESS', writer.ADDRESS))
+    parser.add_argument('--bot', default='main.py', help="script run by each bot process")
+    args = parser.parse_args()
+    n_shards = args.shards or args.processes
+
+    # Hex so that the key can be passed in the environment, it is encoded back to bytes by writer.py and main.py
+    authkey = os.environ.get('STORAGE_AUTHKEY') or secrets.token_bytes(32).hex()
+    storage_process = subprocess.Popen([sys.executable, 'writer.py', '--address', args.address], env={**os.environ, 'STORAGE_AUTHKEY': authkey})
+    wait_for_socket(args.address, storage_process)
+    bots = [subprocess.Popen([sys.executable, args.bot], env=shard_env(n, args.processes, n_shards, args.address, authkey))
+            for n in range(min(args.processes, n_shards))]
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while all(process.poll() is None for process in bots + [storage_process]):
+            time.sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        stop(bots)
+        storage_process.terminate()
+        storage_process.wait()
+
+
+if __name__ == '__main__':
+    main()
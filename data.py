@@ -1,13 +1,244 @@
+import os
+import abc
 import sqlite3
 from discord.enums import ChannelType
 
 import cache
 
-DB_PATH = 'data/data.db'
+DB_PATH = os.environ.get('DB_PATH', 'data/data.db')
+
+
+# ================================
+# Migrations
+# ================================
+# Each step brings the schema from version n to n+1, the version is stored in the user_version pragma.
+# Steps run in their own transaction, new steps must only be appended to MIGRATIONS.
+
+def _column_count(cur: sqlite3.Cursor, table: str) -> int:
+    cur.execute(f'PRAGMA table_info({table})')
+    return len(cur.fetchall())
+
+def _create_tables(cur: sqlite3.Cursor) -> None:
+    cur.execute('CREATE TABLE IF NOT EXISTS servers (id INTEGER PRIMARY KEY, name TEXT, xprate_msg INTEGER DEFAULT 1, xprate_voice INTEGER DEFAULT 1, mod_role INTEGER DEFAULT 0, msg_cooldown INTEGER DEFAULT 0, msg_rankthreshold INTEGER DEFAULT -1, msg_xpfactor REAL DEFAULT 1, msg_xpmin INTEGER DEFAULT 1)')
+    cur.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, username TEXT, discord_id INTEGER, server_id INTEGER, xp INTEGER DEFAULT 0, msg_count INTEGER DEFAULT 0, voice_uptime INTEGER DEFAULT 0, lastmsg_time INTEGER DEFAULT 0, lastmsg_xp INTEGER DEFAULT 0)')
+    cur.execute('CREATE TABLE IF NOT EXISTS roles (id INTEGER PRIMARY KEY, xp_threshold INTEGER, server_id INTEGER)')
+    cur.execute('CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY, type INTEGER, server_id INTEGER)')
+
+    # Databases created before versioning was introduced are upgraded according to their column count
+    nb_columns = _column_count(cur, 'servers')
+    if nb_columns == 5:
+        cur.execute('ALTER TABLE servers ADD COLUMN msg_cooldown INTEGER DEFAULT 0')
+        cur.execute('ALTER TABLE servers ADD COLUMN msg_rankthreshold INTEGER DEFAULT -1')
+        cur.execute('ALTER TABLE servers ADD COLUMN msg_xpfactor REAL DEFAULT 1')
+        cur.execute('ALTER TABLE servers ADD COLUMN msg_xpmin INTEGER DEFAULT 1')
+    elif nb_columns != 9:
+        raise Exception('Database schema is unknown')
+
+    nb_columns = _column_count(cur, 'users')
+    if nb_columns == 7:
+        cur.execute('ALTER TABLE users ADD COLUMN lastmsg_time INTEGER DEFAULT 0')
+        cur.execute('ALTER TABLE users ADD COLUMN lastmsg_xp INTEGER DEFAULT 0')
+    elif nb_columns != 9:
+        raise Exception('Database schema is unknown')
+
+def _create_indexes(cur: sqlite3.Cursor) -> None:
+    # Duplicated users would break the unique index, only the row with the most XP is kept
+    cur.execute('DELETE FROM users WHERE id NOT IN (SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY server_id, discord_id ORDER BY xp DESC, id) AS n FROM users) WHERE n = 1)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS users_server_discord ON users (server_id, discord_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS users_server_xp ON users (server_id, xp DESC)')
+    cur.execute('CREATE INDEX IF NOT EXISTS roles_server ON roles (server_id, xp_threshold)')
+    cur.execute('CREATE INDEX IF NOT EXISTS channels_server ON channels (server_id, type)')
+
+def _create_role_syncs(cur: sqlite3.Cursor) -> None:
+    cur.execute('CREATE TABLE IF NOT EXISTS role_syncs (server_id INTEGER PRIMARY KEY, channel_id INTEGER, cursor INTEGER DEFAULT 0)')
+
+def _create_voice_sessions(cur: sqlite3.Cursor) -> None:
+    cur.execute('CREATE TABLE IF NOT EXISTS voice_sessions (server_id INTEGER, discord_id INTEGER, update_time REAL, PRIMARY KEY (server_id, discord_id))')
+
+def _create_user_daily(cur: sqlite3.Cursor) -> None:
+    # Activity per user and per day (date ordinal, local time), the index covers the leaderboards of a period
+    cur.execute('CREATE TABLE IF NOT EXISTS user_daily (server_id INTEGER, discord_id INTEGER, day INTEGER, xp INTEGER DEFAULT 0, msg_count INTEGER DEFAULT 0, voice_uptime INTEGER DEFAULT 0, PRIMARY KEY (server_id, discord_id, day)) WITHOUT ROWID')
+    cur.execute('CREATE INDEX IF NOT EXISTS user_daily_server_day ON user_daily (server_id, day, discord_id, xp)')
+
+def _create_global_users(cur: sqlite3.Cursor) -> None:
+    # Totals of each Discord user over every server, kept up to date by triggers on users so that every write path
+    # (buffer flushes, departures, server removals, imports, recomputes) maintains them, the index covers the global top
+    cur.execute('CREATE TABLE IF NOT EXISTS global_users (discord_id INTEGER PRIMARY KEY, xp INTEGER DEFAULT 0, msg_count INTEGER DEFAULT 0, voice_uptime INTEGER DEFAULT 0, n_servers INTEGER DEFAULT 0)')
+    cur.execute('CREATE INDEX IF NOT EXISTS global_users_xp ON global_users (xp DESC, discord_id)')
+    cur.execute('DELETE FROM global_users')
+    cur.execute('INSERT INTO global_users (discord_id, xp, msg_count, voice_uptime, n_servers) '
+                'SELECT discord_id, COALESCE(SUM(xp), 0), COALESCE(SUM(msg_count), 0), COALESCE(SUM(voice_uptime), 0), COUNT(*) FROM users GROUP BY discord_id')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS users_global_insert AFTER INSERT ON users BEGIN
+        INSERT INTO global_users (discord_id, xp, msg_count, voice_uptime, n_servers) VALUES (NEW.discord_id, COALESCE(NEW.xp, 0), COALESCE(NEW.msg_count, 0), COALESCE(NEW.voice_uptime, 0), 1)
+        ON CONFLICT (discord_id) DO UPDATE SET xp = xp + excluded.xp, msg_count = msg_count + excluded.msg_count, voice_uptime = voice_uptime + excluded.voice_uptime, n_servers = n_servers + 1;
+    END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS users_global_update AFTER UPDATE OF xp, msg_count, voice_uptime ON users BEGIN
+        UPDATE global_users SET xp = xp + COALESCE(NEW.xp, 0) - COALESCE(OLD.xp, 0), msg_count = msg_count + COALESCE(NEW.msg_count, 0) - COALESCE(OLD.msg_count, 0),
+            voice_uptime = voice_uptime + COALESCE(NEW.voice_uptime, 0) - COALESCE(OLD.voice_uptime, 0) WHERE discord_id = NEW.discord_id;
+    END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS users_global_delete AFTER DELETE ON users BEGIN
+        UPDATE global_users SET xp = xp - COALESCE(OLD.xp, 0), msg_count = msg_count - COALESCE(OLD.msg_count, 0),
+            voice_uptime = voice_uptime - COALESCE(OLD.voice_uptime, 0), n_servers = n_servers - 1 WHERE discord_id = OLD.discord_id;
+        DELETE FROM global_users WHERE discord_id = OLD.discord_id AND n_servers <= 0;
+    END''')
+
+def _create_cache_snapshots(cur: sqlite3.Cursor) -> None:
+    # Token of the last cache snapshot of each bot process (see snapshot.py), cleared by the writes to the users
+    cur.execute('CREATE TABLE IF NOT EXISTS cache_snapshots (name TEXT PRIMARY KEY, token INTEGER)')
+
+def _add_global_leaderboard_opt_in(cur: sqlite3.Cursor) -> None:
+    # Only the servers that opted in count in global_users, none at first. The triggers skip the other servers
+    cur.execute('ALTER TABLE servers ADD COLUMN global_leaderboard INTEGER DEFAULT 0')
+    cur.execute('DELETE FROM global_users')
+    for trigger in ('users_global_insert', 'users_global_update', 'users_global_delete'):
+        cur.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    cur.execute('''CREATE TRIGGER users_global_insert AFTER INSERT ON users
+        WHEN EXISTS (SELECT 1 FROM servers WHERE id = NEW.server_id AND global_leaderboard) BEGIN
+        INSERT INTO global_users (discord_id, xp, msg_count, voice_uptime, n_servers) VALUES (NEW.discord_id, COALESCE(NEW.xp, 0), COALESCE(NEW.msg_count, 0), COALESCE(NEW.voice_uptime, 0), 1)
+        ON CONFLICT (discord_id) DO UPDATE SET xp = xp + excluded.xp, msg_count = msg_count + excluded.msg_count, voice_uptime = voice_uptime + excluded.voice_uptime, n_servers = n_servers + 1;
+    END''')
+    cur.execute('''CREATE TRIGGER users_global_update AFTER UPDATE OF xp, msg_count, voice_uptime ON users
+        WHEN EXISTS (SELECT 1 FROM servers WHERE id = NEW.server_id AND global_leaderboard) BEGIN
+        UPDATE global_users SET xp = xp + COALESCE(NEW.xp, 0) - COALESCE(OLD.xp, 0), msg_count = msg_count + COALESCE(NEW.msg_count, 0) - COALESCE(OLD.msg_count, 0),
+            voice_uptime = voice_uptime + COALESCE(NEW.voice_uptime, 0) - COALESCE(OLD.voice_uptime, 0) WHERE discord_id = NEW.discord_id;
+    END''')
+    cur.execute('''CREATE TRIGGER users_global_delete AFTER DELETE ON users
+        WHEN EXISTS (SELECT 1 FROM servers WHERE id = OLD.server_id AND global_leaderboard) BEGIN
+        UPDATE global_users SET xp = xp - COALESCE(OLD.xp, 0), msg_count = msg_count - COALESCE(OLD.msg_count, 0),
+            voice_uptime = voice_uptime - COALESCE(OLD.voice_uptime, 0), n_servers = n_servers - 1 WHERE discord_id = OLD.discord_id;
+        DELETE FROM global_users WHERE discord_id = OLD.discord_id AND n_servers <= 0;
+    END''')
+
+MIGRATIONS = [
+    _create_tables,
+    _create_indexes,
+    _create_role_syncs,
+    _create_voice_sessions,
+    _create_user_daily,
+    _create_global_users,
+    _create_cache_snapshots,
+    _add_global_leaderboard_opt_in,
+]
+
+
+# ================================
+# Storage interface
+# ================================
+
+class Storage(abc.ABC):
+    """Methods used by the bot, implemented by each storage engine (see storage.ENGINES).
+
+    Engines are run by storage.AsyncDatabase: a thread_safe engine is shared by its threads,
+    otherwise each thread opens its own instance on the same path.
+    benchmarks.conformance checks that every engine gives the same results on the same workload.
+    """
+    thread_safe = False
+
+    @abc.abstractmethod
+    def init(self) -> None: ...
+
+    @abc.abstractmethod
+    def close(self) -> None: ...
+
+    @abc.abstractmethod
+    def add_server(self, server_id: int, server_name: str) -> None: ...
+
+    @abc.abstractmethod
+    def rm_server(self, server_id: int) -> None: ...
+
+    @abc.abstractmethod
+    def get_servers(self) -> list[int]: ...
+
+    @abc.abstractmethod
+    def init_users(self, server_id: int, users: list[tuple[str, int]]) -> None: ...
+
+    @abc.abstractmethod
+    def add_users(self, users: list[tuple[str, int, int]]) -> None: ...
+
+    @abc.abstractmethod
+    def rm_user(self, server_id: int, user_id: int) -> None: ...
+
+    @abc.abstractmethod
+    def set_role(self, server_id: int, role_id: int, xp_threshold: int) -> None: ...
+
+    @abc.abstractmethod
+    def rm_role(self, role_id: int) -> None: ...
+
+    @abc.abstractmethod
+    def add_channel(self, server_id: int, channel_id: int, channel_type: int) -> None: ...
+
+    @abc.abstractmethod
+    def rm_channel(self, channel_id: int) -> None: ...
 
-class Database:
-    def __init__(self):
-        self.con = sqlite3.connect(DB_PATH)
+    @abc.abstractmethod
+    def get_role_syncs(self) -> list[tuple[int, int, int]]: ...
+
+    @abc.abstractmethod
+    def set_role_sync(self, server_id: int, channel_id: int, cursor: int) -> None: ...
+
+    @abc.abstractmethod
+    def rm_role_sync(self, server_id: int) -> None: ...
+
+    @abc.abstractmethod
+    def get_server_config(self, server_id: int) -> cache.ServerConfig | None: ...
+
+    @abc.abstractmethod
+    def get_server_configs(self) -> dict[int:cache.ServerConfig]: ...
+
+    @abc.abstractmethod
+    def set_xp_rate_text(self, server_id: int, xp_rate: int, msg_cooldown: int, msg_rankthr: int, msg_xpfactor: float, msg_xpmin: int) -> None: ...
+
+    @abc.abstractmethod
+    def set_xp_rate_voice(self, server_id: int, xp_rate: int) -> None: ...
+
+    @abc.abstractmethod
+    def set_mod_role(self, server_id: int, role_id: int) -> None: ...
+
+    @abc.abstractmethod
+    def set_global_leaderboard(self, server_id: int, enabled: bool) -> None: ...
+
+    @abc.abstractmethod
+    def set_user_xp(self, server_id: int, user_id: int, xp: int) -> None: ...
+
+    @abc.abstractmethod
+    def get_user(self, server_id: int, user_id: int) -> tuple | None: ...
+
+    @abc.abstractmethod
+    def get_users(self, server_id: int, n_users: int = None) -> list[tuple]: ...
+
+    @abc.abstractmethod
+    def update_users(self, rows: list[tuple], voice_sessions: list[tuple[int, int, float]] | None = None,
+                     new_users: list[tuple[str, int, int]] = (), departed_users: list[tuple[int, int]] = (),
+                     voice_servers: list[int] | None = None, snapshot: tuple[str, int | None] | None = None) -> None: ...
+
+    @abc.abstractmethod
+    def set_users_xp(self, rows: list[tuple[int, float, int, int, int]]) -> None: ...
+
+    @abc.abstractmethod
+    def get_period_leaderboard(self, server_id: int, since_day: int, n_users: int, offset: int = 0) -> tuple[int, list[tuple[int, int]]]: ...
+
+    @abc.abstractmethod
+    def get_user_history(self, server_id: int, user_id: int, since_day: int) -> list[tuple[int, int, int, int]]: ...
+
+    @abc.abstractmethod
+    def get_global_leaderboard(self, n_users: int, offset: int = 0) -> list[tuple[int, int]]: ...
+
+    @abc.abstractmethod
+    def get_voice_sessions(self) -> dict[tuple[int, int]:float]: ...
+
+    @abc.abstractmethod
+    def get_snapshot_token(self, name: str) -> int | None: ...
+
+
+# ================================
+# Database
+# ================================
+
+class Database(Storage):
+    """SQLite engine, one connection per instance."""
+
+    def __init__(self, path: str = DB_PATH):
+        self.con = sqlite3.connect(path)
         self.cur = self.con.cursor()
 
     
@@ -15,34 +246,28 @@ class Database:
         self.con.close()
 
 
+    def close(self) -> None:
+        self.con.close()
+
+
     def init(self) -> None: 
-        self.cur.execute('CREATE TABLE IF NOT EXISTS servers (id INTEGER PRIMARY KEY, name TEXT, xprate_msg INTEGER DEFAULT 1, xprate_voice INTEGER DEFAULT 1, mod_role INTEGER DEFAULT 0, msg_cooldown INTEGER DEFAULT 0, msg_rankthreshold INTEGER DEFAULT -1, msg_xpfactor REAL DEFAULT 1, msg_xpmin INTEGER DEFAULT 1)')
-        self.cur.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, username TEXT, discord_id INTEGER, server_id INTEGER, xp INTEGER DEFAULT 0, msg_count INTEGER DEFAULT 0, voice_uptime INTEGER DEFAULT 0, lastmsg_time INTEGER DEFAULT 0, lastmsg_xp INTEGER DEFAULT 0)') 
-        self.cur.execute('CREATE TABLE IF NOT EXISTS roles (id INTEGER PRIMARY KEY, xp_threshold INTEGER, server_id INTEGER)')
-        self.cur.execute('CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY, type INTEGER, server_id INTEGER)')
-        self.con.commit()
-        
-        self.cur.execute('PRAGMA table_info(servers)')
-        nb_columns = len(self.cur.fetchall())
-        if nb_columns == 5:
-            self.cur.execute('ALTER TABLE servers ADD COLUMN msg_cooldown INTEGER DEFAULT 0')
-            self.cur.execute('ALTER TABLE servers ADD COLUMN msg_rankthreshold INTEGER DEFAULT -1')
-            self.cur.execute('ALTER TABLE servers ADD COLUMN msg_xpfactor REAL DEFAULT 1')
-            self.cur.execute('ALTER TABLE servers ADD COLUMN msg_xpmin INTEGER DEFAULT 1')
-            self.con.commit()
-        elif nb_columns != 9:
+        # WAL lets the reader connections of storage.AsyncDatabase run alongside the writer
+        self.cur.execute('PRAGMA journal_mode=WAL')
+        self.cur.execute('PRAGMA user_version')
+        version = self.cur.fetchone()[0]
+        if version > len(MIGRATIONS):
             self.con.close()
             raise Exception('Database schema is unknown')
 
-        self.cur.execute('PRAGMA table_info(users)')
-        nb_columns = len(self.cur.fetchall())
-        if nb_columns == 7:
-            self.cur.execute('ALTER TABLE users ADD COLUMN lastmsg_time INTEGER DEFAULT 0')
-            self.cur.execute('ALTER TABLE users ADD COLUMN lastmsg_xp INTEGER DEFAULT 0')
-            self.con.commit()
-        elif nb_columns != 9:
-            self.con.close()
-            raise Exception('Database schema is unknown')
+        for n, migration in enumerate(MIGRATIONS[version:], start=version+1):
+            self.cur.execute('BEGIN')
+            try:
+                migration(self.cur)
+                self.cur.execute(f'PRAGMA user_version = {n}')
+                self.con.commit()
+            except Exception:
+                self.con.rollback()
+                raise
 
 
     def add_server(self, server_id: int, server_name: str) -> None:
@@ -51,10 +276,14 @@ class Database:
 
 
     def rm_server(self, server_id: int) -> None:
-        self.cur.execute('DELETE FROM servers WHERE id = ?', (server_id,))
+        # The users go first, the trigger keeping global_users up to date reads the opt-in of their server
         self.cur.execute('DELETE FROM users WHERE server_id = ?', (server_id,))
+        self.cur.execute('DELETE FROM servers WHERE id = ?', (server_id,))
         self.cur.execute('DELETE FROM roles WHERE server_id = ?', (server_id,))
         self.cur.execute('DELETE FROM channels WHERE server_id = ?', (server_id,))
+        self.cur.execute('DELETE FROM role_syncs WHERE server_id = ?', (server_id,))
+        self.cur.execute('DELETE FROM voice_sessions WHERE server_id = ?', (server_id,))
+        self.cur.execute('DELETE FROM user_daily WHERE server_id = ?', (server_id,))
         self.con.commit()
 
     def get_servers(self) -> list[int]:
@@ -63,17 +292,26 @@ class Database:
 
 
     def init_users(self, server_id: int, users: list[tuple[str, int]]) -> None:
-        self.cur.executemany('INSERT INTO users(username, discord_id, server_id) VALUES (?, ?, ?)', [(username, discord_id, server_id) for (username, discord_id) in users])
+        self.cur.executemany('INSERT OR IGNORE INTO users(username, discord_id, server_id) VALUES (?, ?, ?)', [(username, discord_id, server_id) for (username, discord_id) in users])
         self.con.commit()
 
 
+    def add_users(self, users: list[tuple[str, int, int]], chunk_size: int = 10000) -> None:
+        # users are (username, discord_id, server_id), possibly from several servers, inserted in one transaction
+        with self.con:
+            for i in range(0, len(users), chunk_size):
+                self.cur.executemany('INSERT OR IGNORE INTO users(username, discord_id, server_id) VALUES (?, ?, ?)', users[i:i+chunk_size])
+
+
     def add_user(self, server_id: int, user_id: int, username: str, ) -> None:
-        self.cur.execute('INSERT INTO users(username, discord_id, server_id) VALUES (?, ?, ?)', (username, user_id, server_id))
+        self.cur.execute('INSERT OR IGNORE INTO users(username, discord_id, server_id) VALUES (?, ?, ?)', (username, user_id, server_id))
         self.con.commit()
 
 
     def rm_user(self, server_id: int, user_id: int) -> None:
         self.cur.execute('DELETE FROM users WHERE server_id = ? AND discord_id = ?', (server_id, user_id))
+        self.cur.execute('DELETE FROM user_daily WHERE server_id = ? AND discord_id = ?', (server_id, user_id))
+        self.cur.execute('DELETE FROM cache_snapshots')
         self.con.commit()
 
 
@@ -103,9 +341,25 @@ class Database:
         self.con.commit()
 
 
-    def get_server_config(self, server_id: int) -> cache.ServerConfig:
+    def get_role_syncs(self) -> list[tuple[int, int, int]]:
+        self.cur.execute('SELECT server_id, channel_id, cursor FROM role_syncs')
+        return self.cur.fetchall()
+
+    def set_role_sync(self, server_id: int, channel_id: int, cursor: int) -> None:
+        self.cur.execute('INSERT OR REPLACE INTO role_syncs (server_id, channel_id, cursor) VALUES (?, ?, ?)', (server_id, channel_id, cursor))
+        self.con.commit()
+
+    def rm_role_sync(self, server_id: int) -> None:
+        self.cur.execute('DELETE FROM role_syncs WHERE server_id = ?', (server_id,))
+        self.con.commit()
+
+
+    def get_server_config(self, server_id: int) -> cache.ServerConfig | None:
         self.cur.execute('SELECT * FROM servers WHERE id = ?', (server_id,))
-        guild_id, name, rate_txt, rate_voice, mod_role, msg_cd, msg_rkthr, msg_xpfact, msg_xpmin = self.cur.fetchone()
+        server = self.cur.fetchone()
+        if server is None:
+            return None
+        guild_id, name, rate_txt, rate_voice, mod_role, msg_cd, msg_rkthr, msg_xpfact, msg_xpmin, global_leaderboard = server
 
         self.cur.execute('SELECT id, xp_threshold FROM roles WHERE server_id = ? ORDER BY xp_threshold ASC', (server_id,))
         roles = self.cur.fetchall()
@@ -117,9 +371,28 @@ class Database:
         self.cur.execute('SELECT id FROM channels WHERE server_id = ? AND type = ?', (server_id, ChannelType.voice.value))
         channels['voice'] = [channel[0] for channel in self.cur.fetchall()]
 
-        return cache.ServerConfig(guild_id,name, rate_txt, rate_voice, mod_role, msg_cd, msg_rkthr, msg_xpfact, msg_xpmin, roles, channels)
+        return cache.ServerConfig(guild_id,name, rate_txt, rate_voice, mod_role, msg_cd, msg_rkthr, msg_xpfact, msg_xpmin, global_leaderboard, roles, channels)
     
 
+    def get_server_configs(self) -> dict[int:cache.ServerConfig]:
+        # Same as get_server_config for every server at once
+        roles = {}
+        self.cur.execute('SELECT id, xp_threshold, server_id FROM roles ORDER BY xp_threshold ASC')
+        for role_id, xp_threshold, server_id in self.cur.fetchall():
+            roles.setdefault(server_id, []).append((role_id, xp_threshold))
+
+        channels = {}
+        self.cur.execute('SELECT id, type, server_id FROM channels')
+        for channel_id, channel_type, server_id in self.cur.fetchall():
+            if channel_type in cache.CHANNEL_KINDS:
+                server_channels = channels.setdefault(server_id, {'text': [], 'voice': []})
+                server_channels[cache.CHANNEL_KINDS[channel_type]].append(channel_id)
+
+        self.cur.execute('SELECT * FROM servers')
+        return {row[0]: cache.ServerConfig(*row, roles.get(row[0], []), channels.get(row[0], {'text': [], 'voice': []}))
+                for row in self.cur.fetchall()}
+
+
     def set_xp_rate_text(self, server_id: int, xp_rate: int, msg_cooldown: int, msg_rankthr: int, msg_xpfactor: float, msg_xpmin: int) -> int:
         self.cur.execute('UPDATE servers SET (xprate_msg, msg_cooldown, msg_rankthreshold, msg_xpfactor, msg_xpmin) = (?, ?, ?, ?, ?) WHERE id = ?', (xp_rate, msg_cooldown, msg_rankthr, msg_xpfactor, msg_xpmin, server_id))
         self.con.commit()
@@ -132,6 +405,22 @@ class Database:
         self.cur.execute('UPDATE servers SET mod_role = ? WHERE id = ?', (role_id, server_id))
         self.con.commit()
 
+    def set_global_leaderboard(self, server_id: int, enabled: bool) -> None:
+        # The totals of the server's users are added to global_users, or taken out of it, along with the opt-in
+        with self.con:
+            self.cur.execute('UPDATE servers SET global_leaderboard = ? WHERE id = ? AND global_leaderboard != ?', (int(enabled), server_id, int(enabled)))
+            if not self.cur.rowcount:
+                return
+            sign = 1 if enabled else -1
+            # WHERE true lets SQLite parse the ON CONFLICT clause of an INSERT ... SELECT
+            self.cur.execute('INSERT INTO global_users (discord_id, xp, msg_count, voice_uptime, n_servers) '
+                             'SELECT discord_id, ? * COALESCE(xp, 0), ? * COALESCE(msg_count, 0), ? * COALESCE(voice_uptime, 0), ? FROM users WHERE server_id = ? AND true '
+                             'ON CONFLICT (discord_id) DO UPDATE SET xp = xp + excluded.xp, msg_count = msg_count + excluded.msg_count, '
+                             'voice_uptime = voice_uptime + excluded.voice_uptime, n_servers = n_servers + excluded.n_servers',
+                             (sign, sign, sign, sign, server_id))
+            if not enabled:
+                self.cur.execute('DELETE FROM global_users WHERE n_servers <= 0')
+
 
     def get_user_xp(self, server_id: int, user_id: int) -> int:
         self.cur.execute('SELECT xp FROM users WHERE server_id = ? AND discord_id = ?', (server_id, user_id))
@@ -139,10 +428,12 @@ class Database:
 
     def set_user_xp(self, server_id: int, user_id: int, xp: int) -> None:
         self.cur.execute('UPDATE users SET xp = ? WHERE server_id = ? AND discord_id = ?', (xp, server_id, user_id))
+        self.cur.execute('DELETE FROM cache_snapshots')
         self.con.commit()
     
     def add_user_xp(self, server_id: int, user_id: int, xp: int) -> int:
         self.cur.execute('UPDATE users SET xp = xp + ? WHERE server_id = ? AND discord_id = ?', (xp, server_id, user_id))
+        self.cur.execute('DELETE FROM cache_snapshots')
         self.con.commit()
         self.cur.execute('SELECT xp FROM users WHERE server_id = ? AND discord_id = ?', (server_id, user_id))
         return self.cur.fetchone()[0]
@@ -155,10 +446,12 @@ class Database:
     
     def set_user_msg_count(self, server_id: int, user_id: int, msg_count: int) -> None:
         self.cur.execute('UPDATE users SET msg_count = ? WHERE server_id = ? AND discord_id = ?', (msg_count, server_id, user_id))
+        self.cur.execute('DELETE FROM cache_snapshots')
         self.con.commit()
 
     def add_user_msg_count(self, server_id: int, user_id: int, n_msg: int = 1) -> None:
         self.cur.execute('UPDATE users SET msg_count = msg_count + ? WHERE server_id = ? AND discord_id = ?', (n_msg, server_id, user_id))
+        self.cur.execute('DELETE FROM cache_snapshots')
         self.con.commit()
 
 
@@ -168,10 +461,12 @@ class Database:
     
     def set_user_voice_uptime(self, server_id: int, user_id: int, voice_uptime: int) -> None:
         self.cur.execute('UPDATE users SET voice_uptime = ? WHERE server_id = ? AND discord_id = ?', (voice_uptime, server_id, user_id))
+        self.cur.execute('DELETE FROM cache_snapshots')
         self.con.commit()
     
     def add_user_voice_uptime(self, server_id: int, user_id: int, n_min: int) -> None:
         self.cur.execute('UPDATE users SET voice_uptime = voice_uptime + ? WHERE server_id = ? AND discord_id = ?', (n_min, server_id, user_id))
+        self.cur.execute('DELETE FROM cache_snapshots')
         self.con.commit()
 
 
@@ -201,4 +496,67 @@ class Database:
             self.cur.execute('UPDATE users SET lastmsg_xp = ? WHERE server_id = ? AND discord_id = ?', (lastmsg_xp, server_id, user_id))
             updated = True
         if updated:
+            self.cur.execute('DELETE FROM cache_snapshots')
             self.con.commit()
+
+    def update_users(self, rows: list[tuple], voice_sessions: list[tuple[int, int, float]] | None = None,
+                     new_users: list[tuple[str, int, int]] = (), departed_users: list[tuple[int, int]] = (),
+                     voice_servers: list[int] | None = None, snapshot: tuple[str, int | None] | None = None) -> None:
+        # rows are (xp, msg_count, voice_uptime, lastmsg_time, lastmsg_xp, server_id, discord_id, day),
+        # the first three are added to the stored values and to the user_daily row of the day the activity happened,
+        # None leaves the last message fields untouched. The rows of a user are applied in order, earlier days first.
+        # voice_sessions, if given, replace the saved sessions in the same transaction as the credits they account for,
+        # only the sessions of voice_servers if given, for a process that only runs some of the servers.
+        # new_users (username, discord_id, server_id) are inserted before the rows are applied,
+        # departed_users (server_id, discord_id) are deleted after.
+        # snapshot (name, token) sets the cache snapshot token of the process named, the tokens of every process are cleared without it
+        with self.con:
+            self.cur.executemany('INSERT OR IGNORE INTO users(username, discord_id, server_id) VALUES (?, ?, ?)', new_users)
+            self.cur.executemany('UPDATE users SET xp = xp + ?, msg_count = msg_count + ?, voice_uptime = voice_uptime + ?, lastmsg_time = COALESCE(?, lastmsg_time), lastmsg_xp = COALESCE(?, lastmsg_xp) WHERE server_id = ? AND discord_id = ?', [row[:7] for row in rows])
+            self.cur.executemany('INSERT INTO user_daily (server_id, discord_id, day, xp, msg_count, voice_uptime) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (server_id, discord_id, day) DO UPDATE SET xp = xp + excluded.xp, msg_count = msg_count + excluded.msg_count, voice_uptime = voice_uptime + excluded.voice_uptime',
+                                 [(server_id, discord_id, day, xp, msg_count, voice_uptime) for xp, msg_count, voice_uptime, _, _, server_id, discord_id, day in rows])
+            if voice_sessions is not None:
+                if voice_servers is None:
+                    self.cur.execute('DELETE FROM voice_sessions')
+                else:
+                    self.cur.executemany('DELETE FROM voice_sessions WHERE server_id = ?', [(server_id,) for server_id in voice_servers])
+                self.cur.executemany('INSERT INTO voice_sessions (server_id, discord_id, update_time) VALUES (?, ?, ?)', voice_sessions)
+            self.cur.executemany('DELETE FROM users WHERE server_id = ? AND discord_id = ?', departed_users)
+            self.cur.executemany('DELETE FROM user_daily WHERE server_id = ? AND discord_id = ?', departed_users)
+            if snapshot is None:
+                self.cur.execute('DELETE FROM cache_snapshots')
+            else:
+                self.cur.execute('INSERT OR REPLACE INTO cache_snapshots (name, token) VALUES (?, ?)', snapshot)
+
+    def set_users_xp(self, rows: list[tuple[int, float, int, int, int]]) -> None:
+        # rows are (xp, lastmsg_time, lastmsg_xp, server_id, discord_id), as recomputed from the activity journal
+        with self.con:
+            self.cur.executemany('UPDATE users SET xp = ?, lastmsg_time = ?, lastmsg_xp = ? WHERE server_id = ? AND discord_id = ?', rows)
+            self.cur.execute('DELETE FROM cache_snapshots')
+
+    def get_period_leaderboard(self, server_id: int, since_day: int, n_users: int, offset: int = 0) -> tuple[int, list[tuple[int, int]]]:
+        # Returns the number of active users since the day and a page of (discord_id, xp) sorted by XP earned over the period.
+        # The day index only reads the rows of the period, the planner would otherwise scan the whole history for the GROUP BY
+        self.cur.execute('SELECT COUNT(DISTINCT discord_id) FROM user_daily INDEXED BY user_daily_server_day WHERE server_id = ? AND day >= ?', (server_id, since_day))
+        n_active = self.cur.fetchone()[0]
+        self.cur.execute('SELECT discord_id, SUM(xp) AS period_xp FROM user_daily INDEXED BY user_daily_server_day WHERE server_id = ? AND day >= ? GROUP BY discord_id ORDER BY period_xp DESC, discord_id LIMIT ? OFFSET ?', (server_id, since_day, n_users, offset))
+        return n_active, self.cur.fetchall()
+
+    def get_user_history(self, server_id: int, user_id: int, since_day: int) -> list[tuple[int, int, int, int]]:
+        # (day, xp, msg_count, voice_uptime) of the active days since since_day
+        self.cur.execute('SELECT day, xp, msg_count, voice_uptime FROM user_daily WHERE server_id = ? AND discord_id = ? AND day >= ? ORDER BY day', (server_id, user_id, since_day))
+        return self.cur.fetchall()
+
+    def get_global_leaderboard(self, n_users: int, offset: int = 0) -> list[tuple[int, int]]:
+        # (discord_id, xp) by XP summed over the servers that opted in, read from the global_users_xp index
+        self.cur.execute('SELECT discord_id, xp FROM global_users ORDER BY xp DESC, discord_id LIMIT ? OFFSET ?', (n_users, offset))
+        return self.cur.fetchall()
+
+    def get_voice_sessions(self) -> dict[tuple[int, int]:float]:
+        self.cur.execute('SELECT server_id, discord_id, update_time FROM voice_sessions')
+        return {(server_id, discord_id): update_time for server_id, discord_id, update_time in self.cur.fetchall()}
+
+    def get_snapshot_token(self, name: str) -> int | None:
+        self.cur.execute('SELECT token FROM cache_snapshots WHERE name = ?', (name,))
+        row = self.cur.fetchone()
+        return row[0] if row else None
@@ -0,0 +1,324 @@
+"""Append-only journal of the activity credited by the bot, to recompute XP under another configuration.
+
+Events are gathered in memory and written in batches as immutable segment files. A segment stores
+each field as a column, so that it is read back with one array.fromfile per field. Compaction merges
+the segments into one, sorted by server then user then time, and drops the servers that were removed.
+
+The XP the journal did not see, earned before it was enabled or brought in by an import, is recorded
+as SET_XP baseline events. A recomputation replays the activity on top of them.
+
+    python journal.py compact
+    python journal.py recompute <server_id> --rate-txt 15 --cooldown 30 [--apply]
+"""
+import os
+import sys
+import time
+import array
+import bisect
+import struct
+import asyncio
+import argparse
+import datetime
+
+import cache
+
+JOURNAL_DIR = 'data/journal'
+# Written once the baseline of the stored XP is in the journal
+BASELINE_FILE = 'baseline'
+# The periodic compaction waits for the segments written since the last one to reach this share of its size
+COMPACT_MIN_RATIO = 0.1
+
+MESSAGE = 0
+VOICE = 1
+SET_XP = 2
+
+MAGIC = b'XPJ1'
+VERSION = 1
+# Magic, version, number of events, then one array per column
+HEADER = struct.Struct('<4sHI')
+COLUMNS = (('time', 'd'), ('server_id', 'Q'), ('user_id', 'Q'), ('kind', 'B'), ('value', 'q'))
+
+
+class Events():
+    """Columns of journal events, value is 1 for a message, the minutes credited for voice or the XP set by a mod."""
+
+    def __init__(self):
+        for name, typecode in COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def append(self, event_time: float, server_id: int, user_id: int, kind: int, value: int):
+        self.time.append(event_time)
+        self.server_id.append(server_id)
+        self.user_id.append(user_id)
+        self.kind.append(kind)
+        self.value.append(value)
+
+    def extend(self, other: 'Events'):
+        for name, _ in COLUMNS:
+            getattr(self, name).extend(getattr(other, name))
+
+    def select(self, indexes) -> 'Events':
+        selected = Events()
+        for name, _ in COLUMNS:
+            column = getattr(self, name)
+            getattr(selected, name).extend(column[i] for i in indexes)
+        return selected
+
+    def slice(self, start: int, stop: int) -> 'Events':
+        sliced = Events()
+        for name, _ in COLUMNS:
+            setattr(sliced, name, getattr(self, name)[start:stop])
+        return sliced
+
+    def sorted(self) -> 'Events':
+        indexes = sorted(range(len(self)), key=lambda i: (self.server_id[i], self.user_id[i], self.time[i]))
+        return self.select(indexes)
+
+    def server_range(self, server_id: int) -> tuple[int, int]:
+        # Only valid on sorted events
+        return bisect.bisect_left(self.server_id, server_id), bisect.bisect_right(self.server_id, server_id)
+
+
+def write_segment(path: str, events: Events):
+    # Written under a temporary name first so that a segment is never seen half written
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(events)))
+        for name, _ in COLUMNS:
+            column = getattr(events, name)
+            if sys.byteorder == 'big':
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            column.tofile(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+def read_segment(path: str) -> Events:
+    events = Events()
+    with open(path, 'rb') as file:
+        magic, version, count = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} journal segment')
+        for name, typecode in COLUMNS:
+            column = getattr(events, name)
+            column.fromfile(file, count)
+            if sys.byteorder == 'big':
+                column.byteswap()
+    return events
+
+
+class Journal():
+    """Segments are named after their sequence number, a compacted segment replaces every segment up to its own."""
+
+    def __init__(self, directory: str = JOURNAL_DIR):
+        self.directory = directory
+        self.pending = Events()
+        self.lock = asyncio.Lock()
+        os.makedirs(directory, exist_ok=True)
+        compacted, segments = self.segments()
+        self.last_seq = max([seq for seq, _ in segments] + [compacted[0] if compacted else 0])
+
+    def segments(self) -> tuple[tuple[int, str] | None, list[tuple[int, str]]]:
+        # Returns the latest compacted segment and the segments written after it
+        compacted = None
+        segments = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.seg'):
+                continue
+            path = os.path.join(self.directory, name)
+            if name.startswith('compact-'):
+                seq = int(name[len('compact-'):-len('.seg')])
+                if compacted is None or seq > compacted[0]:
+                    compacted = (seq, path)
+            else:
+                segments.append((int(name[:-len('.seg')]), path))
+        last_compacted = compacted[0] if compacted else 0
+        return compacted, sorted(segment for segment in segments if segment[0] > last_compacted)
+
+    def add_message(self, server_id: int, user_id: int, message_time: float):
+        self.pending.append(message_time, server_id, user_id, MESSAGE, 1)
+
+    def add_voice(self, server_id: int, user_id: int, update_time: float, n_min: int):
+        self.pending.append(update_time, server_id, user_id, VOICE, n_min)
+
+    def set_xp(self, server_id: int, user_id: int, xp: int, event_time: float | None = None):
+        self.pending.append(time.time() if event_time is None else event_time, server_id, user_id, SET_XP, xp)
+
+    def has_baseline(self) -> bool:
+        return os.path.exists(os.path.join(self.directory, BASELINE_FILE))
+
+    def mark_baseline(self, baseline_time: float):
+        # Only once the baseline events are written, a baseline interrupted before is written again
+        with open(os.path.join(self.directory, BASELINE_FILE), 'w') as file:
+            file.write(f'{baseline_time}\n')
+
+    async def flush(self) -> int:
+        # Segments are written one at a time and in order, so that a compaction never skips one still being written
+        async with self.lock:
+            if not len(self.pending):
+                return 0
+            events, self.pending = self.pending, Events()
+            self.last_seq += 1
+            path = os.path.join(self.directory, f'{self.last_seq:010d}.seg')
+            try:
+                await asyncio.to_thread(write_segment, path, events)
+            except Exception:
+                events.extend(self.pending)
+                self.pending = events
+                raise
+            return len(events)
+
+    def read(self) -> Events:
+        return self._read(*self.segments())
+
+    def _read(self, compacted: tuple[int, str] | None, segments: list[tuple[int, str]]) -> Events:
+        events = read_segment(compacted[1]) if compacted else Events()
+        for _, path in segments:
+            events.extend(read_segment(path))
+        return events
+
+    def read_server(self, server_id: int) -> Events:
+        compacted, segments = self.segments()
+        events = Events()
+        if compacted:
+            compacted_events = read_segment(compacted[1])
+            events.extend(compacted_events.slice(*compacted_events.server_range(server_id)))
+        for _, path in segments:
+            segment = read_segment(path)
+            events.extend(segment.select([i for i, value in enumerate(segment.server_id) if value == server_id]))
+        return events
+
+    def compact(self, servers: set[int] | None = None, min_ratio: float = 0) -> int:
+        # Segments written meanwhile get a higher sequence number and are left for the next compaction.
+        # The whole journal is read, min_ratio skips a compaction that would only merge a few new segments
+        compacted, segments = self.segments()
+        if not segments:
+            return 0
+        if compacted and sum(os.path.getsize(path) for _, path in segments) < min_ratio * os.path.getsize(compacted[1]):
+            return 0
+        events = self._read(compacted, segments)
+        if servers is not None:
+            events = events.select([i for i, server_id in enumerate(events.server_id) if server_id in servers])
+        events = events.sorted()
+        last_seq = segments[-1][0]
+        write_segment(os.path.join(self.directory, f'compact-{last_seq:010d}.seg'), events)
+        # The files replaced by the new segment, including the leftovers of a compaction interrupted at this point
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg'):
+                seq = int(name[len('compact-'):-len('.seg')] if name.startswith('compact-') else name[:-len('.seg')])
+                if seq < last_seq or (seq == last_seq and not name.startswith('compact-')):
+                    os.remove(os.path.join(self.directory, name))
+        return len(events)
+
+    async def compact_async(self, servers: set[int] | None = None, min_ratio: float = 0) -> int:
+        return await asyncio.to_thread(self.compact, servers, min_ratio)
+
+
+# ================================
+# Recomputation
+# ================================
+
+def recompute(events: Events, config: cache.ServerConfig) -> dict[int:tuple[int, float, int]]:
+    """Replays the events of one server with the rules of on_message and credit_voice.
+
+    Returns (xp, lastmsg_time, lastmsg_xp) by user. Message and voice counts do not depend on the configuration.
+    """
+    events = events.sorted()
+    times, users, kinds, values = events.time, events.user_id, events.kind, events.value
+    cooldown, rankthr, xpfactor, xpmin = config.msg_cooldown, config.msg_rankthr, config.msg_xpfactor, config.msg_xpmin
+    rate_txt, rate_voice = config.rate_txt, config.rate_voice
+    fromtimestamp = datetime.date.fromtimestamp
+
+    results = {}
+    n = len(events)
+    start = 0
+    while start < n:
+        user_id = users[start]
+        stop = bisect.bisect_right(users, user_id, start, n)
+        xp, lastmsg_time, lastmsg_xp, last_date = 0, 0.0, 0, None
+        for i in range(start, stop):
+            kind = kinds[i]
+            if kind == MESSAGE:
+                event_time = times[i]
+                if event_time - lastmsg_time < cooldown:
+                    continue
+                date = fromtimestamp(event_time)
+                if rankthr == -1 or xp < rankthr or date != last_date:
+                    new_xp = rate_txt
+                else:
+                    new_xp = max(int(lastmsg_xp * xpfactor), xpmin)
+                xp += new_xp
+                lastmsg_time, lastmsg_xp, last_date = event_time, new_xp, date
+            elif kind == VOICE:
+                xp += rate_voice * values[i]
+            else:
+                xp = values[i]
+        results[user_id] = (xp, lastmsg_time, lastmsg_xp)
+        start = stop
+    return results
+
+
+def main():
+    import data
+
+    parser = argparse.ArgumentParser(description="Compact the activity journal or recompute the XP of a server from it")
+    parser.add_argument('--journal', default=os.environ.get('JOURNAL_DIR', JOURNAL_DIR))
+    parser.add_argument('--db', default=data.DB_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('compact', help="merge the segments and drop the removed servers")
+    parser_recompute = subparsers.add_parser('recompute', help="replay the journal of a server under another XP rate")
+    parser_recompute.add_argument('server_id', type=int)
+    parser_recompute.add_argument('--rate-txt', type=int)
+    parser_recompute.add_argument('--rate-voice', type=int)
+    parser_recompute.add_argument('--cooldown', type=int)
+    parser_recompute.add_argument('--rank-threshold', type=int)
+    parser_recompute.add_argument('--xp-factor', type=float)
+    parser_recompute.add_argument('--min-xp', type=int)
+    parser_recompute.add_argument('--apply', action='store_true', help="write the XP to the database, the bot must be stopped")
+    args = parser.parse_args()
+
+    db = data.Database(args.db)
+    db.init()
+    activity_journal = Journal(args.journal)
+    start = time.perf_counter()
+    if args.command == 'compact':
+        n_events = activity_journal.compact(set(db.get_servers()))
+        print(f'Compacted {n_events} events in {time.perf_counter() - start:.1f} s')
+        return
+
+    config = db.get_server_config(args.server_id)
+    if config is None:
+        sys.exit(f'Unknown server {args.server_id}')
+    config.rate_txt = config.rate_txt if args.rate_txt is None else args.rate_txt
+    config.rate_voice = config.rate_voice if args.rate_voice is None else args.rate_voice
+    config.msg_cooldown = config.msg_cooldown if args.cooldown is None else args.cooldown
+    config.msg_rankthr = config.msg_rankthr if args.rank_threshold is None else args.rank_threshold
+    config.msg_xpfactor = config.msg_xpfactor if args.xp_factor is None else args.xp_factor
+    config.msg_xpmin = config.msg_xpmin if args.min_xp is None else args.min_xp
+
+    events = activity_journal.read_server(args.server_id)
+    results = recompute(events, config)
+    print(f'Replayed {len(events)} events of {len(results)} users in {time.perf_counter() - start:.1f} s')
+    current = {user_id: xp for _, user_id, xp, *_ in db.get_users(args.server_id)}
+    changes = sorted(((user_id, current.get(user_id, 0), xp) for user_id, (xp, _, _) in results.items() if current.get(user_id) != xp),
+                     key=lambda change: abs(change[2] - change[1]), reverse=True)
+    print(f'{len(changes)} users would change')
+    for user_id, old_xp, new_xp in changes[:20]:
+        print(f'  {user_id}: {old_xp} -> {new_xp}')
+    if not activity_journal.has_baseline():
+        # Without it, the XP of every user would be rebuilt from the journaled activity alone
+        print('The journal has no baseline of the XP earned before it was enabled or imported, '
+              'the changes above include that XP being lost')
+        if args.apply:
+            sys.exit('Not applied: start the bot once with this journal to write the baseline')
+    if args.apply:
+        db.set_users_xp([(xp, lastmsg_time, lastmsg_xp, args.server_id, user_id) for user_id, (xp, lastmsg_time, lastmsg_xp) in results.items()])
+        print('Applied')
+
+
+if __name__ == '__main__':
+    main()
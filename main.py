@@ -1,42 +1,138 @@
 import os
+import sys
 import time
+import random
+import asyncio
 import datetime
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from dotenv import load_dotenv
 
-import data
 import cache
+import buffer
+import storage
+import memory
+import rolesync
+import metrics
+import journal
+import outbox
+import profiling
+import snapshot
 from cache import ServerConfig
 
 load_dotenv()
 token = os.environ.get('DISCORD_TOKEN')
+flush_interval = float(os.environ.get('FLUSH_INTERVAL', 10))
+flush_max_rows = int(os.environ.get('FLUSH_MAX_ROWS', 1000))
+role_sync_concurrency = int(os.environ.get('ROLE_SYNC_CONCURRENCY', 4))
+voice_checkpoint_interval = float(os.environ.get('VOICE_CHECKPOINT_INTERVAL', 5))
+metrics_port = int(os.environ.get('METRICS_PORT', 0))
+lazy_guilds = os.environ.get('LAZY_GUILDS', '0') == '1'
+guild_cache_size = int(os.environ.get('GUILD_CACHE_SIZE', 1000))
+journal_dir = os.environ.get('JOURNAL_DIR', journal.JOURNAL_DIR)
+journal_compact_interval = float(os.environ.get('JOURNAL_COMPACT_INTERVAL', 24))
+role_update_workers = int(os.environ.get('ROLE_UPDATE_WORKERS', 4))
+role_update_rate = float(os.environ.get('ROLE_UPDATE_RATE', 10))
+# Sharded deployment, see cluster.py: this process runs the SHARD_IDS shards out of SHARD_COUNT
+# and reaches the database through the writer process listening on STORAGE_ADDRESS
+shard_count = int(os.environ.get('SHARD_COUNT', 0))
+shard_ids = [int(shard_id) for shard_id in os.environ.get('SHARD_IDS', '').split(',') if shard_id]
+storage_address = os.environ.get('STORAGE_ADDRESS')
+storage_authkey = os.environ.get('STORAGE_AUTHKEY')
+storage_engine = os.environ.get('STORAGE_ENGINE', 'sqlite')
+# An empty MEMORY_SNAPSHOT keeps the data of the memory engine in memory only
+memory_snapshot = os.environ.get('MEMORY_SNAPSHOT', memory.SNAPSHOT_PATH)
+memory_snapshot_interval = float(os.environ.get('MEMORY_SNAPSHOT_INTERVAL', 60))
+# An empty CACHE_SNAPSHOT disables the warm restarts from a cache snapshot
+cache_snapshot = os.environ.get('CACHE_SNAPSHOT', snapshot.SNAPSHOT_PATH)
+cache_snapshot_interval = float(os.environ.get('CACHE_SNAPSHOT_INTERVAL', 15))
+
+LEADERBOARD_PAGE_SIZE = 10
+MEMBER_CHUNK_SIZE = 1000
+# Days covered by the periods of /leaderboard and /stats, today included
+PERIODS = {'week': 7, 'month': 30}
+# Users ranked by /leaderboard scope:global, a bounded read of the global_users_xp index whatever the number of users
+GLOBAL_LEADERBOARD_SIZE = 100
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = discord.Bot(intents=intents)
-db = data.Database()
-cached = cache.CachedData()
+if shard_count:
+    bot = discord.AutoShardedBot(intents=intents, shard_count=shard_count, shard_ids=shard_ids or None)
+else:
+    bot = discord.Bot(intents=intents)
+if storage_address:
+    if not storage_authkey:
+        sys.exit('STORAGE_ADDRESS requires the STORAGE_AUTHKEY of the writer process')
+    db = storage.RemoteDatabase(storage_address, storage_authkey.encode())
+elif storage_engine == 'memory':
+    db = storage.AsyncDatabase(memory_snapshot or None, engine=memory.MemoryDatabase, snapshot_interval=memory_snapshot_interval)
+else:
+    db = storage.AsyncDatabase()
+cached = cache.CachedData(guild_cache_size if lazy_guilds else None)
+xp_buffer = buffer.XpBuffer(db, flush_max_rows, cache_snapshot or None)
+# An empty JOURNAL_DIR disables the activity journal
+activity_journal = journal.Journal(journal_dir) if journal_dir else None
+
+metrics.Gauge('xpbot_buffer_pending_rows', "Users with XP deltas waiting to be flushed", lambda: xp_buffer.pending_rows)
+metrics.Gauge('xpbot_buffer_flushes', "Flushes of the XP buffer", lambda: xp_buffer.flush_count)
+metrics.Gauge('xpbot_buffer_flush_seconds', "Total time spent flushing the XP buffer", lambda: xp_buffer.total_flush_time)
+metrics.Gauge('xpbot_guilds', "Servers in the cached data", lambda: len(cached.data))
+metrics_tasks: list[asyncio.Task] = []
+profile_session: profiling.ProfileSession | None = None
+# Lazy mode state: guilds being loaded and voice sessions saved by the last run, not resumed yet
+loading_servers: dict[int:asyncio.Task] = {}
+saved_voice_sessions: dict[tuple[int, int]:float] = {}
 
 
 # ================================
 # Functions
 # ================================
 
-async def update_role(member: discord.Member, server_config: ServerConfig, xp: int):
-    member_roles = [role.id for role in member.roles]    
-    n_role = 0
-    while n_role < len(server_config.roles) and server_config.roles[n_role][1] <= xp:
-        n_role += 1
-
-    if n_role>0 and server_config.roles[n_role-1][0] not in member_roles:
-        await member.remove_roles(*[discord.Object(role_id) for role_id, _ in server_config.roles])
-        await member.add_roles(discord.Object(server_config.roles[n_role-1][0]))
+def get_role_changes(member: discord.Member, server_config: ServerConfig, xp: int) -> tuple[set[int], set[int]] | None:
+    # Returns the automatic roles to add to and remove from the member, or None if they already have the right one.
+    # Only the changes are sent, so that the other roles of the member, and the default role, are left alone
+    role_id = server_config.get_role(xp)
+    if role_id is None:
+        return None
+    member_roles = {role.id for role in member.roles if not role.is_default()}
+    to_add = {role_id} - member_roles
+    to_remove = (member_roles & server_config.role_ids) - {role_id}
+    return (to_add, to_remove) if to_add or to_remove else None
+
+async def update_role(member: discord.Member, server_config: ServerConfig, xp: int) -> bool:
+    changes = get_role_changes(member, server_config, xp)
+    if changes is None:
+        return False
+    to_add, to_remove = changes
+    try:
+        # One call per role, as add_roles and remove_roles make them
+        if to_remove:
+            metrics.REST_CALLS.inc(len(to_remove), route='member.remove_roles')
+            await member.remove_roles(*[discord.Object(role_id) for role_id in to_remove])
+        if to_add:
+            metrics.REST_CALLS.inc(len(to_add), route='member.add_roles')
+            await member.add_roles(*[discord.Object(role_id) for role_id in to_add])
+    except discord.HTTPException as e:
+        if e.status == 429:
+            metrics.REST_RATE_LIMITS.inc(source='update_role')
+        raise
+    return True
+
+# A ROLE_UPDATE_RATE of 0 leaves the rate to the workers and to the rate limits of discord.py
+role_outbox = outbox.RoleOutbox(update_role, role_update_workers,
+                                rolesync.RateLimiter(role_update_rate, burst=int(role_update_rate) or 1) if role_update_rate else None)
+metrics.Gauge('xpbot_role_outbox_pending', "Members waiting for a role update", lambda: len(role_outbox))
+
+def request_role(member: discord.Member, server_config: ServerConfig, xp: int):
+    # The handlers never wait on Discord, the role is applied by role_outbox. A request made with an older XP
+    # is replaced even when the current roles already match, update_role recomputes the changes when it runs
+    if role_outbox.has_request(member) or get_role_changes(member, server_config, xp) is not None:
+        role_outbox.request(member, server_config, xp)
 
 async def is_mod(ctx: commands.Context):
-    mod_role = cached.get_server(ctx.guild.id).config.mod_role
+    mod_role = (await get_server(ctx.guild.id)).config.mod_role
     if mod_role in [role.id for role in ctx.author.roles]:
         return True
     await ctx.respond(f"You must be <{mod_role}> to use this command")
@@ -70,15 +166,238 @@ def is_channel_visible(ctx: commands.context, channel_id: int):
         return perms.read_messages or perms.view_channel
     return False
 
-def on_exit():
+def is_local_guild(server_id: int) -> bool:
+    # Whether the guild belongs to the shards of this process
+    if not shard_count:
+        return True
+    return (server_id >> 22) % shard_count in (shard_ids or range(shard_count))
+
+def local_voice_servers() -> list[int] | None:
+    # The saved voice sessions of the other processes must be kept when this one saves its own
+    return list(cached.data) if shard_count else None
+
+def log_timing(phase: str, start: float) -> float:
+    now = time.perf_counter()
+    print(f'Loaded {phase} in {(now - start) * 1000:.0f} ms')
+    return now
+
+async def load_server(config: ServerConfig, ordered: bool = False, saved: snapshot.ServerSnapshot | None = None) -> list[tuple[str, int, int]]:
+    # Returns the members missing from the database, as expected by Database.add_users.
+    # An ordered load reads the users after every pending write, for servers loaded while the bot runs,
+    # the users of a server restored from a cache snapshot are used as is
+    server = cached.add_server(config)
+    if saved is not None:
+        server.set_users(saved.users, saved.ranking)
+    else:
+        server.load_users(await (db.run_ordered('get_users', config.id) if ordered else db.get_users(config.id)))
+
+    guild = bot.get_guild(config.id)
+    if guild is None:
+        return []
+    missing = [(member.name, member.id, config.id) for member in guild.members if member.id not in server.users]
+    for _, member_id, _ in missing:
+        server.get_user(member_id)
+    if guild.chunked:
+        # The members who left while the bot was offline, only known once every member is received
+        member_ids = {member.id for member in guild.members}
+        for user_id in [user_id for user_id in server.users if user_id not in member_ids]:
+            server.rm_user(user_id)
+            await xp_buffer.remove_member(config.id, user_id)
+    return missing
+
+async def iter_member_chunks(guild: discord.Guild):
+    # Huge guilds may not be chunked yet, their members are then fetched page by page
+    if guild.chunked:
+        members = guild.members
+        for start in range(0, len(members), MEMBER_CHUNK_SIZE):
+            yield members[start:start + MEMBER_CHUNK_SIZE]
+    else:
+        chunk = []
+        async for member in guild.fetch_members(limit=None):
+            chunk.append(member)
+            if len(chunk) >= MEMBER_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+def tracked_voice_members(guild: discord.Guild, config: ServerConfig) -> list[int]:
+    members = []
+    for channel_id in config.channels['voice']:
+        channel = guild.get_channel(channel_id)
+        if channel is not None:
+            members += [user_id for user_id in channel.voice_states if guild.get_member(user_id) is not None]
+    return members
+
+def load_voice_states(server_id: int, voice_sessions: dict[tuple[int, int]:float]):
+    # Sessions saved by the last checkpoint are resumed if the member is still connected
+    server = cached.get_server(server_id)
+    guild = bot.get_guild(server_id)
+    if guild is None:
+        return
+    for user_id in tracked_voice_members(guild, server.config):
+        server.start_voice_session(user_id, voice_sessions.pop((server_id, user_id), None))
+
+async def load_guild(guild: discord.Guild) -> cache.CachedServer:
+    # Loads a guild on demand in lazy mode, the least recently used idle guilds are unloaded past the cache size
+    try:
+        config = await db.get_server_config(guild.id)
+        if config is None:
+            await db.add_server(guild.id, guild.name)
+            config = await db.get_server_config(guild.id)
+        await db.add_users(await load_server(config, ordered=True))
+        load_voice_states(guild.id, saved_voice_sessions)
+        server = cached.get_server(guild.id)
+        await evict_servers(keep=guild.id)
+        return server
+    finally:
+        del loading_servers[guild.id]
+
+async def evict_servers(keep: int | None = None):
+    # The users of an evicted server are read again from the database when it is loaded back,
+    # so their pending deltas must be written first
+    if cached.evict(keep):
+        await xp_buffer.flush()
+
+async def get_server(server_id: int) -> cache.CachedServer | None:
+    server = cached.get_server(server_id)
+    if server is None and lazy_guilds:
+        guild = bot.get_guild(server_id)
+        if guild is None:
+            return None
+        if server_id not in loading_servers:
+            loading_servers[server_id] = asyncio.create_task(load_guild(guild))
+        server = await asyncio.shield(loading_servers[server_id])
+    return server
+
+role_sync = rolesync.RoleSync(db, get_server, update_role, role_sync_concurrency)
+
+async def credit_voice(server: cache.CachedServer, session: cache.VoiceSession, update_time: float) -> int:
+    # Credits the minutes spent in voice since the last update of the session and returns them
+    uptime = int(update_time // 60 - session.update_time // 60)
+    session.update_time = update_time
+    if uptime > 0:
+        server.add_user_xp(session.user_id, server.config.rate_voice * uptime)
+        if activity_journal:
+            activity_journal.add_voice(server.id, session.user_id, update_time, uptime)
+        await xp_buffer.add_voice(server.id, session.user_id, server.config.rate_voice * uptime, uptime)
+    return uptime
+
+async def read_snapshot() -> dict[int:snapshot.ServerSnapshot]:
+    # A snapshot is only used while the database holds its token, that is when it matches the stored users
+    try:
+        saved = snapshot.load(cache_snapshot)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f'Ignored the cache snapshot: {e}')
+        return {}
+    if saved.token != await db.get_snapshot_token(cache_snapshot):
+        print('Ignored the cache snapshot: the database changed since it was written')
+        return {}
+    return saved.servers
+
+async def write_snapshot() -> bool:
+    # The snapshot is taken and the flush storing its token starts without awaiting in between, so that
+    # the snapshot is exactly the stored state once the flush is written. A flush already in flight could
+    # fail and put its deltas back in the buffer, the snapshot is then left to the next round
+    if xp_buffer.flushing:
+        return False
+    start = time.perf_counter()
+    token = random.getrandbits(63)
+    payload = snapshot.dump(cached, token, time.time())
+    sessions = [(server.id, session.user_id, session.update_time) for server in cached.data.values() for session in server.voice_sessions.values()]
+    await xp_buffer.flush(voice_sessions=sessions, voice_servers=local_voice_servers(), snapshot_token=token)
+    await asyncio.to_thread(snapshot.write, cache_snapshot, payload)
+    print(f'Wrote the cache snapshot of {len(cached.data)} servers ({len(payload)} bytes) in {(time.perf_counter() - start) * 1000:.0f} ms')
+    return True
+
+async def on_exit():
+    now = time.time()
     server: cache.CachedServer
     for server in cached.data.values():
-        voice_update: cache.VoiceUpdate
-        for voice_update in server.voice_updates.values():
-            if voice_update.is_connected:
-                uptime = time.time() // 60 - voice_update.update_time // 60
-                db.add_user_xp(server.id, voice_update.user_id, server.config.rate_voice * uptime)
-                db.add_user_voice_uptime(server.id, voice_update.user_id, uptime)
+        for session in server.voice_sessions.values():
+            await credit_voice(server, session, now)
+    # A flush still in flight would make write_snapshot skip, and it puts its deltas back if it fails
+    await xp_buffer.idle.wait()
+    # The sessions are saved credited up to now, those still connected at the next start go on without a gap
+    if not (cache_snapshot and await write_snapshot()):
+        # Every session is fully credited, none is left to resume
+        await xp_buffer.idle.wait()
+        await xp_buffer.flush(voice_sessions=[], voice_servers=local_voice_servers())
+    if activity_journal:
+        await activity_journal.flush()
+    db.close()
+
+
+# ================================
+# Tasks
+# ================================
+
+@tasks.loop(seconds=flush_interval)
+async def flush_xp_buffer():
+    # A task loop stops for good on errors other than network ones, a failed flush is retried on the next iteration
+    try:
+        await xp_buffer.flush()
+        if activity_journal:
+            await activity_journal.flush()
+    except Exception as e:
+        print(f'Flush of the XP buffer failed: {e!r}')
+
+@tasks.loop(minutes=cache_snapshot_interval)
+async def snapshot_cache():
+    try:
+        await write_snapshot()
+    except Exception as e:
+        print(f'Cache snapshot failed: {e!r}')
+
+@tasks.loop(hours=journal_compact_interval)
+async def compact_journal():
+    # Also runs at startup, where it is skipped unless enough was written since the last compaction
+    try:
+        n_events = await activity_journal.compact_async(set(await db.get_servers()), journal.COMPACT_MIN_RATIO)
+    except Exception as e:
+        print(f'Journal compaction failed: {e!r}')
+        return
+    if n_events:
+        print(f'Compacted {n_events} journal events')
+
+async def write_journal_baseline(server_ids: list[int]):
+    # The XP stored before the journal was enabled is recorded once, so that a recomputation replays the activity on top of it
+    baseline_time = time.time()
+    n_users = 0
+    for server_id in server_ids:
+        for _, user_id, xp, *_ in await db.get_users(server_id):
+            if xp:
+                activity_journal.set_xp(server_id, user_id, xp, baseline_time)
+                n_users += 1
+    await activity_journal.flush()
+    activity_journal.mark_baseline(baseline_time)
+    print(f'Wrote the journal baseline of {n_users} users')
+
+@tasks.loop(minutes=voice_checkpoint_interval)
+async def checkpoint_voice_sessions():
+    # Credits the ongoing voice sessions so that a crash loses at most one interval,
+    # the sessions are saved in the same transaction as their credits
+    now = time.time()
+    sessions = []
+    credited = []
+    for server in list(cached.data.values()):
+        for session in list(server.voice_sessions.values()):
+            if await credit_voice(server, session, now):
+                credited.append((server, session.user_id))
+            sessions.append((server.id, session.user_id, session.update_time))
+    try:
+        await xp_buffer.flush(voice_sessions=sessions, voice_servers=local_voice_servers())
+    except Exception as e:
+        # The credits stay in the buffer, the sessions are saved by the next checkpoint
+        print(f'Voice checkpoint failed: {e!r}')
+
+    for server, user_id in credited:
+        guild = bot.get_guild(server.id)
+        member = guild.get_member(user_id) if guild else None
+        if member is not None:
+            request_role(member, server.config, server.get_user(user_id).xp)
 
 
 # ================================
@@ -86,89 +405,146 @@ def on_exit():
 # ================================
 
 @bot.event
+@metrics.observe_handler
 async def on_ready():
     await bot.change_presence(status=discord.Status.invisible)
-    db.init()
-    servers = db.get_servers()
-    for server in servers:
-        config = db.get_server_config(server)
-        cached.add_server(config)
-
-        guild = bot.get_guild(server)
-        users = db.get_users(server)
-        user_ids = [discord_id for _, discord_id, _, _, _, _, _ in users]
-        for member in guild.members:
-            if not member.id in user_ids:
-                db.add_user(server, member.id, member.name)
-        for channel in config.channels['voice']:
-            voice_states: dict[int:discord.VoiceState] = bot.get_channel(channel).voice_states
-            for user_id in voice_states:
-                member = bot.get_guild(server).get_member(user_id)
-                cached.get_server(server).add_voice_update(member, voice_states[user_id])
-        
+    start = time.perf_counter()
+    await db.init()
+    # The cached activity is reloaded from the database, so it must hold every pending delta
+    await xp_buffer.flush()
+    phase = log_timing('database init', start)
+
+    configs = {server_id: config for server_id, config in (await db.get_server_configs()).items() if is_local_guild(server_id)}
+    phase = log_timing(f'{len(configs)} server configs', phase)
+    if activity_journal and not activity_journal.has_baseline():
+        await write_journal_baseline(list(configs))
+        phase = log_timing('journal baseline', phase)
+    # The configs are always read from the database, the snapshot only replaces the users and the voice sessions
+    saved_servers = {server_id: saved for server_id, saved in (await read_snapshot() if cache_snapshot else {}).items() if server_id in configs}
+    phase = log_timing(f'cache snapshot of {len(saved_servers)} servers', phase)
+    if lazy_guilds:
+        # Only the guilds with members in voice, or in the snapshot, are loaded, so that their sessions start now
+        saved_voice_sessions.update(await db.get_voice_sessions())
+        configs = {server_id: config for server_id, config in configs.items()
+                   if server_id in saved_servers or bot.get_guild(server_id) and tracked_voice_members(bot.get_guild(server_id), config)}
+
+    # Guilds are loaded concurrently, their users are read from the reader pool
+    missing = await asyncio.gather(*[load_server(config, saved=saved_servers.get(config.id)) for config in configs.values()])
+    missing = [user for users in missing for user in users]
+    phase = log_timing('users', phase)
+    await db.add_users(missing)
+    phase = log_timing(f'{len(missing)} missing users', phase)
+
+    voice_sessions = saved_voice_sessions if lazy_guilds else await db.get_voice_sessions()
+    for server_id, saved in saved_servers.items():
+        voice_sessions.update({(server_id, user_id): update_time for user_id, update_time in saved.voice_sessions.items()})
+    for server_id in configs:
+        load_voice_states(server_id, voice_sessions)
+    await evict_servers()
+    phase = log_timing('voice states', phase)
+
+    await role_sync.resume(bot, is_local_guild)
+    if not flush_xp_buffer.is_running():
+        flush_xp_buffer.start()
+    if not checkpoint_voice_sessions.is_running():
+        checkpoint_voice_sessions.start()
+    if activity_journal and not compact_journal.is_running():
+        compact_journal.start()
+    if cache_snapshot and not snapshot_cache.is_running():
+        snapshot_cache.start()
+    role_outbox.start()
+    if metrics_port and not metrics_tasks:
+        await metrics.start_server(metrics_port)
+        metrics_tasks.append(asyncio.create_task(metrics.monitor_loop_lag()))
+    log_timing('startup', start)
     print(f'We have logged in as {bot.user}')
 
 @bot.event
+@metrics.observe_handler
 async def on_guild_join(guild: discord.Guild):
-    db.add_server(guild.id, guild.name)
-    users = [(member.name, member.id) for member in guild.members]
-    db.init_users(guild.id, users)
-    cached.add_server(db.get_server_config(guild.id))
+    await db.add_server(guild.id, guild.name)
+    # One transaction per chunk, so that a huge guild neither holds the writer nor builds the whole list at once
+    async for members in iter_member_chunks(guild):
+        await db.init_users(guild.id, [(member.name, member.id) for member in members])
+    cached.add_server(await db.get_server_config(guild.id))
+    await evict_servers()
 
 @bot.event
+@metrics.observe_handler
 async def on_guild_remove(guild: discord.Guild):
-    db.rm_server(guild.id)
+    role_sync.cancel(guild.id)
+    xp_buffer.discard(guild.id)
+    await db.rm_server(guild.id)
     cached.rm_server(guild.id)
 
 @bot.event
-async def on_member_join(member):
-    db.add_user(member.guild.id, member.id, member.name)
-    server_config = cached.get_server(member.guild.id).config
-    await update_role(member, server_config, 0)
+@metrics.observe_handler
+async def on_member_join(member: discord.Member):
+    # The row is inserted with the next buffer flush
+    server = await get_server(member.guild.id)
+    if server is None:
+        return
+    rejoined = xp_buffer.is_departed(member.guild.id, member.id)
+    await xp_buffer.add_member(member.guild.id, member.id, member.name)
+    user = server.get_user(member.id)
+    if rejoined:
+        # Back before their departure was written, the row and its XP are still there
+        _, xp, _, _, user.lastmsg_time, user.lastmsg_xp = await xp_buffer.get_user(member.guild.id, member.id)
+        server.set_user_xp(member.id, xp)
+    request_role(member, server.config, user.xp)
+
+@bot.event
+@metrics.observe_handler
+async def on_member_remove(member: discord.Member):
+    server = cached.get_server(member.guild.id)
+    if server is not None:
+        server.rm_user(member.id)
+    await xp_buffer.remove_member(member.guild.id, member.id)
 
 @bot.event
+@metrics.observe_handler
 async def on_message(message: discord.Message):
     if message.author.bot:
         return
-    server_config = cached.get_server(message.guild.id).config
-    if message.channel.id in server_config.channels['text']:
-        _, xp, msg_count, _, lastmsg_time, lastmsg_xp = db.get_user(message.guild.id, message.author.id)
-        msg_count += 1
+    server = await get_server(message.guild.id)
+    server_config = server.config
+    if message.channel.id in server_config.text_channels:
+        user = server.get_user(message.author.id)
         newmsg_time = time.time()
-        if newmsg_time - lastmsg_time >= server_config.msg_cooldown:
-            is_new_user = server_config.msg_rankthr == -1 or xp < server_config.msg_rankthr
+        if activity_journal:
+            # Every message is journaled, with another cooldown the ignored ones could be credited
+            activity_journal.add_message(message.guild.id, message.author.id, newmsg_time)
+        if newmsg_time - user.lastmsg_time >= server_config.msg_cooldown:
+            is_new_user = server_config.msg_rankthr == -1 or user.xp < server_config.msg_rankthr
             new_date = datetime.datetime.fromtimestamp(newmsg_time)
-            last_date = datetime.datetime.fromtimestamp(lastmsg_time)
+            last_date = datetime.datetime.fromtimestamp(user.lastmsg_time)
             if is_new_user or new_date.date() != last_date.date():
-                xp += server_config.rate_txt
-                lastmsg_xp = server_config.rate_txt
+                new_xp = server_config.rate_txt
             else:
-                new_xp = max(int(lastmsg_xp * server_config.msg_xpfactor), server_config.msg_xpmin)
-                xp += new_xp
-                lastmsg_xp = new_xp
-            db.update_user(message.guild.id, message.author.id, msg_count=msg_count, xp=xp, lastmsg_time=newmsg_time, lastmsg_xp=lastmsg_xp)
-            await update_role(message.author, server_config, xp)
+                new_xp = max(int(user.lastmsg_xp * server_config.msg_xpfactor), server_config.msg_xpmin)
+            server.add_user_xp(message.author.id, new_xp)
+            user.lastmsg_time = newmsg_time
+            user.lastmsg_xp = new_xp
+            await xp_buffer.add_message(message.guild.id, message.author.id, new_xp, newmsg_time, new_xp)
+            request_role(message.author, server_config, user.xp)
         else:
-            db.update_user(message.guild.id, message.author.id, msg_count=msg_count)
+            await xp_buffer.add_message(message.guild.id, message.author.id)
 
 @bot.event
+@metrics.observe_handler
 async def on_voice_state_update(member: discord.Member,
                                 before: discord.VoiceState,
                                 after: discord.VoiceState):
-    server = cached.get_server(member.guild.id)
-    # If user disconnected from voice channel and a past update exist in cached data,
-    # calculate the time spent in voice channel and update the user xp
-    if before.channel is not None and after.channel is None:
-        last_voice_update = server.get_voice_update(member.id)
-        if last_voice_update and last_voice_update.is_connected:
-            uptime = last_voice_update.uptime(cache.VoiceUpdate(member, after))
-            xp = db.add_user_xp(member.guild.id, member.id, server.config.rate_voice * uptime)
-            db.add_user_voice_uptime(member.guild.id, member.id, uptime)
-            await update_role(member, server.config, xp)
-            server.add_voice_update(member, after)
-    # If user connected to voice channel, create a new voice update
-    elif before.channel is None and after.channel is not None:
-        server.add_voice_update(member, after)
+    server = await get_server(member.guild.id)
+    # Only the time spent in tracked channels counts, moves between two tracked channels keep the session going
+    if after.channel is not None and after.channel.id in server.config.voice_channels:
+        if server.get_voice_session(member.id) is None:
+            server.start_voice_session(member.id)
+    else:
+        session = server.end_voice_session(member.id)
+        if session is not None:
+            await credit_voice(server, session, time.time())
+            request_role(member, server.config, server.get_user(member.id).xp)
 
 
 # ================================
@@ -176,31 +552,87 @@ async def on_voice_state_update(member: discord.Member,
 # ================================
 
 # User commands
-@bot.command(description="Shows the top 10 most active users of the server")
-async def leaderboard(ctx: commands.Context):
-    users = db.get_users(ctx.guild.id, 10)
+@bot.command(description="Shows the most active users of the server")
+async def leaderboard(ctx: commands.Context, page: int = 1,
+                      period: discord.Option(str, choices=['all', *PERIODS], default='all') = 'all',
+                      scope: discord.Option(str, choices=['server', 'global'], default='server') = 'server'):
+    if scope == 'global':
+        # XP over the servers that opted in, all time, the XP earned since the last buffer flush is not counted yet
+        if not (await get_server(ctx.guild.id)).config.global_leaderboard:
+            await ctx.respond("This server is not part of the global leaderboard, an administrator can join it with `/config global_leaderboard`")
+            return
+        if period != 'all':
+            await ctx.respond("The global leaderboard only ranks the XP of all time")
+            return
+        ranking = await db.get_global_leaderboard(GLOBAL_LEADERBOARD_SIZE)
+        n_pages = max(1, -(-len(ranking) // LEADERBOARD_PAGE_SIZE))
+        page = min(max(page, 1), n_pages)
+        offset = (page - 1) * LEADERBOARD_PAGE_SIZE
+        top = ranking[offset:offset + LEADERBOARD_PAGE_SIZE]
+    elif period == 'all':
+        ranking = (await get_server(ctx.guild.id)).ranking
+        n_pages = max(1, -(-len(ranking) // LEADERBOARD_PAGE_SIZE))
+        page = min(max(page, 1), n_pages)
+        offset = (page - 1) * LEADERBOARD_PAGE_SIZE
+        top = ranking.top(LEADERBOARD_PAGE_SIZE, offset)
+    else:
+        # From the daily rollups, the XP earned since the last buffer flush is not counted yet
+        since_day = datetime.date.today().toordinal() - PERIODS[period] + 1
+        page = max(page, 1)
+        n_active, top = await db.get_period_leaderboard(ctx.guild.id, since_day, LEADERBOARD_PAGE_SIZE, (page - 1) * LEADERBOARD_PAGE_SIZE)
+        n_pages = max(1, -(-n_active // LEADERBOARD_PAGE_SIZE))
+        if page > n_pages:
+            page = n_pages
+            _, top = await db.get_period_leaderboard(ctx.guild.id, since_day, LEADERBOARD_PAGE_SIZE, (page - 1) * LEADERBOARD_PAGE_SIZE)
+        offset = (page - 1) * LEADERBOARD_PAGE_SIZE
     embed = discord.Embed(
-        title="Leaderboard",
+        title="Global leaderboard" if scope == 'global' else "Leaderboard" if period == 'all' else f"Leaderboard of the {period}",
         color=0x82c778,
     )
     user_column, xp_column = [], []
-    for i, user in enumerate(users):
-        _, discord_id, xp, _, _, _, _ = user
-        user_column.append(f"`{i+1}.` <@{discord_id}>")
+    for i, (discord_id, xp) in enumerate(top):
+        user_column.append(f"`{offset+i+1}.` <@{discord_id}>")
         xp_column.append(f"`{xp}`")
 
-    embed.add_field(name="Top 10", value="\n".join(user_column), inline=True)
+    embed.add_field(name="Top 10" if page == 1 else f"Page {page}", value="\n".join(user_column), inline=True)
     embed.add_field(name="XP", value="\n".join(xp_column), inline=True)
+    embed.set_footer(text=f"Page {page}/{n_pages}")
+    await ctx.respond(embed=embed)
+
+@bot.command(description="Shows your rank on this server")
+async def rank(ctx: commands.Context, member: discord.Member = None):
+    member = member or ctx.author
+    server = await get_server(ctx.guild.id)
+    user = server.users.get(member.id)
+    if user is None:
+        await ctx.respond(f"{member.name} has no XP yet")
+        return
+    embed = discord.Embed(
+        title=f"{member.name}'s rank",
+        color=0x82c778,
+    )
+    embed.add_field(name="Rank", value=f"#{server.get_rank(member.id)} / {len(server.ranking)}")
+    embed.add_field(name="XP", value=f"{user.xp} XP")
     await ctx.respond(embed=embed)
 
 @bot.command(description="Shows your stats on this server")
-async def stats(ctx: commands.Context):
-    stats = db.get_user(ctx.guild.id, ctx.author.id)
+async def stats(ctx: commands.Context,
+                period: discord.Option(str, choices=['all', *PERIODS], default='all') = 'all'):
+    stats = await xp_buffer.get_user(ctx.guild.id, ctx.author.id)
     username, xp, msg_count, voice_uptime, _, _ = stats
     embed = discord.Embed(
         title=f"{username}'s stats",
         color=0x82c778,
     )
+    if period != 'all':
+        # From the daily rollups, the activity since the last buffer flush is not counted yet
+        history = await db.get_user_history(ctx.guild.id, ctx.author.id, datetime.date.today().toordinal() - PERIODS[period] + 1)
+        xp = sum(day[1] for day in history)
+        msg_count = sum(day[2] for day in history)
+        voice_uptime = sum(day[3] for day in history)
+        lines = [f"`{datetime.date.fromordinal(day):%m-%d}` {day_xp} XP, {day_msg} msg, {day_voice//60}h{day_voice%60:02d}"
+                 for day, day_xp, day_msg, day_voice in history]
+        embed.description = f"Activity of the {period}\n" + ("\n".join(lines) or "No activity")
     embed.add_field(name="XP", value=f"{xp} XP")
     embed.add_field(name="Texts", value=f"{msg_count} msg")
     embed.add_field(name="Vocal", value=f"{voice_uptime//60}h{voice_uptime%60:02d}")
@@ -208,7 +640,7 @@ async def stats(ctx: commands.Context):
 
 @bot.command(description="Shows the roles and the XP required to get them")
 async def info(ctx: commands.Context):
-    server_config = cached.get_server(ctx.guild.id).config
+    server_config = (await get_server(ctx.guild.id)).config
     embed = discord.Embed(
         title="Roles",
         color=0x82c778,
@@ -222,22 +654,27 @@ async def info(ctx: commands.Context):
 @bot.command()
 async def user_xp(ctx: commands.Context, member: discord.Member, xp: int):
     if await is_mod(ctx):
-        db.set_user_xp(ctx.guild.id, member.id, xp)
-        await update_role(member, db.get_server_config(ctx.guild.id), xp)
-        cached.update_server_config(db.get_server_config(ctx.guild.id))
+        server = await get_server(ctx.guild.id)
+        await xp_buffer.flush()
+        # The cache is set before the database write, so that a cache snapshot taken in between already has the new XP
+        server.set_user_xp(member.id, xp)
+        await db.set_user_xp(ctx.guild.id, member.id, xp)
+        if activity_journal:
+            activity_journal.set_xp(ctx.guild.id, member.id, xp)
+        request_role(member, server.config, xp)
         await ctx.respond('Done')
 
 
 @bot.command()
-async def refresh_roles(ctx: commands.Context):
+async def refresh_roles(ctx: commands.Context, cancel: bool = False):
     if await is_mod(ctx):
-        await ctx.send('Refreshing roles...')
-        server_config = cached.get_server(ctx.guild.id).config
-        users = db.get_users(ctx.guild.id)
-        for _, discord_id, xp, _, _, _, _ in users:
-            member = ctx.guild.get_member(discord_id)
-            await update_role(member, server_config, xp)
-        await ctx.respond('Done')
+        if cancel:
+            await ctx.respond('Cancelling' if role_sync.cancel(ctx.guild.id) else 'No role refresh is running')
+        elif role_sync.is_running(ctx.guild.id):
+            await ctx.respond('Roles are already being refreshed')
+        else:
+            await role_sync.start(ctx.guild, ctx.channel)
+            await ctx.respond('Refreshing roles in the background')
 
 
 config = bot.create_group('config', "Manage bot configuration for this server")
@@ -245,12 +682,13 @@ config = bot.create_group('config', "Manage bot configuration for this server")
 @config.command(description="Show the full bot configuration for this server")
 async def show(ctx: commands.Context):
     if await is_mod(ctx):
-        server_config = cached.get_server(ctx.guild.id).config
+        server_config = (await get_server(ctx.guild.id)).config
         embed = discord.Embed(
             title="XP Bot configuration",
             color=0x82c778,
         )
         embed.add_field(name="Mod role", value=f"<@&{server_config.mod_role}>", inline=False)
+        embed.add_field(name="Global leaderboard", value="Joined" if server_config.global_leaderboard else "Not joined", inline=False)
         embed.add_field(name=" ", value="**=== Automatic roles ===**", inline=False)
         add_role_fields(embed, server_config)
         embed.add_field(name=" ", value="**=== Tracked channels ===**", inline=False)
@@ -265,8 +703,8 @@ channel = config.create_subgroup('channel', "Manage channels")
 @channel.command(description="Add a channel to the list of channels to track")
 async def add(ctx: commands.Context, channel: discord.TextChannel | discord.VoiceChannel):
     if await is_mod(ctx):
-        db.add_channel(ctx.guild.id, channel.id, channel.type.value)
-        cached.update_server_config(db.get_server_config(ctx.guild.id))
+        await db.add_channel(ctx.guild.id, channel.id, channel.type.value)
+        (await get_server(ctx.guild.id)).config.add_channel(channel.id, channel.type.value)
         if not is_channel_visible(ctx, channel.id):
             await ctx.respond(f"Warning: I cannot see <#{channel.id}>, please check my permissions")
         await ctx.respond('Done')
@@ -274,14 +712,14 @@ async def add(ctx: commands.Context, channel: discord.TextChannel | discord.Voic
 @channel.command(description="Remove a channel from the list of channels to track")
 async def rm(ctx: commands.Context, channel: discord.TextChannel | discord.VoiceChannel):
     if await is_mod(ctx):
-        db.rm_channel(channel.id)
-        cached.update_server_config(db.get_server_config(ctx.guild.id))
+        await db.rm_channel(channel.id)
+        (await get_server(ctx.guild.id)).config.rm_channel(channel.id)
         await ctx.respond('Done')
 
 @channel.command(description="Show the list of channels to track")
 async def show(ctx: commands.Context):
     if await is_mod(ctx):
-        server_config = cached.get_server(ctx.guild.id).config
+        server_config = (await get_server(ctx.guild.id)).config
         embed = discord.Embed(
             title="Channels",
             color=0x82c778,
@@ -302,15 +740,15 @@ role = config.create_subgroup('role', "Manage automatic roles")
 @role.command(description="Add a role to the list of automatic roles")
 async def add(ctx: commands.Context, role: discord.Role, xp_threshold: int):
     if await is_mod(ctx):
-        db.set_role(ctx.guild.id, role.id, xp_threshold)
-        cached.update_server_config(db.get_server_config(ctx.guild.id))
+        await db.set_role(ctx.guild.id, role.id, xp_threshold)
+        (await get_server(ctx.guild.id)).config.set_role(role.id, xp_threshold)
         await ctx.respond('Done')
 
 @role.command(description="Remove a role from the list of automatic roles")
 async def rm(ctx: commands.Context, role: discord.Role):
     if await is_mod(ctx):
-        db.rm_role(role.id)
-        cached.update_server_config(db.get_server_config(ctx.guild.id))
+        await db.rm_role(role.id)
+        (await get_server(ctx.guild.id)).config.rm_role(role.id)
         await ctx.respond('Done')
 
 @role.command(description="Show the list of automatic roles")
@@ -324,21 +762,21 @@ rate = config.create_subgroup('rate', "Manage XP rate")
 @rate.command(description="Set the XP rate for text channel. Check documentation for more info")
 async def text(ctx: commands.Context, base_xp_per_msg: int, cooldown_in_sec: int = 0, xp_factor: float = 1, min_xp: int = 1, rank_xp_threshold: int = -1):
     if await is_mod(ctx):
-        db.set_xp_rate_text(ctx.guild.id, base_xp_per_msg, cooldown_in_sec, rank_xp_threshold, xp_factor, min_xp)
-        cached.update_server_config(db.get_server_config(ctx.guild.id))
+        await db.set_xp_rate_text(ctx.guild.id, base_xp_per_msg, cooldown_in_sec, rank_xp_threshold, xp_factor, min_xp)
+        (await get_server(ctx.guild.id)).config.set_xp_rate_text(base_xp_per_msg, cooldown_in_sec, rank_xp_threshold, xp_factor, min_xp)
         await ctx.respond('Done')
 
 @rate.command(description="Set the XP rate for voice channels")
 async def voice(ctx: commands.Context, xp_per_minute: int):
     if await is_mod(ctx):
-        db.set_xp_rate_voice(ctx.guild.id, xp_per_minute)
-        cached.update_server_config(db.get_server_config(ctx.guild.id))
+        await db.set_xp_rate_voice(ctx.guild.id, xp_per_minute)
+        (await get_server(ctx.guild.id)).config.set_xp_rate_voice(xp_per_minute)
         await ctx.respond('Done')
 
 @rate.command(description="Show the XP rate for text and voice channels")
 async def show(ctx: commands.Context):
     if await is_mod(ctx):
-        server_config = cached.get_server(ctx.guild.id).config
+        server_config = (await get_server(ctx.guild.id)).config
         embed = discord.Embed(
             title="XP rate",
             color=0x82c778,
@@ -348,11 +786,40 @@ async def show(ctx: commands.Context):
 
 
 # Admin commands
+@config.command(description="Profile the bot for a few seconds, owner only")
+async def profile(ctx: commands.Context, seconds: int = 30):
+    global profile_session
+    if not await bot.is_owner(ctx.author):
+        await ctx.respond('You must be the owner of the bot to use this command')
+    elif profile_session is not None:
+        await ctx.respond('A profiling session is already running')
+    else:
+        # Follow-ups must be sent within the 15 minutes of the interaction
+        seconds = min(max(seconds, 1), 600)
+        try:
+            # Set before the first await, so that a second /profile sees it, and cleared whatever fails
+            profile_session = profiling.ProfileSession(seconds)
+            await ctx.respond(f'Profiling for {seconds} seconds...')
+            await profile_session.run()
+            await ctx.send_followup(f'Profile written to `{profile_session.profile_path}`',
+                                    file=discord.File(profile_session.summary_path))
+        finally:
+            profile_session = None
+
 @config.command()
 async def mod_role(ctx: commands.Context, role: discord.Role):
     if ctx.author.guild_permissions.administrator:
-        db.set_mod_role(ctx.guild.id, role.id)
-        cached.update_server_config(db.get_server_config(ctx.guild.id))
+        await db.set_mod_role(ctx.guild.id, role.id)
+        (await get_server(ctx.guild.id)).config.set_mod_role(role.id)
+        await ctx.respond('Done')
+    else:
+        await ctx.respond('You must be an administrator to use this command')
+
+@config.command(description="Join or leave the global leaderboard shared with the other servers")
+async def global_leaderboard(ctx: commands.Context, enabled: bool):
+    if ctx.author.guild_permissions.administrator:
+        await db.set_global_leaderboard(ctx.guild.id, enabled)
+        (await get_server(ctx.guild.id)).config.set_global_leaderboard(enabled)
         await ctx.respond('Done')
     else:
         await ctx.respond('You must be an administrator to use this command')
@@ -360,4 +827,4 @@ async def mod_role(ctx: commands.Context, role: discord.Role):
 
 if __name__ == '__main__':
     bot.run(token)
-    on_exit()
+    asyncio.run(on_exit())
@@ -0,0 +1,386 @@
+import os
+import time
+import pickle
+import functools
+import threading
+from discord.enums import ChannelType
+from sortedcontainers import SortedList
+
+import cache
+import data
+
+SNAPSHOT_PATH = 'data/memory.pickle'
+SNAPSHOT_VERSION = 1
+
+# Columns of a server and defaults of a new one, as in the servers table
+SERVER_DEFAULTS = (1, 1, 0, 0, -1, 1.0, 1, 0)
+GLOBAL_LEADERBOARD = 8
+
+
+def _locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class MemoryDatabase(data.Storage):
+    """Storage engine keeping everything in dicts, for tests, benchmarks and small deployments.
+
+    If a path is given, the data is loaded from it and written back on close, and at most every
+    snapshot_interval seconds after a write. A crash loses the writes made since the last snapshot.
+    """
+    thread_safe = True
+
+    def __init__(self, path: str | None = None, snapshot_interval: float = 60):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.RLock()
+        self.last_snapshot = time.monotonic()
+        # servers: {id: [name, xprate_msg, xprate_voice, mod_role, msg_cooldown, msg_rankthreshold, msg_xpfactor, msg_xpmin, global_leaderboard]}
+        self.servers: dict[int:list] = {}
+        # users: {server_id: {discord_id: [username, xp, msg_count, voice_uptime, lastmsg_time, lastmsg_xp]}}
+        self.users: dict[int:dict[int:list]] = {}
+        self.roles: dict[int:tuple[int, int]] = {}          # {id: (server_id, xp_threshold)}
+        self.channels: dict[int:tuple[int, int]] = {}       # {id: (server_id, type)}
+        self.role_syncs: dict[int:tuple[int, int]] = {}     # {server_id: (channel_id, cursor)}
+        self.voice_sessions: dict[tuple[int, int]:float] = {}
+        # daily: {server_id: {discord_id: {day: [xp, msg_count, voice_uptime]}}}
+        self.daily: dict[int:dict[int:dict[int:list]]] = {}
+        self.cache_snapshots: dict[str:int | None] = {}
+        # Totals over the servers that opted in, as the global_users table: {discord_id: [xp, msg_count, voice_uptime, n_servers]},
+        # rebuilt from users when a snapshot is loaded, and ranked by (-xp, discord_id)
+        self.global_users: dict[int:list] = {}
+        self.global_ranking = SortedList()
+
+
+    # ================================
+    # Snapshots
+    # ================================
+
+    @_locked
+    def init(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as file:
+            snapshot = pickle.load(file)
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise Exception('Snapshot version is unknown')
+        for name in ('servers', 'users', 'roles', 'channels', 'role_syncs', 'voice_sessions', 'daily'):
+            setattr(self, name, snapshot[name])
+        self.cache_snapshots = snapshot.get('cache_snapshots', {})
+        # Snapshots written before a column was added get its default
+        for server in self.servers.values():
+            server.extend(SERVER_DEFAULTS[len(server) - 1:])
+        self.global_users = {}
+        self.global_ranking = SortedList()
+        for server_id, users in self.users.items():
+            for user_id, (_, xp, msg_count, voice_uptime, _, _) in users.items():
+                self._add_global(server_id, user_id, xp, msg_count, voice_uptime, 1)
+
+    @_locked
+    def snapshot(self) -> None:
+        # Written to a temporary file first so that a crash never leaves a partial snapshot
+        if not self.path:
+            return
+        snapshot = {'version': SNAPSHOT_VERSION, 'servers': self.servers, 'users': self.users, 'roles': self.roles, 'channels': self.channels,
+                    'role_syncs': self.role_syncs, 'voice_sessions': self.voice_sessions, 'daily': self.daily,
+                    'cache_snapshots': self.cache_snapshots}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(snapshot, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.last_snapshot = time.monotonic()
+
+    def _written(self):
+        if self.path and time.monotonic() - self.last_snapshot >= self.snapshot_interval:
+            self.snapshot()
+
+    def close(self) -> None:
+        self.snapshot()
+
+
+    # ================================
+    # Servers
+    # ================================
+
+    @_locked
+    def add_server(self, server_id: int, server_name: str) -> None:
+        if server_id in self.servers:
+            raise ValueError(f'Server {server_id} already exists')
+        self.servers[server_id] = [server_name, *SERVER_DEFAULTS]
+        self._written()
+
+    @_locked
+    def rm_server(self, server_id: int) -> None:
+        for user_id, (_, xp, msg_count, voice_uptime, _, _) in self.users.pop(server_id, {}).items():
+            self._add_global(server_id, user_id, -xp, -msg_count, -voice_uptime, -1)
+        self.servers.pop(server_id, None)
+        self.daily.pop(server_id, None)
+        self.role_syncs.pop(server_id, None)
+        self.roles = {role_id: role for role_id, role in self.roles.items() if role[0] != server_id}
+        self.channels = {channel_id: channel for channel_id, channel in self.channels.items() if channel[0] != server_id}
+        self.voice_sessions = {key: update_time for key, update_time in self.voice_sessions.items() if key[0] != server_id}
+        self._written()
+
+    @_locked
+    def get_servers(self) -> list[int]:
+        return sorted(self.servers)
+
+    def _server_config(self, server_id: int, roles: list[tuple[int, int]], channels: dict[str:list[int]]) -> cache.ServerConfig:
+        return cache.ServerConfig(server_id, *self.servers[server_id], roles, channels)
+
+    @_locked
+    def get_server_config(self, server_id: int) -> cache.ServerConfig | None:
+        if server_id not in self.servers:
+            return None
+        roles = sorted(((role_id, xp_threshold) for role_id, (role_server, xp_threshold) in self.roles.items() if role_server == server_id),
+                       key=lambda role: (role[1], role[0]))
+        channels = {'text': [], 'voice': []}
+        for channel_id, (channel_server, channel_type) in sorted(self.channels.items()):
+            if channel_server == server_id and channel_type in (ChannelType.text.value, ChannelType.voice.value):
+                channels[cache.CHANNEL_KINDS[channel_type]].append(channel_id)
+        return self._server_config(server_id, roles, channels)
+
+    @_locked
+    def get_server_configs(self) -> dict[int:cache.ServerConfig]:
+        roles = {}
+        for role_id, (server_id, xp_threshold) in sorted(self.roles.items(), key=lambda role: (role[1][1], role[0])):
+            roles.setdefault(server_id, []).append((role_id, xp_threshold))
+        channels = {}
+        for channel_id, (server_id, channel_type) in sorted(self.channels.items()):
+            if channel_type in cache.CHANNEL_KINDS:
+                channels.setdefault(server_id, {'text': [], 'voice': []})[cache.CHANNEL_KINDS[channel_type]].append(channel_id)
+        return {server_id: self._server_config(server_id, roles.get(server_id, []), channels.get(server_id, {'text': [], 'voice': []}))
+                for server_id in sorted(self.servers)}
+
+    @_locked
+    def set_xp_rate_text(self, server_id: int, xp_rate: int, msg_cooldown: int, msg_rankthr: int, msg_xpfactor: float, msg_xpmin: int) -> None:
+        if server_id in self.servers:
+            self.servers[server_id][1] = xp_rate
+            self.servers[server_id][4:8] = [msg_cooldown, msg_rankthr, msg_xpfactor, msg_xpmin]
+            self._written()
+
+    @_locked
+    def set_xp_rate_voice(self, server_id: int, xp_rate: int) -> None:
+        if server_id in self.servers:
+            self.servers[server_id][2] = xp_rate
+            self._written()
+
+    @_locked
+    def set_mod_role(self, server_id: int, role_id: int) -> None:
+        if server_id in self.servers:
+            self.servers[server_id][3] = role_id
+            self._written()
+
+    @_locked
+    def set_global_leaderboard(self, server_id: int, enabled: bool) -> None:
+        server = self.servers.get(server_id)
+        if server is None or bool(server[GLOBAL_LEADERBOARD]) == enabled:
+            return
+        # The totals of the server are taken out while it still counts, and added once it does
+        if not enabled:
+            self._add_server_global(server_id, -1)
+        server[GLOBAL_LEADERBOARD] = int(enabled)
+        if enabled:
+            self._add_server_global(server_id, 1)
+        self._written()
+
+
+    # ================================
+    # Roles, channels and role syncs
+    # ================================
+
+    @_locked
+    def set_role(self, server_id: int, role_id: int, xp_threshold: int) -> None:
+        # An existing role only gets its new threshold
+        if role_id in self.roles:
+            server_id = self.roles[role_id][0]
+        self.roles[role_id] = (server_id, xp_threshold)
+        self._written()
+
+    @_locked
+    def rm_role(self, role_id: int) -> None:
+        self.roles.pop(role_id, None)
+        self._written()
+
+    @_locked
+    def add_channel(self, server_id: int, channel_id: int, channel_type: int) -> None:
+        if channel_id in self.channels:
+            raise ValueError(f'Channel {channel_id} already exists')
+        self.channels[channel_id] = (server_id, channel_type)
+        self._written()
+
+    @_locked
+    def rm_channel(self, channel_id: int) -> None:
+        self.channels.pop(channel_id, None)
+        self._written()
+
+    @_locked
+    def get_role_syncs(self) -> list[tuple[int, int, int]]:
+        return [(server_id, channel_id, cursor) for server_id, (channel_id, cursor) in sorted(self.role_syncs.items())]
+
+    @_locked
+    def set_role_sync(self, server_id: int, channel_id: int, cursor: int) -> None:
+        self.role_syncs[server_id] = (channel_id, cursor)
+        self._written()
+
+    @_locked
+    def rm_role_sync(self, server_id: int) -> None:
+        self.role_syncs.pop(server_id, None)
+        self._written()
+
+
+    # ================================
+    # Users
+    # ================================
+
+    def _add_global(self, server_id: int, user_id: int, xp: int, msg_count: int, voice_uptime: int, n_servers: int = 0):
+        server = self.servers.get(server_id)
+        if server is None or not server[GLOBAL_LEADERBOARD]:
+            return
+        total = self.global_users.get(user_id)
+        if total is None:
+            total = self.global_users[user_id] = [0, 0, 0, 0]
+        else:
+            self.global_ranking.remove((-total[0], user_id))
+        total[0] += xp
+        total[1] += msg_count
+        total[2] += voice_uptime
+        total[3] += n_servers
+        if total[3] > 0:
+            self.global_ranking.add((-total[0], user_id))
+        else:
+            del self.global_users[user_id]
+
+    def _add_server_global(self, server_id: int, sign: int):
+        for user_id, (_, xp, msg_count, voice_uptime, _, _) in self.users.get(server_id, {}).items():
+            self._add_global(server_id, user_id, sign * xp, sign * msg_count, sign * voice_uptime, sign)
+
+    def _add_user(self, server_id: int, user_id: int, username: str):
+        users = self.users.setdefault(server_id, {})
+        if user_id not in users:
+            users[user_id] = [username, 0, 0, 0, 0, 0]
+            self._add_global(server_id, user_id, 0, 0, 0, 1)
+
+    def _set_xp(self, server_id: int, user: list, user_id: int, xp: int):
+        self._add_global(server_id, user_id, xp - user[1], 0, 0)
+        user[1] = xp
+
+    def _rm_user(self, server_id: int, user_id: int):
+        user = self.users.get(server_id, {}).pop(user_id, None)
+        if user is not None:
+            self._add_global(server_id, user_id, -user[1], -user[2], -user[3], -1)
+        self.daily.get(server_id, {}).pop(user_id, None)
+
+    @_locked
+    def init_users(self, server_id: int, users: list[tuple[str, int]]) -> None:
+        for username, user_id in users:
+            self._add_user(server_id, user_id, username)
+        self._written()
+
+    @_locked
+    def add_users(self, users: list[tuple[str, int, int]]) -> None:
+        for username, user_id, server_id in users:
+            self._add_user(server_id, user_id, username)
+        self._written()
+
+    @_locked
+    def rm_user(self, server_id: int, user_id: int) -> None:
+        self._rm_user(server_id, user_id)
+        self.cache_snapshots.clear()
+        self._written()
+
+    @_locked
+    def set_user_xp(self, server_id: int, user_id: int, xp: int) -> None:
+        user = self.users.get(server_id, {}).get(user_id)
+        if user is not None:
+            self._set_xp(server_id, user, user_id, xp)
+        self.cache_snapshots.clear()
+        self._written()
+
+    @_locked
+    def get_user(self, server_id: int, user_id: int) -> tuple | None:
+        user = self.users.get(server_id, {}).get(user_id)
+        return tuple(user) if user is not None else None
+
+    @_locked
+    def get_users(self, server_id: int, n_users: int = None) -> list[tuple]:
+        users = sorted(self.users.get(server_id, {}).items(), key=lambda user: -user[1][1])
+        return [(username, user_id, *values) for user_id, (username, *values) in users[:n_users or None]]
+
+    @_locked
+    def update_users(self, rows: list[tuple], voice_sessions: list[tuple[int, int, float]] | None = None,
+                     new_users: list[tuple[str, int, int]] = (), departed_users: list[tuple[int, int]] = (),
+                     voice_servers: list[int] | None = None, snapshot: tuple[str, int | None] | None = None) -> None:
+        # Same arguments as data.Database.update_users
+        for username, user_id, server_id in new_users:
+            self._add_user(server_id, user_id, username)
+        for xp, msg_count, voice_uptime, lastmsg_time, lastmsg_xp, server_id, user_id, day in rows:
+            user = self.users.get(server_id, {}).get(user_id)
+            if user is not None:
+                user[1] += xp
+                user[2] += msg_count
+                user[3] += voice_uptime
+                self._add_global(server_id, user_id, xp, msg_count, voice_uptime)
+                if lastmsg_time is not None:
+                    user[4] = lastmsg_time
+                if lastmsg_xp is not None:
+                    user[5] = lastmsg_xp
+            daily = self.daily.setdefault(server_id, {}).setdefault(user_id, {}).setdefault(day, [0, 0, 0])
+            daily[0] += xp
+            daily[1] += msg_count
+            daily[2] += voice_uptime
+        if voice_sessions is not None:
+            if voice_servers is None:
+                self.voice_sessions = {}
+            else:
+                voice_servers = set(voice_servers)
+                self.voice_sessions = {key: update_time for key, update_time in self.voice_sessions.items() if key[0] not in voice_servers}
+            for server_id, user_id, update_time in voice_sessions:
+                self.voice_sessions[(server_id, user_id)] = update_time
+        for server_id, user_id in departed_users:
+            self._rm_user(server_id, user_id)
+        if snapshot is None:
+            self.cache_snapshots.clear()
+        else:
+            self.cache_snapshots[snapshot[0]] = snapshot[1]
+        self._written()
+
+    @_locked
+    def set_users_xp(self, rows: list[tuple[int, float, int, int, int]]) -> None:
+        for xp, lastmsg_time, lastmsg_xp, server_id, user_id in rows:
+            user = self.users.get(server_id, {}).get(user_id)
+            if user is not None:
+                self._set_xp(server_id, user, user_id, xp)
+                user[4], user[5] = lastmsg_time, lastmsg_xp
+        self.cache_snapshots.clear()
+        self._written()
+
+    @_locked
+    def get_period_leaderboard(self, server_id: int, since_day: int, n_users: int, offset: int = 0) -> tuple[int, list[tuple[int, int]]]:
+        period_xp = []
+        for user_id, days in self.daily.get(server_id, {}).items():
+            xp = [day_xp for day, (day_xp, _, _) in days.items() if day >= since_day]
+            if xp:
+                period_xp.append((user_id, sum(xp)))
+        period_xp.sort(key=lambda user: (-user[1], user[0]))
+        return len(period_xp), period_xp[offset:offset + n_users]
+
+    @_locked
+    def get_user_history(self, server_id: int, user_id: int, since_day: int) -> list[tuple[int, int, int, int]]:
+        days = self.daily.get(server_id, {}).get(user_id, {})
+        return [(day, *days[day]) for day in sorted(days) if day >= since_day]
+
+    @_locked
+    def get_global_leaderboard(self, n_users: int, offset: int = 0) -> list[tuple[int, int]]:
+        return [(user_id, -xp) for xp, user_id in self.global_ranking.islice(offset, offset + n_users)]
+
+    @_locked
+    def get_voice_sessions(self) -> dict[tuple[int, int]:float]:
+        return dict(self.voice_sessions)
+
+    @_locked
+    def get_snapshot_token(self, name: str) -> int | None:
+        return self.cache_snapshots.get(name)
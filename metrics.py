@@ -0,0 +1,179 @@
+"""In-process metrics, served in the Prometheus text exposition format by an optional local HTTP endpoint."""
+import time
+import asyncio
+import logging
+import functools
+import threading
+from aiohttp import web
+
+
+class Metric():
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # Updated from the database threads as well as from the event loop
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key: tuple, extra: dict | None = None) -> str:
+        pairs = list(zip(self.labels, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{value}"' for label, value in pairs) + '}'
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}', *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple:float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f'{self.name}{self._format_labels(key)} {value}' for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, function=None):
+        # A gauge with a function is read when the metrics are collected
+        super().__init__(name, help)
+        self.value: float = 0
+        self.function = function
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self) -> list[str]:
+        value = self.function() if self.function else self.value
+        return [f'{self.name} {value}']
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Per label values: count of each bucket (not cumulative), then sum and count
+        self.values: dict[tuple:list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [[0] * len(self.buckets), 0, 0]
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    values[0][i] += 1
+                    break
+            values[1] += value
+            values[2] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for key, (buckets, total, count) in self.values.items():
+                cumulated = 0
+                for bucket, n in zip(self.buckets, buckets):
+                    cumulated += n
+                    lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": bucket})} {cumulated}')
+                lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": "+Inf"})} {count}')
+                lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{self._format_labels(key)} {count}')
+        return lines
+
+
+REGISTRY: list[Metric] = []
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+# ================================
+# Metrics
+# ================================
+
+HANDLER_SECONDS = Histogram('xpbot_handler_seconds', "Duration of the event handlers", ('event',))
+HANDLER_ERRORS = Counter('xpbot_handler_errors_total', "Exceptions raised by the event handlers", ('event',))
+DB_CALL_SECONDS = Histogram('xpbot_db_call_seconds', "Duration of the database methods, on the database threads", ('method',))
+DB_COMMITS = Counter('xpbot_db_commits_total', "Write transactions committed to the database")
+CACHE_LOOKUPS = Counter('xpbot_cache_lookups_total', "Server lookups in the cached data", ('result',))
+REST_CALLS = Counter('xpbot_rest_calls_total', "Discord REST calls made by the bot", ('route',))
+REST_RATE_LIMITS = Counter('xpbot_rest_rate_limits_total', "429 responses from Discord", ('source',))
+LOOP_LAG_SECONDS = Histogram('xpbot_loop_lag_seconds', "Delay of the event loop in waking up a sleeping task")
+ROLE_UPDATES = Counter('xpbot_role_updates_total', "Role update requests by outcome", ('result',))
+ROLE_UPDATE_SECONDS = Histogram('xpbot_role_update_seconds', "Time from the first role request of a member to its update")
+
+
+def observe_handler(function):
+    # Wraps an event handler to time it, the wrapper keeps the name used by bot.event
+    event = function.__name__
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(event=event)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, event=event)
+    return wrapper
+
+
+class RateLimitLogHandler(logging.Handler):
+    # discord.py retries 429 responses by itself and only logs them
+    def emit(self, record: logging.LogRecord):
+        if isinstance(record.msg, str) and record.msg.startswith('We are being rate limited'):
+            REST_RATE_LIMITS.inc(source='discord.http')
+
+logging.getLogger('discord.http').addHandler(RateLimitLogHandler(logging.WARNING))
+
+
+async def monitor_loop_lag(interval: float = 1):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0, time.perf_counter() - start - interval))
+
+
+# ================================
+# Exporter
+# ================================
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def start_server(port: int, host: str = '127.0.0.1') -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,103 @@
+import time
+import asyncio
+import discord
+from typing import Awaitable, Callable
+
+import cache
+import metrics
+import rolesync
+
+MAX_RETRIES = 4
+
+
+class RoleRequest():
+    __slots__ = ('member', 'server_config', 'xp', 'request_time')
+
+    def __init__(self, member: discord.Member, server_config: cache.ServerConfig, xp: int, request_time: float):
+        self.member = member
+        self.server_config = server_config
+        self.xp = xp
+        self.request_time = request_time
+
+
+class RoleOutbox():
+    """Role updates applied in the background by a pool of workers, only the last request of a member is applied."""
+
+    def __init__(self,
+                 update_role: Callable[[discord.Member, cache.ServerConfig, int], Awaitable[bool]],
+                 workers: int = 4,
+                 limiter: rolesync.RateLimiter | None = None):
+        self.update_role = update_role
+        self.n_workers = workers
+        self.limiter = limiter
+        self.pending: dict[tuple[int, int], RoleRequest] = {}
+        # A member is in the queue at most once and is never applied by two workers at the same time
+        self.queue: asyncio.Queue[tuple[int, int]] = asyncio.Queue()
+        self.in_flight: set[tuple[int, int]] = set()
+        self.workers: list[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def has_request(self, member: discord.Member) -> bool:
+        # A request of the member is waiting or being applied
+        key = (member.guild.id, member.id)
+        return key in self.pending or key in self.in_flight
+
+    def request(self, member: discord.Member, server_config: cache.ServerConfig, xp: int):
+        key = (member.guild.id, member.id)
+        previous = self.pending.get(key)
+        if previous is not None:
+            # The replaced request keeps its time, the latency covers the whole wait of the member
+            self.pending[key] = RoleRequest(member, server_config, xp, previous.request_time)
+            metrics.ROLE_UPDATES.inc(result='superseded')
+            return
+        self.pending[key] = RoleRequest(member, server_config, xp, time.perf_counter())
+        if key not in self.in_flight:
+            self.queue.put_nowait(key)
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._work()) for _ in range(self.n_workers)]
+
+    async def join(self):
+        # Waits until every request made so far is applied
+        await self.queue.join()
+
+    async def _apply(self, request: RoleRequest) -> str:
+        member = request.member
+        if member.guild.get_member(member.id) is None:
+            return 'departed'
+        for attempt in range(MAX_RETRIES):
+            if self.limiter is not None:
+                await self.limiter.acquire()
+            try:
+                return 'applied' if await self.update_role(member, request.server_config, request.xp) else 'unchanged'
+            except discord.HTTPException as e:
+                # Rate limits that discord.py gave up on and server errors are retried, other errors are final
+                if (e.status != 429 and e.status < 500) or attempt == MAX_RETRIES - 1:
+                    print(f'Could not set the role of {member.id} in {member.guild.id}: {e}')
+                    return 'failed'
+                await asyncio.sleep(2 ** attempt)
+
+    async def _work(self):
+        while True:
+            key = await self.queue.get()
+            request = self.pending.pop(key, None)
+            if request is None:
+                self.queue.task_done()
+                continue
+            self.in_flight.add(key)
+            try:
+                result = await self._apply(request)
+            except Exception as e:
+                print(f'Role update of {key[1]} in {key[0]} failed: {e!r}')
+                result = 'failed'
+            finally:
+                self.in_flight.discard(key)
+                # A request made while this one was applied waits for it to be done
+                if key in self.pending:
+                    self.queue.put_nowait(key)
+                self.queue.task_done()
+            metrics.ROLE_UPDATES.inc(result=result)
+            metrics.ROLE_UPDATE_SECONDS.observe(time.perf_counter() - request.request_time)
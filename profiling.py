@@ -0,0 +1,63 @@
+"""Profiling sessions captured from the running bot."""
+import io
+import os
+import time
+import pstats
+import asyncio
+import cProfile
+
+PROFILES_DIR = 'data/profiles'
+TOP_FUNCTIONS = 30
+
+
+class ProfileSession():
+    def __init__(self, duration: float, directory: str = PROFILES_DIR):
+        self.duration = duration
+        self.directory = directory
+        self.name = time.strftime('profile-%Y%m%d-%H%M%S')
+        self.profiler = cProfile.Profile()
+
+    @property
+    def profile_path(self) -> str:
+        return os.path.join(self.directory, f'{self.name}.prof')
+
+    @property
+    def summary_path(self) -> str:
+        return os.path.join(self.directory, f'{self.name}.txt')
+
+    async def run(self) -> str:
+        # The profiler only sees the event loop thread, which is where the handlers run
+        tasks_start = capture_tasks()
+        self.profiler.enable()
+        try:
+            await asyncio.sleep(self.duration)
+        finally:
+            self.profiler.disable()
+        tasks_end = capture_tasks()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.profiler.dump_stats(self.profile_path)
+        summary = self.summary()
+        with open(self.summary_path, 'w') as file:
+            file.write(summary)
+            file.write('\n\n=== Tasks at start ===\n\n')
+            file.write(tasks_start)
+            file.write('\n\n=== Tasks at end ===\n\n')
+            file.write(tasks_end)
+        return summary
+
+    def summary(self, n_functions: int = TOP_FUNCTIONS) -> str:
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(n_functions)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(n_functions)
+        return stream.getvalue()
+
+
+def capture_tasks() -> str:
+    stream = io.StringIO()
+    for task in asyncio.all_tasks():
+        stream.write(f'{task!r}\n')
+        task.print_stack(limit=20, file=stream)
+        stream.write('\n')
+    return stream.getvalue()
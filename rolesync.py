@@ -0,0 +1,163 @@
+import time
+import asyncio
+import discord
+from typing import Awaitable, Callable
+
+import cache
+import storage
+
+CHUNK_SIZE = 100
+PROGRESS_INTERVAL = 10
+MAX_RETRIES = 3
+
+
+class RateLimiter():
+    """Token bucket shared by the role assignments that are not part of a sync, such as the ones of new members."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens: float = burst
+        self.update_time: float = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.update_time) * self.rate)
+            self.update_time = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.update_time = time.monotonic()
+                self.tokens = 1
+            self.tokens -= 1
+
+
+class RoleSyncJob():
+    def __init__(self, guild: discord.Guild, channel: discord.abc.Messageable | None, cursor: int):
+        self.guild = guild
+        self.channel = channel
+        # Members are processed by increasing id, every member up to the cursor is done
+        self.cursor: int = cursor
+        self.total: int = 0
+        self.done: int = 0
+        self.updated: int = 0
+        self.failed: int = 0
+        self.cancelled: bool = False
+        self.task: asyncio.Task | None = None
+
+    def progress(self) -> str:
+        return f"{self.done}/{self.total} members checked, {self.updated} updated, {self.failed} failed"
+
+
+class RoleSync():
+    """Background role refresh of whole guilds, resumable after a restart."""
+
+    def __init__(self,
+                 db: storage.AsyncDatabase,
+                 get_server: Callable[[int], Awaitable[cache.CachedServer | None]],
+                 update_role: Callable[[discord.Member, cache.ServerConfig, int], Awaitable[bool]],
+                 concurrency: int = 4):
+        self.db = db
+        self.get_server = get_server
+        self.update_role = update_role
+        # Shared by every job so that the REST calls in flight stay bounded
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.jobs: dict[int:RoleSyncJob] = {}
+
+    def is_running(self, guild_id: int) -> bool:
+        return guild_id in self.jobs
+
+    async def start(self, guild: discord.Guild, channel: discord.abc.Messageable | None, cursor: int = 0) -> RoleSyncJob:
+        job = RoleSyncJob(guild, channel, cursor)
+        self.jobs[guild.id] = job
+        await self.db.set_role_sync(guild.id, channel.id if channel else 0, cursor)
+        if job.cancelled:
+            # Cancelled while it was being saved, it never starts
+            del self.jobs[guild.id]
+            await self.db.rm_role_sync(guild.id)
+            return job
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    def cancel(self, guild_id: int) -> bool:
+        job = self.jobs.get(guild_id)
+        if job is None:
+            return False
+        job.cancelled = True
+        # A job still being saved has no task yet, start sees it cancelled
+        if job.task is not None:
+            job.task.cancel()
+        return True
+
+    async def resume(self, bot: discord.Bot, is_local: Callable[[int], bool] = lambda server_id: True):
+        # is_local tells the guilds of this process apart in a sharded deployment, the jobs of the others are left alone
+        for server_id, channel_id, cursor in await self.db.get_role_syncs():
+            if not is_local(server_id):
+                continue
+            guild = bot.get_guild(server_id)
+            if guild is None:
+                await self.db.rm_role_sync(server_id)
+            elif not self.is_running(server_id):
+                await self.start(guild, bot.get_channel(channel_id), cursor)
+
+    async def _report(self, job: RoleSyncJob, message: discord.Message | None, content: str):
+        if message is None:
+            print(f"[{job.guild.name}] {content}")
+            return
+        try:
+            await message.edit(content=content)
+        except discord.HTTPException:
+            pass
+
+    async def _update_member(self, job: RoleSyncJob, server: cache.CachedServer, member: discord.Member):
+        async with self.semaphore:
+            for attempt in range(MAX_RETRIES):
+                try:
+                    if await self.update_role(member, server.config, server.get_user(member.id).xp):
+                        job.updated += 1
+                    return
+                except discord.HTTPException as e:
+                    # discord.py already waits on rate limit buckets, a 429 here means its own retries ran out
+                    if e.status != 429 or attempt == MAX_RETRIES - 1:
+                        job.failed += 1
+                        return
+                    await asyncio.sleep(2 ** attempt)
+
+    async def _run(self, job: RoleSyncJob):
+        message = None
+        # Everything runs in the try so that a failed or cancelled start still releases the guild
+        try:
+            server = await self.get_server(job.guild.id)
+            if server is None:
+                # The guild is gone, the job would otherwise come back on every start
+                await self.db.rm_role_sync(job.guild.id)
+                return
+            members = sorted((member for member in job.guild.members if member.id > job.cursor), key=lambda member: member.id)
+            job.total = len(members)
+            if job.channel is not None:
+                try:
+                    message = await job.channel.send(f"Refreshing roles... {job.progress()}")
+                except discord.HTTPException:
+                    pass
+
+            last_report = time.monotonic()
+            for i in range(0, len(members), CHUNK_SIZE):
+                chunk = members[i:i+CHUNK_SIZE]
+                await asyncio.gather(*[self._update_member(job, server, member) for member in chunk])
+                job.done += len(chunk)
+                job.cursor = chunk[-1].id
+                await self.db.set_role_sync(job.guild.id, job.channel.id if job.channel else 0, job.cursor)
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(job, message, f"Refreshing roles... {job.progress()}")
+            await self.db.rm_role_sync(job.guild.id)
+            await self._report(job, message, f"Roles refreshed: {job.progress()}")
+        except asyncio.CancelledError:
+            # A job stopped by a shutdown stays in the database to be resumed
+            if job.cancelled:
+                await self.db.rm_role_sync(job.guild.id)
+                await self._report(job, message, f"Role refresh cancelled: {job.progress()}")
+            raise
+        finally:
+            del self.jobs[job.guild.id]
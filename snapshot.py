@@ -0,0 +1,128 @@
+"""Binary snapshot of the cached activity and voice sessions, for warm restarts.
+
+A snapshot holds, for each cached server, the columns of its users (id, XP, last message time and XP)
+and of its voice sessions (id, time credited up to). It is written along with a buffer flush that stores
+its token in the database, in the same transaction. Every later write to the users clears the token,
+so a snapshot is only used while the database holds its token, and never differs from the database.
+"""
+import os
+import gc
+import sys
+import mmap
+import array
+import struct
+import zlib
+import operator
+
+import cache
+
+SNAPSHOT_PATH = 'data/cache.snap'
+
+MAGIC = b'XPS1'
+VERSION = 1
+# Magic, version, token, write time, number of servers, CRC32 of everything after the header
+HEADER = struct.Struct('<4sHqdII')
+# Server id, number of users, number of voice sessions, then one array per column
+SERVER_HEADER = struct.Struct('<QII')
+USER_COLUMNS = (('user_id', 'Q'), ('xp', 'q'), ('lastmsg_time', 'd'), ('lastmsg_xp', 'q'))
+SESSION_COLUMNS = (('user_id', 'Q'), ('update_time', 'd'))
+
+
+class ServerSnapshot():
+    __slots__ = ('users', 'ranking', 'voice_sessions')
+
+    def __init__(self, users: dict[int:cache.UserActivity], ranking: cache.Ranking, voice_sessions: dict[int:float]):
+        self.users = users
+        self.ranking = ranking
+        self.voice_sessions = voice_sessions
+
+
+class Snapshot():
+    def __init__(self, token: int, write_time: float, servers: dict[int:ServerSnapshot]):
+        self.token = token
+        self.write_time = write_time
+        self.servers = servers
+
+
+def _pack_columns(parts: list[bytes], columns: tuple, values: tuple[list, ...]):
+    for (_, typecode), column in zip(columns, values):
+        column = array.array(typecode, column)
+        if sys.byteorder == 'big':
+            column.byteswap()
+        parts.append(column.tobytes())
+
+def _unpack_columns(view: memoryview, offset: int, columns: tuple, count: int) -> tuple[list[array.array], int]:
+    values = []
+    for _, typecode in columns:
+        column = array.array(typecode)
+        size = column.itemsize * count
+        column.frombytes(view[offset:offset + size])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        values.append(column)
+        offset += size
+    return values, offset
+
+
+def dump(cached: cache.CachedData, token: int, write_time: float) -> bytes:
+    # Synchronous, so that the snapshot is the state of the cache at one point of the event loop
+    parts = []
+    for server in cached.data.values():
+        parts.append(SERVER_HEADER.pack(server.id, len(server.users), len(server.voice_sessions)))
+        # Users are written in ranking order, the ranking of a restored server is then built from sorted entries
+        user_ids = [user_id for _, user_id in server.ranking.entries]
+        users = [server.users[user_id] for user_id in user_ids]
+        _pack_columns(parts, USER_COLUMNS, (user_ids, [user.xp for user in users],
+                                            [user.lastmsg_time for user in users], [user.lastmsg_xp for user in users]))
+        sessions = server.voice_sessions
+        _pack_columns(parts, SESSION_COLUMNS, (sessions.keys(), [session.update_time for session in sessions.values()]))
+    body = b''.join(parts)
+    return HEADER.pack(MAGIC, VERSION, token, write_time, len(cached.data), zlib.crc32(body)) + body
+
+def write(path: str, payload: bytes):
+    # Written under a temporary name first so that a snapshot is never seen half written
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+def load(path: str) -> Snapshot:
+    # Raises FileNotFoundError without a snapshot and ValueError for a corrupted or unknown one
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        # The users and their ranking are new objects without cycles, the collections their allocation would trigger only scan the heap again and again
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return _read(path, view)
+        except struct.error:
+            raise ValueError(f'{path} is truncated')
+        finally:
+            view.release()
+            if gc_enabled:
+                gc.enable()
+
+def _read(path: str, view: memoryview) -> Snapshot:
+    if len(view) < HEADER.size:
+        raise ValueError(f'{path} is truncated')
+    magic, version, token, write_time, n_servers, crc = HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a version {VERSION} cache snapshot')
+    if zlib.crc32(view[HEADER.size:]) != crc:
+        raise ValueError(f'{path} is corrupted')
+    servers = {}
+    offset = HEADER.size
+    for _ in range(n_servers):
+        server_id, n_users, n_sessions = SERVER_HEADER.unpack_from(view, offset)
+        offset += SERVER_HEADER.size
+        (user_ids, xp, lastmsg_time, lastmsg_xp), offset = _unpack_columns(view, offset, USER_COLUMNS, n_users)
+        (session_ids, update_time), offset = _unpack_columns(view, offset, SESSION_COLUMNS, n_sessions)
+        users = dict(zip(user_ids, map(cache.UserActivity, xp, lastmsg_time, lastmsg_xp)))
+        ranking = cache.Ranking(users, list(zip(map(operator.neg, xp), user_ids)))
+        servers[server_id] = ServerSnapshot(users, ranking, dict(zip(session_ids, update_time)))
+    if offset != len(view):
+        raise ValueError(f'{path} is corrupted')
+    return Snapshot(token, write_time, servers)
@@ -0,0 +1,171 @@
+import time
+import asyncio
+import functools
+import threading
+from multiprocessing.connection import Client
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import data
+import memory
+import metrics
+
+# Storage engines, selected with STORAGE_ENGINE
+ENGINES: dict[str:type[data.Storage]] = {
+    'sqlite': data.Database,
+    'memory': memory.MemoryDatabase,
+}
+
+
+class AsyncDatabase():
+    """Runs the methods of a storage engine (data.Database by default) off the event loop.
+
+    Writes go through a single writer thread so they keep their submission order,
+    reads (the get_* methods) are spread over a pool of threads with their own connection.
+    """
+
+    def __init__(self, path: str | None = data.DB_PATH, readers: int = 4, engine: type[data.Storage] = data.Database, **options):
+        self.path = path
+        self.engine = engine
+        self.options = options
+        self._local = threading.local()
+        # A thread safe engine is opened once and shared by every thread
+        self._shared = engine(path, **options) if engine.thread_safe else None
+        self.writer = ThreadPoolExecutor(1, 'db-writer', self._connect)
+        self.readers = ThreadPoolExecutor(readers, 'db-reader', self._connect)
+
+    def _connect(self):
+        self._local.db = self._shared if self._shared is not None else self.engine(self.path, **self.options)
+
+    def _call(self, name: str, args: tuple, kwargs: dict):
+        start = time.perf_counter()
+        result = getattr(self._local.db, name)(*args, **kwargs)
+        metrics.DB_CALL_SECONDS.observe(time.perf_counter() - start, method=name)
+        if not self.is_read(name):
+            metrics.DB_COMMITS.inc()
+        return result
+
+    @staticmethod
+    def is_read(name: str) -> bool:
+        return name.startswith('get_')
+
+    def submit(self, name: str, args: tuple, kwargs: dict, ordered: bool = False) -> Future:
+        # For callers outside of an event loop, such as the writer process
+        executor = self.readers if self.is_read(name) and not ordered else self.writer
+        return executor.submit(self._call, name, args, kwargs)
+
+    async def _submit(self, executor: ThreadPoolExecutor, name: str, args: tuple, kwargs: dict):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(self._call, name, args, kwargs))
+
+    async def run(self, name: str, *args, **kwargs):
+        executor = self.readers if self.is_read(name) else self.writer
+        return await self._submit(executor, name, args, kwargs)
+
+    async def run_ordered(self, name: str, *args, **kwargs):
+        # Runs on the writer thread, after every write submitted before it
+        return await self._submit(self.writer, name, args, kwargs)
+
+    def __getattr__(self, name: str):
+        if name.startswith('_') or not callable(getattr(self.__dict__.get('engine', data.Storage), name, None)):
+            raise AttributeError(name)
+        method = functools.partial(self.run, name)
+        setattr(self, name, method)
+        return method
+
+    def close(self):
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        if self._shared is not None:
+            self._shared.close()
+
+
+class RemoteDatabase():
+    """Same interface as AsyncDatabase, for the bot processes of a sharded deployment.
+
+    Calls are sent over a Unix socket to the writer process (writer.py), which runs them on its own AsyncDatabase.
+    The writer handles the calls of a connection in the order they are sent, so run_ordered keeps its guarantee.
+    """
+
+    def __init__(self, address: str, authkey: bytes | None = None):
+        self.address = address
+        self.authkey = authkey
+        self.connection = None
+        self.lock = threading.Lock()
+        self.next_id: int = 0
+        self.pending: dict[int:tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+
+    is_read = staticmethod(AsyncDatabase.is_read)
+
+    def _connect(self):
+        self.connection = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+        threading.Thread(target=self._receive, args=(self.connection,), name='db-remote', daemon=True).start()
+
+    def _receive(self, connection):
+        while True:
+            try:
+                request_id, ok, result = connection.recv()
+            except (EOFError, OSError):
+                break
+            loop, future = self.pending.pop(request_id)
+            _resolve(loop, future, ok, result)
+        # Calls still waiting will never get their answer
+        with self.lock:
+            if self.connection is connection:
+                self.connection = None
+            pending, self.pending = self.pending, {}
+        for loop, future in pending.values():
+            _resolve(loop, future, False, ConnectionError(f'Lost the connection to {self.address}'))
+
+    async def _submit(self, name: str, args: tuple, kwargs: dict, ordered: bool):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if self.connection is None:
+                self._connect()
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = (loop, future)
+            try:
+                self.connection.send((request_id, name, args, kwargs, ordered))
+            except Exception:
+                self.pending.pop(request_id, None)
+                raise
+        return await future
+
+    async def run(self, name: str, *args, **kwargs):
+        return await self._submit(name, args, kwargs, False)
+
+    async def run_ordered(self, name: str, *args, **kwargs):
+        return await self._submit(name, args, kwargs, True)
+
+    def __getattr__(self, name: str):
+        if name.startswith('_') or not callable(getattr(data.Storage, name, None)):
+            raise AttributeError(name)
+        method = functools.partial(self.run, name)
+        setattr(self, name, method)
+        return method
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+def _resolve(loop: asyncio.AbstractEventLoop, future: asyncio.Future, ok: bool, result):
+    # Answers to calls made on a loop that is already closed, e.g. the one of Client.run before on_exit, are dropped
+    if future.done() or loop.is_closed():
+        return
+    try:
+        loop.call_soon_threadsafe(_set_result, future, ok, result)
+    except RuntimeError:
+        # The loop closed since the check
+        pass
+
+def _set_result(future: asyncio.Future, ok: bool, result):
+    if future.done():
+        return
+    if ok:
+        future.set_result(result)
+    else:
+        future.set_exception(result)
@@ -0,0 +1,217 @@
+"""Exports the users, roles and channels of a server to CSV or JSONL files, and imports them back.
+
+Rows are streamed in chunks in both directions so that memory stays bounded whatever the size of the server.
+An import first stages the files in temporary tables, then applies them in one transaction, or only
+reports the difference with the database in dry-run mode. Stop the bot before an import, its cache
+would not see the new rows. The imported XP is recorded in the activity journal, so that a later
+recomputation starts from it.
+
+    python transfer.py export <server_id> backup/ --format jsonl
+    python transfer.py import <server_id> backup/ --dry-run
+"""
+import os
+import csv
+import sys
+import json
+import time
+import asyncio
+import argparse
+import itertools
+
+import data
+import journal
+
+CHUNK_SIZE = 10000
+
+# Columns of each table, the first one is the key of a row within a server
+TABLES = {
+    'users': ('discord_id', 'username', 'xp', 'msg_count', 'voice_uptime', 'lastmsg_time', 'lastmsg_xp'),
+    'roles': ('id', 'xp_threshold'),
+    'channels': ('id', 'type'),
+}
+TYPES = {'username': str, 'lastmsg_time': float}
+DEFAULTS = {'username': ''}
+
+
+def table_path(directory: str, table: str, file_format: str) -> str:
+    return os.path.join(directory, f'{table}.{file_format}')
+
+def parse_row(values: dict, columns: tuple[str, ...]) -> tuple:
+    # Empty values take the default of their column
+    return tuple(DEFAULTS.get(column, 0) if values.get(column) in (None, '') else TYPES.get(column, int)(values[column]) for column in columns)
+
+
+# ================================
+# Export
+# ================================
+
+def export_table(db: data.Database, server_id: int, table: str, path: str, file_format: str, chunk_size: int = CHUNK_SIZE) -> int:
+    columns = TABLES[table]
+    cursor = db.con.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE server_id = ? ORDER BY {columns[0]}", (server_id,))
+    n_rows = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file) if file_format == 'csv' else None
+        if writer:
+            writer.writerow(columns)
+        while rows := cursor.fetchmany(chunk_size):
+            if writer:
+                writer.writerows(rows)
+            else:
+                file.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows)
+            n_rows += len(rows)
+    return n_rows
+
+
+# ================================
+# Import
+# ================================
+
+def file_columns(path: str, file_format: str, table: str) -> tuple[str, ...]:
+    # Only the columns found in the file are imported, so that files from other bots only need the key and the XP.
+    # The columns of a JSONL file are the ones of its first row
+    with open(path, newline='', encoding='utf-8') as file:
+        if file_format == 'csv':
+            found = next(csv.reader(file), [])
+        else:
+            line = file.readline()
+            found = json.loads(line) if line.strip() else {}
+    columns = tuple(column for column in TABLES[table] if column in found)
+    if TABLES[table][0] not in columns:
+        raise ValueError(f'{path} has no {TABLES[table][0]} column')
+    return columns
+
+def read_rows(path: str, file_format: str, columns: tuple[str, ...]):
+    with open(path, newline='', encoding='utf-8') as file:
+        reader = csv.DictReader(file) if file_format == 'csv' else (json.loads(line) for line in file if line.strip())
+        for values in reader:
+            yield parse_row(values, columns)
+
+def stage_table(db: data.Database, table: str, columns: tuple[str, ...], rows, chunk_size: int = CHUNK_SIZE) -> int:
+    # The rows are written to a temporary table one chunk per transaction, a key seen twice keeps its last row
+    db.con.execute(f'DROP TABLE IF EXISTS temp.import_{table}')
+    db.con.execute(f"CREATE TEMP TABLE import_{table} ({columns[0]} INTEGER PRIMARY KEY, {', '.join(columns[1:])})")
+    query = f"INSERT OR REPLACE INTO import_{table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    n_rows = 0
+    while chunk := list(itertools.islice(rows, chunk_size)):
+        with db.con:
+            db.con.executemany(query, chunk)
+        n_rows += len(chunk)
+    return n_rows
+
+def _match(table: str) -> str:
+    # Users are only unique within a server, roles and channels have a global id
+    key = TABLES[table][0]
+    if table == 'users':
+        return f't.server_id = :server_id AND t.{key} = i.{key}'
+    return f't.{key} = i.{key}'
+
+def diff_table(db: data.Database, server_id: int, table: str, columns: tuple[str, ...]) -> dict[str:int]:
+    key = columns[0]
+    changed = ' OR '.join(f't.{column} IS NOT i.{column}' for column in columns[1:]) or 'false'
+    if table != 'users':
+        # A role or a channel of another server is moved to this one
+        changed += ' OR t.server_id IS NOT :server_id'
+    params = {'server_id': server_id}
+    queries = {
+        'added': f'SELECT COUNT(*) FROM import_{table} i WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {_match(table)})',
+        'changed': f'SELECT COUNT(*) FROM import_{table} i JOIN {table} t ON {_match(table)} WHERE {changed}',
+        'unchanged': f'SELECT COUNT(*) FROM import_{table} i JOIN {table} t ON {_match(table)} WHERE NOT ({changed})',
+        'missing': f'SELECT COUNT(*) FROM {table} WHERE server_id = :server_id AND {key} NOT IN (SELECT {key} FROM import_{table})',
+    }
+    return {name: db.con.execute(query, params).fetchone()[0] for name, query in queries.items()}
+
+def apply_table(db: data.Database, server_id: int, table: str, columns: tuple[str, ...], replace: bool):
+    # Runs inside the transaction of import_server, new rows take the default values of the columns not imported
+    key = columns[0]
+    conflict = '(server_id, discord_id)' if table == 'users' else '(id)'
+    updates = ', '.join(f'{column} = excluded.{column}' for column in (*columns[1:], 'server_id'))
+    # WHERE true lets SQLite parse the ON CONFLICT clause of an INSERT ... SELECT
+    db.con.execute(f"INSERT INTO {table} (server_id, {', '.join(columns)}) SELECT :server_id, {', '.join(columns)} FROM import_{table} WHERE true "
+                   f"ON CONFLICT {conflict} DO UPDATE SET {updates}", {'server_id': server_id})
+    if replace:
+        db.con.execute(f'DELETE FROM {table} WHERE server_id = ? AND {key} NOT IN (SELECT {key} FROM import_{table})', (server_id,))
+        if table == 'users':
+            db.con.execute('DELETE FROM user_daily WHERE server_id = ? AND discord_id NOT IN (SELECT discord_id FROM import_users)', (server_id,))
+
+def import_server(db: data.Database, server_id: int, directory: str, file_format: str,
+                  dry_run: bool = False, replace: bool = False, chunk_size: int = CHUNK_SIZE,
+                  activity_journal: journal.Journal | None = None) -> dict[str:dict]:
+    tables = {}
+    for table in TABLES:
+        path = table_path(directory, table, file_format)
+        if os.path.exists(path):
+            tables[table] = file_columns(path, file_format, table)
+    report = {}
+    for table, columns in tables.items():
+        n_rows = stage_table(db, table, columns, read_rows(table_path(directory, table, file_format), file_format, columns), chunk_size)
+        report[table] = {'rows': n_rows, 'columns': columns, **diff_table(db, server_id, table, columns)}
+
+    if not dry_run and tables:
+        if activity_journal and 'xp' in tables.get('users', ()):
+            # The XP that the import changes is not activity the journal saw, it becomes the baseline of these users
+            db.cur.execute('SELECT i.discord_id, i.xp FROM import_users i LEFT JOIN users u ON u.server_id = ? AND u.discord_id = i.discord_id '
+                           'WHERE COALESCE(u.xp, 0) IS NOT i.xp', (server_id,))
+            baseline = db.cur.fetchall()
+        else:
+            baseline = []
+        with db.con:
+            if db.get_server_config(server_id) is None:
+                db.con.execute('INSERT INTO servers (id, name) VALUES (?, ?)', (server_id, f'imported-{server_id}'))
+            for table, columns in tables.items():
+                apply_table(db, server_id, table, columns, replace)
+            # The cache snapshots of the bot no longer match the users
+            db.con.execute('DELETE FROM cache_snapshots')
+        if baseline:
+            import_time = time.time()
+            for user_id, xp in baseline:
+                activity_journal.set_xp(server_id, user_id, xp, import_time)
+            report['users']['baseline'] = len(baseline)
+    for table in tables:
+        db.con.execute(f'DROP TABLE temp.import_{table}')
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import the XP data of a server")
+    parser.add_argument('--db', default=data.DB_PATH)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--journal', default=os.environ.get('JOURNAL_DIR', journal.JOURNAL_DIR),
+                        help="activity journal of the bot process owning the server, empty if it is disabled")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ('export', 'import'):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument('server_id', type=int)
+        subparser.add_argument('directory', help=f"folder of the {', '.join(TABLES)} files")
+        subparser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    parser_import = subparsers.choices['import']
+    parser_import.add_argument('--dry-run', action='store_true', help="only report the difference with the database")
+    parser_import.add_argument('--replace', action='store_true', help="also delete the rows of the server missing from the files")
+    args = parser.parse_args()
+
+    db = data.Database(args.db)
+    db.init()
+    start = time.perf_counter()
+    if args.command == 'export':
+        os.makedirs(args.directory, exist_ok=True)
+        for table in TABLES:
+            n_rows = export_table(db, args.server_id, table, table_path(args.directory, table, args.format), args.format, args.chunk_size)
+            print(f'{table}: {n_rows} rows')
+    else:
+        if not os.path.isdir(args.directory):
+            sys.exit(f'{args.directory} is not a folder')
+        activity_journal = journal.Journal(args.journal) if args.journal and not args.dry_run else None
+        report = import_server(db, args.server_id, args.directory, args.format, args.dry_run, args.replace, args.chunk_size, activity_journal)
+        if activity_journal:
+            asyncio.run(activity_journal.flush())
+        for table, counts in report.items():
+            missing = 'deleted' if args.replace else 'kept'
+            print(f"{table} ({', '.join(counts['columns'])}): {counts['rows']} rows, {counts['added']} added, {counts['changed']} changed, "
+                  f"{counts['unchanged']} unchanged, {counts['missing']} not in the files ({missing})")
+        if 'baseline' in report.get('users', {}):
+            print(f"Recorded the imported XP of {report['users']['baseline']} users in the journal")
+        print('Dry run, nothing was written' if args.dry_run else 'Imported')
+    print(f'Done in {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
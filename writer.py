@@ -0,0 +1,101 @@
+"""Storage process of a sharded deployment, the only process that opens the database.
+
+The bot processes connect to its Unix socket through storage.RemoteDatabase. Writes from every process
+go through the single writer thread of an AsyncDatabase, reads are spread over its reader threads.
+The writer unpickles what it receives, it only starts with the STORAGE_AUTHKEY shared with the bot processes.
+
+    STORAGE_AUTHKEY=<key> python writer.py --address data/writer.sock
+"""
+import os
+import sys
+import signal
+import argparse
+import functools
+import threading
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Connection, Listener
+
+import data
+import memory
+import storage
+
+ADDRESS = 'data/writer.sock'
+
+
+def reply(connection: Connection, lock: threading.Lock, request_id: int, future: Future):
+    try:
+        response = (request_id, True, future.result())
+    except Exception as e:
+        response = (request_id, False, e)
+    try:
+        with lock:
+            connection.send(response)
+    except (OSError, ValueError):
+        # The bot process is gone, its calls are still done
+        pass
+
+def serve_connection(db: storage.AsyncDatabase, connection: Connection):
+    # Calls are submitted in the order they are received, the answers are sent as they complete
+    lock = threading.Lock()
+    while True:
+        try:
+            request_id, name, args, kwargs, ordered = connection.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            if name.startswith('_') or not callable(getattr(db.engine, name, None)):
+                raise AttributeError(name)
+            future = db.submit(name, args, kwargs, ordered)
+        except Exception as e:
+            # Unknown methods, or calls received while the writer shuts down
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(functools.partial(reply, connection, lock, request_id))
+    connection.close()
+
+def serve(address: str, path: str = data.DB_PATH, readers: int = 4, authkey: bytes | None = None, engine: str = 'sqlite'):
+    if os.path.exists(address):
+        os.remove(address)
+    db = storage.AsyncDatabase(path, readers, storage.ENGINES[engine])
+    db.submit('init', (), {}).result()
+    listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    print(f'Serving {path} on {address}')
+    # Stop the bot processes first so that their last flush is written, SIGTERM then stops accepting connections
+    signal.signal(signal.SIGTERM, lambda *_: listener.close())
+    try:
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError) as e:
+                # A client without the key, or gone during the handshake, the listener keeps serving the others
+                print(f'Refused a connection: {e!r}')
+                continue
+            except OSError:
+                break
+            threading.Thread(target=serve_connection, args=(db, connection), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        db.close()
+        if os.path.exists(address):
+            os.remove(address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the database to the bot processes of a sharded deployment")
+    parser.add_argument('--address', default=os.environ.get('STORAGE_ADDRESS', ADDRESS))
+    parser.add_argument('--db', help="database path, or snapshot path of the memory engine")
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--engine', choices=storage.ENGINES, default=os.environ.get('STORAGE_ENGINE', 'sqlite'))
+    args = parser.parse_args()
+    path = args.db or (os.environ.get('MEMORY_SNAPSHOT', memory.SNAPSHOT_PATH) if args.engine == 'memory' else data.DB_PATH)
+    authkey = os.environ.get('STORAGE_AUTHKEY')
+    if not authkey:
+        sys.exit('STORAGE_AUTHKEY is not set, the writer socket would accept any local process')
+    serve(args.address, path, args.readers, authkey.encode(), args.engine)
+
+
+if __name__ == '__main__':
+    main()